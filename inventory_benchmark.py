@@ -0,0 +1,519 @@
+"""
+Benchmark do Inventory Service
+
+Suite reprodutível de carga:
+1) Semeia um banco SQLite temporário com N produtos e M lançamentos, distribuídos
+   com assimetria realista (Zipf: poucos SKUs concentram a maior parte do histórico
+   e das requisições).
+2) Dispara clientes concorrentes contra o app em processo (transporte ASGI do httpx)
+   ou contra um uvicorn real (--transport uvicorn, opcionalmente com --workers).
+3) Emite JSON com vazão e latências p50/p95/p99 por endpoint, para comparar execuções
+   (--output salva o resultado; --compare mostra a variação contra um JSON anterior).
+
+Como rodar:
+1) pip install fastapi uvicorn "sqlalchemy[asyncio]" pydantic aiosqlite httpx
+2) python inventory_benchmark.py --mode both --requests 3000 --concurrency 12
+   python inventory_benchmark.py --transport uvicorn --workers 4 --output atual.json --compare base.json
+
+Modos: sync (inventory_service_fastapi) | async (inventory_service_async) | both
+Perfil SQLite: --profile default|wal (INVENTORY_SQLITE_PROFILE).
+Mistura de endpoints: --mix "stock_one=60,stock_page=10,search=10,movements_page=5,movement_in=10,movement_out=5"
+O cache de respostas fica desligado (--cache-ttl 0, o padrão do serviço) para medir o trabalho real.
+--serialization: em vez da carga, mede o custo por linha de /stock e /products/{id}/movements
+(caminho antigo: objetos/modelos pydantic por linha vs. tuplas do SQL + orjson).
+--startup: orçamento de cold start por modo: python -X importtime (total, corpo do módulo e imports
+mais pesados) e tempo do spawn do uvicorn até a primeira resposta, com banco vazio e já migrado.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_MIX = "stock_one=60,stock_page=10,search=10,movements_page=5,movement_in=10,movement_out=5"
+SEED_CHUNK = 50_000
+WORDS = ["Álcool", "Luva", "Sabão", "Papel", "Detergente", "Esponja", "Máscara", "Toalha", "Copo", "Saco"]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class ZipfPicker:
+    """Picks product ids with Zipf(s) popularity: the first id is the hottest SKU."""
+
+    def __init__(self, ids: List[int], s: float, rng: random.Random):
+        self.ids = ids
+        self.rng = rng
+        self.cum = list(itertools.accumulate(1 / (rank ** s) for rank in range(1, len(ids) + 1)))
+
+    def __call__(self) -> int:
+        return self.ids[bisect.bisect(self.cum, self.rng.random() * self.cum[-1])]
+
+
+# ===========================
+# Seeding
+# ===========================
+def seed(products: int, movements: int, skew: float, days: int, rng: random.Random) -> List[int]:
+    """Bulk-loads the catalogue and a skewed ledger, then derives balances, rollups and checkpoints."""
+    # Imported lazily: INVENTORY_* variables must be set before the service module loads
+    from sqlalchemy import insert, select
+    from inventory_service_fastapi import (
+        SessionLocal, Product, StockMovement, init_db, rebuild_balances, rebuild_rollups, take_checkpoints,
+    )
+
+    init_db()
+    with SessionLocal() as db:
+        db.execute(insert(Product), [
+            {"sku": f"SKU-{i:07d}", "name": f"{rng.choice(WORDS)} {i}", "unit": "un", "min_stock": rng.randint(0, 50)}
+            for i in range(products)
+        ])
+        ids = list(db.execute(select(Product.id).order_by(Product.id)).scalars())
+        db.commit()
+
+    pick = ZipfPicker(ids, skew, rng)
+    start = datetime.utcnow() - timedelta(days=days)
+    step = timedelta(days=days) / max(movements, 1)
+    balance: Dict[int, int] = {}
+    with SessionLocal() as db:
+        for offset in range(0, movements, SEED_CHUNK):
+            rows = []
+            for n in range(offset, min(offset + SEED_CHUNK, movements)):
+                pid = pick()
+                current = balance.get(pid, 0)
+                # Mostly sales once there is stock, replenishment otherwise
+                if current > 0 and rng.random() < 0.6:
+                    kind, change = "OUT", rng.randint(1, min(current, 10))
+                else:
+                    kind, change = "IN", rng.randint(5, 50)
+                balance[pid] = current + (change if kind == "IN" else -change)
+                rows.append({
+                    "product_id": pid, "change": change, "kind": kind, "note": None, "created_at": start + step * n,
+                })
+            db.execute(insert(StockMovement), rows)
+        db.commit()
+
+    with SessionLocal() as db:
+        rebuild_balances(dry_run=False, db=db)
+    with SessionLocal() as db:
+        rebuild_rollups(db=db)
+    with SessionLocal() as db:
+        for week in range(7, days, 7):
+            take_checkpoints(db, start + timedelta(days=week))
+        db.commit()
+    return ids
+
+# ===========================
+# Load
+# ===========================
+async def _stock_one(client, pick, rng):
+    return await client.get(f"/products/{pick()}/stock")
+
+
+async def _stock_page(client, pick, rng):
+    return await client.get("/stock", params={"limit": 50})
+
+
+async def _search(client, pick, rng):
+    return await client.get("/products", params={"q": rng.choice(WORDS)[1:5], "limit": 20})
+
+
+async def _movements_page(client, pick, rng):
+    return await client.get(f"/products/{pick()}/movements", params={"limit": 50})
+
+
+async def _movement_in(client, pick, rng):
+    return await client.post(f"/products/{pick()}/movements", json={"change": rng.randint(1, 20), "kind": "IN"})
+
+
+async def _movement_out(client, pick, rng):
+    # May legitimately answer 409 (insufficient stock); reported in "status", not as an error
+    return await client.post(f"/products/{pick()}/movements", json={"change": 1, "kind": "OUT"})
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "stock_one": _stock_one,
+    "stock_page": _stock_page,
+    "search": _search,
+    "movements_page": _movements_page,
+    "movement_in": _movement_in,
+    "movement_out": _movement_out,
+}
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Cenário desconhecido: {name!r} (use {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+async def run_load(
+    client, product_ids: List[int], requests: int, concurrency: int, mix: Dict[str, float],
+    skew: float, rng: random.Random,
+) -> Dict[str, object]:
+    names = list(mix)
+    cum_weights = list(itertools.accumulate(mix[n] for n in names))
+    pick = ZipfPicker(product_ids, skew, rng)
+    latencies: Dict[str, List[float]] = {name: [] for name in names}
+    statuses: Dict[str, Dict[str, int]] = {name: {} for name in names}
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        for _ in remaining:
+            name = rng.choices(names, cum_weights=cum_weights)[0]
+            started = time.perf_counter()
+            try:
+                status = str((await SCENARIOS[name](client, pick, rng)).status_code)
+            except Exception as exc:  # transport errors (timeouts, resets) are results too
+                status = type(exc).__name__
+            latencies[name].append((time.perf_counter() - started) * 1000)
+            statuses[name][status] = statuses[name].get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    errors = sum(
+        n for per_status in statuses.values() for code, n in per_status.items() if not code[:1] in ("2", "3", "4")
+    )
+    report: Dict[str, object] = {
+        "requests": requests, "concurrency": concurrency, "errors": errors,
+        "seconds": round(elapsed, 3), "rps": round(requests / elapsed, 1), "endpoints": {},
+    }
+    for name in names:
+        values = sorted(latencies[name])
+        report["endpoints"][name] = {
+            "count": len(values),
+            "rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+            "status": statuses[name],
+        }
+    return report
+
+
+async def run_in_process(mode: str, *load_args) -> Dict[str, object]:
+    import httpx
+
+    if mode == "sync":
+        from inventory_service_fastapi import app
+    else:
+        from inventory_service_async import app
+    # App exceptions (e.g. pool timeouts) are counted as 500s instead of aborting the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        return await run_load(client, *load_args)
+
+
+def bench_serialization(product_ids: List[int], rows: int, repeat: int) -> Dict[str, object]:
+    """Per-row cost of building a list response: SQL + hydration + encoding, old path vs fast path."""
+    from pydantic import TypeAdapter
+    from sqlalchemy import select
+    import inventory_service_fastapi as svc
+
+    def measure(fn: Callable[[], bytes]) -> Tuple[float, int]:
+        fn()  # warm-up (statement cache, imports)
+        best, size = float("inf"), 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            size = len(fn())
+            best = min(best, time.perf_counter() - started)
+        return best, size
+
+    snapshots = TypeAdapter(List[svc.StockSnapshot])
+    movements = TypeAdapter(List[svc.MovementOut])
+    order = (svc.StockMovement.created_at.desc(), svc.StockMovement.id.desc())
+    hottest = product_ids[0]
+    cases = {
+        "stock": (
+            # Before: mappings -> StockSnapshot per row -> TypeAdapter.dump_json
+            lambda db: snapshots.dump_json(
+                [svc.StockSnapshot(**row) for row in db.execute(svc.stock_snapshot_query().limit(rows)).mappings()]
+            ),
+            lambda db: svc.rows_to_json(
+                svc.STOCK_SNAPSHOT_FIELDS, db.execute(svc.stock_snapshot_query().limit(rows)).all()
+            ),
+        ),
+        "movements": (
+            # Before: ORM objects -> response_model validation -> jsonable dict -> json.dumps (FastAPI's path)
+            lambda db: json.dumps(movements.dump_python(movements.validate_python(
+                db.execute(
+                    select(svc.StockMovement).where(svc.StockMovement.product_id == hottest).order_by(*order).limit(rows)
+                ).scalars().all()
+            ), mode="json"), ensure_ascii=False, separators=(",", ":")).encode(),
+            lambda db: svc.rows_to_json(svc.MOVEMENT_FIELDS, db.execute(
+                select(*(getattr(svc.StockMovement, f) for f in svc.MOVEMENT_FIELDS))
+                .where(svc.StockMovement.product_id == hottest).order_by(*order).limit(rows)
+            ).all()),
+        ),
+    }
+    report: Dict[str, object] = {"encoder": "orjson" if svc.orjson is not None else "json", "repeat": repeat}
+    with svc.SessionLocal() as db:
+        for name, (baseline, fast) in cases.items():
+            old_seconds, old_size = measure(lambda: baseline(db))
+            new_seconds, new_size = measure(lambda: fast(db))
+            count = len(json.loads(fast(db)))
+            report[name] = {
+                "rows": count,
+                "same_bytes": baseline(db) == fast(db),
+                "baseline_us_per_row": round(old_seconds / max(count, 1) * 1e6, 2),
+                "fast_us_per_row": round(new_seconds / max(count, 1) * 1e6, 2),
+                "speedup": round(old_seconds / new_seconds, 2) if new_seconds else None,
+                "bytes": new_size,
+            }
+            db.expunge_all()
+    return report
+
+
+# ===========================
+# Startup
+# ===========================
+SERVICE_MODULES = {"sync": "inventory_service_fastapi", "async": "inventory_service_async"}
+
+
+def import_profile(module: str, top: int = 8) -> Dict[str, object]:
+    """`python -X importtime -c "import <module>"` in a fresh process: total, the module's own
+    body and its heaviest direct imports (cumulative, in ms)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=os.environ.copy(),
+        capture_output=True, text=True, check=True,
+    )
+    rows: List[Tuple[int, int, int, str]] = []  # (depth, self_us, cumulative_us, name)
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, raw_name = line[len("import time:"):].split("|")
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        rows.append((depth, int(self_us), int(cumulative_us), raw_name.strip()))
+    # Children are printed before their parent; the module's subtree starts after the previous top-level line
+    end = next(i for i, row in enumerate(rows) if row[0] == 0 and row[3] == module)
+    begin = max((i for i in range(end) if rows[i][0] == 0), default=-1) + 1
+    direct = sorted((r for r in rows[begin:end] if r[0] == 1), key=lambda r: r[2], reverse=True)
+    return {
+        "total_ms": round(rows[end][2] / 1000, 1),
+        "module_body_ms": round(rows[end][1] / 1000, 1),
+        "heaviest_imports_ms": {name: round(cumulative / 1000, 1) for _, _, cumulative, name in direct[:top]},
+    }
+
+
+async def time_to_first_request(module: str, database_url: str) -> Dict[str, float]:
+    """Spawns one uvicorn worker and measures, from the spawn, the first 200 on /health
+    (process up, lifespan done) and on /stock (first query on a new connection)."""
+    import httpx
+
+    port = _free_port()
+    env = dict(os.environ, INVENTORY_DATABASE_URL=database_url)
+    env.pop("INVENTORY_ASYNC_DATABASE_URL", None)
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            while True:
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() - started > 30 or server.poll() is not None:
+                    raise SystemExit("uvicorn não respondeu em /health")
+                await asyncio.sleep(0.005)
+            health_ms = (time.perf_counter() - started) * 1000
+            (await client.get("/stock", params={"limit": 1})).raise_for_status()
+            stock_ms = (time.perf_counter() - started) * 1000
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {"first_health_ms": round(health_ms, 1), "first_stock_ms": round(stock_ms, 1)}
+
+
+def bench_startup(modes: List[str], seeded_url: str, repeat: int) -> Dict[str, object]:
+    """Cold-start budget per mode: import breakdown plus time-to-first-request against an empty
+    database (schema created at startup) and against the seeded one (schema already current).
+    Medians of `repeat` runs."""
+    def median(values: List[float]) -> float:
+        return sorted(values)[len(values) // 2]
+
+    report: Dict[str, object] = {"repeat": repeat}
+    for mode in modes:
+        module = SERVICE_MODULES[mode]
+        imports = [import_profile(module) for _ in range(repeat)]
+        entry: Dict[str, object] = {
+            "import_ms": median([i["total_ms"] for i in imports]),
+            "module_body_ms": median([i["module_body_ms"] for i in imports]),
+            "heaviest_imports_ms": imports[-1]["heaviest_imports_ms"],
+        }
+        for label in ("empty_db", "current_db"):
+            runs = []
+            for _ in range(repeat):
+                if label == "empty_db":
+                    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='inventory-startup-'), 'cold.db')}"
+                else:
+                    url = seeded_url
+                runs.append(asyncio.run(time_to_first_request(module, url)))
+            entry[label] = {key: median([r[key] for r in runs]) for key in runs[0]}
+        report[mode] = entry
+    return report
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_over_uvicorn(mode: str, workers: int, *load_args) -> Dict[str, object]:
+    import httpx
+
+    module = "inventory_service_fastapi" if mode == "sync" else "inventory_service_async"
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=os.environ.copy(),
+    )
+    concurrency = load_args[2]
+    try:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise SystemExit("uvicorn não respondeu em /health")
+                await asyncio.sleep(0.2)
+            return await run_load(client, *load_args)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def compare(current: Dict[str, object], baseline: Dict[str, object]) -> Dict[str, object]:
+    """Relative change (%) of rps and percentiles per mode/endpoint; positive latency = slower."""
+    def delta(new: float, old: float) -> Optional[float]:
+        return round((new - old) / old * 100, 1) if old else None
+
+    diff: Dict[str, object] = {}
+    for mode in ("sync", "async"):
+        if mode not in current or mode not in baseline:
+            continue
+        new, old = current[mode], baseline[mode]
+        entry: Dict[str, object] = {"rps_pct": delta(new["rps"], old["rps"]), "endpoints": {}}
+        for name, stats in new["endpoints"].items():
+            if name in old["endpoints"]:
+                base = old["endpoints"][name]
+                entry["endpoints"][name] = {
+                    key + "_pct": delta(stats[key], base[key]) for key in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                }
+        diff[mode] = entry
+    return diff
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark do Inventory Service")
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    parser.add_argument("--transport", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--workers", type=int, default=1, help="processos uvicorn (--transport uvicorn)")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--movements", type=int, default=20000, help="total de lançamentos semeados")
+    parser.add_argument("--days", type=int, default=180, help="janela de histórico semeada")
+    parser.add_argument("--skew", type=float, default=1.1, help="expoente Zipf dos SKUs (0 = uniforme)")
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=12)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--profile", choices=["default", "wal"], default="wal")
+    parser.add_argument("--cache-ttl", default="0", help="INVENTORY_CACHE_TTL do app medido")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="arquivo SQLite já semeado (pula a semeadura)")
+    parser.add_argument("--output", help="grava o JSON do resultado neste arquivo")
+    parser.add_argument("--compare", help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--serialization", action="store_true", help="mede só o custo de serialização por linha")
+    parser.add_argument("--rows", type=int, default=1000, help="linhas por resposta (--serialization)")
+    parser.add_argument("--startup", action="store_true", help="mede só o cold start (imports e primeira requisição)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="inventory-bench-"), "bench.db")
+    os.environ["INVENTORY_DATABASE_URL"] = f"sqlite:///{os.path.abspath(db_path)}"
+    os.environ.pop("INVENTORY_ASYNC_DATABASE_URL", None)
+    os.environ["INVENTORY_SQLITE_PROFILE"] = args.profile
+    os.environ["INVENTORY_CACHE_TTL"] = args.cache_ttl
+    os.environ["INVENTORY_CHECKPOINT_INTERVAL"] = "0"
+
+    seed_started = time.perf_counter()
+    if args.db:
+        from sqlalchemy import select
+        from inventory_service_fastapi import SessionLocal, Product, init_db
+        init_db()
+        with SessionLocal() as db:
+            product_ids = list(db.execute(select(Product.id).order_by(Product.id)).scalars())
+    else:
+        product_ids = seed(args.products, args.movements, args.skew, args.days, rng)
+    seed_seconds = time.perf_counter() - seed_started
+
+    results: Dict[str, object] = {
+        "config": {
+            key: getattr(args, key) for key in (
+                "transport", "workers", "products", "movements", "days", "skew", "requests",
+                "concurrency", "mix", "profile", "cache_ttl", "seed",
+            )
+        },
+        "python": sys.version.split()[0],
+        "seed_seconds": round(seed_seconds, 2),
+    }
+    if args.serialization:
+        results["serialization"] = bench_serialization(product_ids, args.rows, repeat=20)
+        print(json.dumps(results, indent=2))
+        return
+    modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+    if args.startup:
+        results["startup"] = bench_startup(modes, os.environ["INVENTORY_DATABASE_URL"], repeat=5)
+        print(json.dumps(results, indent=2))
+        return
+    load_args: Tuple = (product_ids, args.requests, args.concurrency, mix, args.skew, rng)
+    for mode in modes:
+        if args.transport == "asgi":
+            results[mode] = asyncio.run(run_in_process(mode, *load_args))
+        else:
+            results[mode] = asyncio.run(run_over_uvicorn(mode, args.workers, *load_args))
+
+    if args.compare:
+        with open(args.compare) as fh:
+            results["compare"] = compare(results, json.load(fh))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
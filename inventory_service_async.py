@@ -0,0 +1,339 @@
+"""
+Inventory Service - modo assíncrono (SQLAlchemy AsyncEngine + handlers async def)
+
+Mesmos endpoints, modelos e regras de inventory_service_fastapi.py, mas cada
+request roda no event loop com uma AsyncSession, em vez de ocupar uma thread do
+threadpool do FastAPI com uma Session síncrona.
+
+As regras de negócio não são duplicadas: cada handler async chama o handler
+síncrono correspondente via AsyncSession.run_sync, que executa o mesmo código
+ORM sobre o driver assíncrono (greenlet), sem bloquear o loop.
+
+Como rodar:
+1) pip install fastapi uvicorn "sqlalchemy[asyncio]" pydantic aiosqlite   (ou asyncpg para PostgreSQL)
+2) uvicorn inventory_service_async:app
+
+Banco: INVENTORY_ASYNC_DATABASE_URL, ou derivado de INVENTORY_DATABASE_URL
+(sqlite:// -> sqlite+aiosqlite://, postgresql:// -> postgresql+asyncpg://).
+O perfil SQLite (INVENTORY_SQLITE_PROFILE) vale também para este modo.
+
+Limitação: as respostas format=ndjson continuam usando a Session síncrona
+(o gerador de streaming roda no threadpool).
+
+Benchmark comparando os dois modos: python inventory_benchmark.py --mode both
+"""
+from __future__ import annotations
+
+import os
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional
+
+from fastapi import Depends, FastAPI, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+import inventory_service_fastapi as sync_service
+from inventory_service_fastapi import (
+    AfterParam, AsOfParam, BucketParam, DateFromParam, DateToParam, FormatParam, LimitParam, SkuPrefixParam,
+    WarehouseParam, IdempotencyKeyHeader,
+    ArchiveJobOut, CheckpointJobOut, MovementBatchIn, MovementBatchOut, MovementCreate, MovementOut,
+    ProductCreate, ProductImportOut, ProductOut, ProductUpdate, RebuildBalancesOut, RebuildRollupsOut, RollupBucket,
+    StockSnapshot, TransferCreate, TransferOut, WarehouseCreate, WarehouseOut, WarehouseStockOut,
+)
+
+# ===========================
+# DB setup
+# ===========================
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+ASYNC_DATABASE_URL = os.getenv("INVENTORY_ASYNC_DATABASE_URL", to_async_url(sync_service.DATABASE_URL))
+
+
+def build_async_engine(url: str = ASYNC_DATABASE_URL) -> AsyncEngine:
+    if url.startswith("sqlite"):
+        new_engine = create_async_engine(
+            url, poolclass=sync_service.InstrumentedAsyncQueuePool,
+            **sync_service.SQLITE_PROFILES[sync_service.SQLITE_PROFILE]["pool"],
+        )
+        sync_service.install_sqlite_pragmas(new_engine.sync_engine, sync_service.sqlite_pragmas())
+    else:
+        new_engine = create_async_engine(url, poolclass=sync_service.InstrumentedAsyncQueuePool)
+    sync_service.instrument_engine(new_engine.sync_engine, "async")
+    return new_engine
+
+
+_async_engine: Optional[AsyncEngine] = None
+
+
+def get_async_engine() -> AsyncEngine:
+    # Built on first use, like sync_service.get_engine(); only ever called from the event loop thread
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = build_async_engine()
+    return _async_engine
+
+
+class LazyAsyncSessionmaker(async_sessionmaker):
+    def __call__(self, **local_kw: Any) -> AsyncSession:
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_async_engine())
+        return super().__call__(**local_kw)
+
+
+# expire_on_commit=False: objects are serialized after run_sync returns, outside the greenlet
+AsyncSessionLocal = LazyAsyncSessionmaker(autoflush=False, expire_on_commit=False)
+
+app = FastAPI(title="Inventory Service (async)", version="1.0.0", lifespan=sync_service.lifespan)
+app.add_middleware(sync_service.MetricsMiddleware)
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# ===========================
+# Product Endpoints
+# ===========================
+@app.post("/products", response_model=ProductOut, status_code=201)
+async def create_product(payload: ProductCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.create_product(payload, db=s))
+
+
+@app.get("/products", response_model=List[ProductOut])
+async def list_products(
+    response: Response,
+    q: Optional[str] = Query(None, description="Busca por nome ou SKU"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.list_products(
+            response, q=q, sku_prefix=sku_prefix, limit=limit, after=after, fmt=fmt, db=s
+        )
+    )
+
+
+@app.get("/products/{product_id}", response_model=ProductOut)
+async def get_product(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.get_product(product_id, db=s))
+
+
+@app.patch("/products/{product_id}", response_model=ProductOut)
+async def update_product(product_id: int, payload: ProductUpdate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.update_product(product_id, payload, db=s))
+
+
+@app.delete("/products/{product_id}", status_code=204)
+async def delete_product(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.delete_product(product_id, db=s))
+
+
+# Import/export stream on their own sync sessions (threadpool / server-side cursor)
+@app.post("/products:import", response_model=ProductImportOut)
+async def import_products(
+    request: Request,
+    fmt: Optional[Literal["csv", "ndjson"]] = Query(
+        None, alias="format", description="csv ou ndjson (padrão: pelo Content-Type)"
+    ),
+):
+    return await sync_service.import_products(request, fmt)
+
+
+@app.get("/products:export")
+async def export_products(
+    fmt: Literal["csv", "ndjson"] = Query("csv", alias="format", description="csv ou ndjson"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
+):
+    return sync_service.export_products(fmt, sku_prefix)
+
+# ===========================
+# Warehouse Endpoints
+# ===========================
+@app.post("/warehouses", response_model=WarehouseOut, status_code=201)
+async def create_warehouse(payload: WarehouseCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.create_warehouse(payload, db=s))
+
+
+@app.get("/warehouses", response_model=List[WarehouseOut])
+async def list_warehouses(db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.list_warehouses(db=s))
+
+# ===========================
+# Stock Endpoints
+# ===========================
+@app.post("/products/{product_id}/movements", response_model=MovementOut, status_code=201)
+async def create_movement(
+    product_id: int,
+    payload: MovementCreate,
+    idempotency_key: Optional[str] = IdempotencyKeyHeader,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.create_movement(product_id, payload, idempotency_key=idempotency_key, db=s)
+    )
+
+
+@app.post("/transfers", response_model=TransferOut, status_code=201)
+async def create_transfer(payload: TransferCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.create_transfer(payload, db=s))
+
+
+@app.post("/movements:batch", response_model=MovementBatchOut)
+async def create_movements_batch(payload: MovementBatchIn, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.create_movements_batch(payload, db=s))
+
+
+@app.get("/products/{product_id}/movements", response_model=List[MovementOut])
+async def list_movements(
+    product_id: int,
+    response: Response,
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    warehouse_id: Optional[int] = Query(None, description="Apenas lançamentos deste depósito"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.list_movements(
+            product_id, response, limit=limit, after=after, fmt=fmt, warehouse_id=warehouse_id, db=s,
+        )
+    )
+
+
+@app.get("/products/{product_id}/movements/archived")
+async def list_archived_movements(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.list_archived_movements(product_id, db=s))
+
+
+@app.get("/stock", response_model=List[StockSnapshot])
+async def list_stock(
+    request: Request,
+    q: Optional[str] = Query(None, description="Busca por nome ou SKU"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
+    only_below_min: bool = Query(False, description="Apenas itens abaixo do mínimo"),
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    as_of: Optional[datetime] = AsOfParam,
+    warehouse_id: Optional[int] = WarehouseParam,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.list_stock(
+            request, q=q, sku_prefix=sku_prefix, only_below_min=only_below_min,
+            limit=limit, after=after, fmt=fmt, as_of=as_of, warehouse_id=warehouse_id, db=s,
+        )
+    )
+
+
+@app.get("/products/{product_id}/stock", response_model=StockSnapshot)
+async def get_product_stock(
+    product_id: int,
+    request: Request,
+    as_of: Optional[datetime] = AsOfParam,
+    warehouse_id: Optional[int] = WarehouseParam,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.get_product_stock(product_id, request, as_of=as_of, warehouse_id=warehouse_id, db=s)
+    )
+
+
+@app.get("/products/{product_id}/stock/warehouses", response_model=List[WarehouseStockOut])
+async def get_product_stock_by_warehouse(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.get_product_stock_by_warehouse(product_id, db=s))
+
+# ===========================
+# Alert stream (Server-Sent Events)
+# ===========================
+# Streams read stock_alerts on their own sync sessions (threadpool)
+@app.get("/alerts/stream")
+async def stream_alerts(
+    request: Request,
+    after: Optional[int] = Query(None, ge=0, description="Reenvia os alertas com id maior (padrão: só os novos)"),
+):
+    return await sync_service.stream_alerts(request, after)
+
+# ===========================
+# Reporting
+# ===========================
+@app.get("/products/{product_id}/movements/rollup", response_model=List[RollupBucket])
+async def product_movements_rollup(
+    product_id: int,
+    bucket: Literal["day", "week", "month"] = BucketParam,
+    date_from: Optional[date] = DateFromParam,
+    date_to: Optional[date] = DateToParam,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.product_movements_rollup(
+            product_id, bucket=bucket, date_from=date_from, date_to=date_to, db=s
+        )
+    )
+
+
+@app.get("/movements/rollup", response_model=List[RollupBucket])
+async def movements_rollup(
+    bucket: Literal["day", "week", "month"] = BucketParam,
+    date_from: Optional[date] = DateFromParam,
+    date_to: Optional[date] = DateToParam,
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(
+        lambda s: sync_service.movements_rollup(bucket=bucket, date_from=date_from, date_to=date_to, db=s)
+    )
+
+# ===========================
+# Admin
+# ===========================
+@app.post("/admin/rebuild-balances", response_model=RebuildBalancesOut)
+async def rebuild_balances(
+    dry_run: bool = Query(False, description="Apenas reporta divergências, sem corrigir"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(lambda s: sync_service.rebuild_balances(dry_run=dry_run, db=s))
+
+
+@app.post("/admin/rebuild-rollups", response_model=RebuildRollupsOut)
+async def rebuild_rollups(db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda s: sync_service.rebuild_rollups(db=s))
+
+
+@app.post("/admin/checkpoints", response_model=CheckpointJobOut)
+async def run_checkpoints():
+    return await run_in_threadpool(sync_service.run_checkpoint_job)
+
+
+@app.post("/admin/archive-movements", response_model=ArchiveJobOut)
+async def archive_movements(
+    retention_days: int = Query(
+        sync_service.ARCHIVE_RETENTION_DAYS or 365, ge=1, description="Dias de histórico mantidos em stock_movements"
+    ),
+):
+    return await run_in_threadpool(sync_service.run_archive_job, retention_days)
+
+# ===========================
+# Health & meta
+# ===========================
+@app.get("/health")
+async def health() -> Dict[str, str]:
+    return sync_service.health()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    return sync_service.metrics()
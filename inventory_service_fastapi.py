@@ -5,12 +5,52 @@ Features:
 - CRUD de produtos (SKU, nome, unidade, estoque mínimo)
 - Lançamentos de estoque (entrada/saída) com histórico
 - Endpoint para consultar saldo atual e abaixo do mínimo
+- Saldo materializado por produto (stock_balances), atualizado junto com cada lançamento
+- Reconciliação do saldo com o histórico (POST /admin/rebuild-balances)
+- Busca de produtos por índice FTS5 trigram (q) e por prefixo de SKU (sku_prefix)
+- Lançamentos em lote (POST /movements:batch), atômicos ou best-effort
+- Cache em processo (TTL + LRU) de /stock e /products/{id}/stock, invalidado nas escritas, com ETag/304
+- Totais de entradas/saídas por dia/semana/mês (GET /products/{id}/movements/rollup e /movements/rollup)
+- Saldo em data passada (as_of) via checkpoints periódicos + replay do histórico desde o checkpoint
+- Métricas no formato Prometheus (GET /metrics): latência por rota, requisições em andamento,
+  tamanho das respostas, consultas SQL por requisição, tempo de statement e uso do pool
+- Importação em massa de produtos (POST /products:import, CSV ou NDJSON, upsert por SKU em lotes)
+  e exportação em streaming (GET /products:export)
+- Listas de saldo e de lançamentos serializadas direto das tuplas do SQL (orjson se instalado),
+  sem hidratar objetos ORM nem validar um modelo por linha
+- Alertas de estoque mínimo detectados na escrita (lançamentos, edição de min_stock, importação)
+  e publicados por Server-Sent Events (GET /alerts/stream); flag below_minimum indexada em stock_balances
+- Arquivamento do histórico antigo (POST /admin/archive-movements): lançamentos fora da janela de
+  retenção vão comprimidos para stock_movement_archives e viram um lançamento de saldo de abertura
+- Vários depósitos: warehouse_id nos lançamentos e saldos por depósito, /stock agregado ou por depósito
+  (warehouse_id) e transferências atômicas entre depósitos (POST /transfers)
+- Idempotency-Key nos lançamentos: retentativas do cliente devolvem o lançamento original sem gravar de novo
+- Paginação por cursor (limit/after + header X-Next-Cursor) e exportação NDJSON (format=ndjson)
 - Transações atômicas (SQLite) para evitar inconsistências
 
 Como rodar:
-1) pip install fastapi uvicorn sqlalchemy pydantic
+1) pip install fastapi uvicorn sqlalchemy pydantic   (opcional: orjson, serialização mais rápida das listas)
 2) uvicorn inventory_service_fastapi:app --reload
 
+Banco: INVENTORY_DATABASE_URL (padrão sqlite:///./inventory.db).
+Perfil SQLite: INVENTORY_SQLITE_PROFILE=default|wal (padrão wal: journal WAL,
+synchronous=NORMAL, mmap, cache maior e busy_timeout; pool dimensionado para o
+threadpool). Ajustes pontuais: INVENTORY_SQLITE_PRAGMAS="cache_size=-20000,mmap_size=0"
+Checkpoints de saldo: INVENTORY_CHECKPOINT_INTERVAL (segundos, padrão 3600; 0 desliga o job)
+e INVENTORY_CHECKPOINT_KEEP_DAYS (padrão 30; mais antigos ficam só o último de cada mês).
+Log de consultas lentas: INVENTORY_SLOW_QUERY_MS (desligado se 0/ausente; logger inventory_service.slow_query).
+Arquivamento automático: INVENTORY_ARCHIVE_RETENTION_DAYS (dias mantidos em stock_movements;
+padrão 0 = só sob demanda). Roda junto do job de checkpoints.
+Idempotência: header Idempotency-Key em POST /products/{id}/movements; INVENTORY_IDEMPOTENCY_TTL_HOURS
+(padrão 24) é a validade da chave; chaves vencidas são apagadas junto do job de checkpoints.
+Alertas: INVENTORY_ALERT_POLL_SECONDS (padrão 2): atraso máximo para alertas gravados por outros processos.
+Cache de saldos: INVENTORY_CACHE_TTL (segundos; padrão 0 = desligado) e INVENTORY_CACHE_MAX_ENTRIES.
+Ligue só com um processo, ou aceitando que escritas de outro worker apareçam até TTL segundos depois.
+Schema: criado/atualizado no startup (lifespan); com o banco já na versão atual custa uma consulta.
+Com vários workers: python inventory_service_fastapi.py migrate uma vez e INVENTORY_AUTO_MIGRATE=0.
+O import do módulo não abre conexão nem cria o arquivo do banco (engine construído no primeiro uso).
+Modo assíncrono (AsyncSession + aiosqlite/asyncpg): ver inventory_service_async.py
+
 Exemplos rápidos:
 - Criar produto:
   curl -X POST http://localhost:8000/products -H 'Content-Type: application/json' \
@@ -21,31 +61,414 @@ Exemplos rápidos:
 - Saída de estoque:
   curl -X POST http://localhost:8000/products/1/movements -H 'Content-Type: application/json' \
        -d '{"change": 5, "kind": "OUT", "note": "Venda"}'
+- Lançamento com retentativa segura (a mesma chave devolve o lançamento original):
+  curl -X POST http://localhost:8000/products/1/movements -H 'Content-Type: application/json' \
+       -H 'Idempotency-Key: 6f1c2a4e-scan-0042' -d '{"change": 1, "kind": "OUT"}'
 - Saldo atual de todos:
   curl http://localhost:8000/stock
+- Paginação (use o valor do header X-Next-Cursor em `after`):
+  curl -i 'http://localhost:8000/products?limit=100'
+- Exportação completa em NDJSON:
+  curl 'http://localhost:8000/stock?format=ndjson'
+- Transferência entre depósitos:
+  curl -X POST http://localhost:8000/transfers -H 'Content-Type: application/json' \
+       -d '{"product_id": 1, "from_warehouse_id": 1, "to_warehouse_id": 2, "quantity": 5}'
+- Alertas de estoque mínimo (SSE; reconexão retoma pelo Last-Event-ID):
+  curl -N http://localhost:8000/alerts/stream
 
 """
 from __future__ import annotations
 
-from datetime import datetime
-from typing import List, Optional, Literal, Dict
+import asyncio
+import base64
+import binascii
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, BinaryIO, Callable, Iterator, List, NamedTuple, Optional, Literal, Dict, Tuple
 
-from fastapi import FastAPI, HTTPException, Depends, Query
-from pydantic import BaseModel, Field, constr
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, constr
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, ForeignKey, CheckConstraint, Text,
-    func, select
+    create_engine, event, inspect, Boolean, Column, Integer, LargeBinary, String, Date, DateTime, ForeignKey, CheckConstraint, Text, Index,
+    func, select, insert, update, delete, case, cast, exists, tuple_, bindparam, table, column, text
 )
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import declarative_base, relationship, Session, sessionmaker
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib fallback produces the same bytes, only slower
+    orjson = None
+
+logger = logging.getLogger("inventory_service")
+slow_query_logger = logging.getLogger("inventory_service.slow_query")
 
 # ===========================
-# DB setup
+# Metrics (Prometheus text format)
 # ===========================
-DATABASE_URL = "sqlite:///./inventory.db"
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+# Per-process registry: with several uvicorn workers each one exposes its own
+# series, the same as prometheus_client without multiprocess mode.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+SLOW_QUERY_MS = float(os.getenv("INVENTORY_SLOW_QUERY_MS", "0") or 0)
+
+METRICS: List["_Metric"] = []
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key: Tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    """Counter that can go down, or be read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set_function(self, fn: Callable[[], float], **labels: Any) -> None:
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    def _samples(self) -> List[str]:
+        lines = super()._samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        return lines + [f"{self.name}{self._labels(k)} {fn()}" for k, fn in functions]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple, List[float]] = {}  # per key: bucket counts..., +Inf count, sum
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for key, counts in items:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._labels(key, (('le', repr(float(bound))),))} {count}")
+            lines.append(f"{self.name}_bucket{self._labels(key, (('le', '+Inf'),))} {counts[-2]}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {counts[-2]}")
+        return lines
+
+
+HTTP_REQUESTS = Counter("inventory_http_requests_total", "Requisições HTTP", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("inventory_http_request_duration_seconds", "Latência por rota", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("inventory_http_requests_in_flight", "Requisições em andamento")
+HTTP_RESPONSE_SIZE = Histogram(
+    "inventory_http_response_size_bytes", "Tamanho do corpo da resposta", ("method", "route"), SIZE_BUCKETS
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "inventory_db_queries_per_request", "Statements SQL por requisição", ("route",), COUNT_BUCKETS
+)
+DB_TIME_PER_REQUEST = Histogram("inventory_db_seconds_per_request", "Tempo em SQL por requisição", ("route",))
+DB_STATEMENT_SECONDS = Histogram("inventory_db_statement_duration_seconds", "Duração de cada statement SQL")
+DB_SLOW_QUERIES = Counter("inventory_db_slow_queries_total", "Statements acima de INVENTORY_SLOW_QUERY_MS")
+DB_POOL_CHECKOUTS = Counter("inventory_db_pool_checkouts_total", "Conexões retiradas do pool", ("engine",))
+DB_POOL_WAIT = Histogram(
+    "inventory_db_pool_wait_seconds", "Espera para obter conexão do pool", ("engine",),
+    (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0),
+)
+DB_POOL_CHECKED_OUT = Gauge("inventory_db_pool_checked_out", "Conexões em uso", ("engine",))
+
+
+class _RequestDbStats:
+    __slots__ = ("path", "queries", "seconds")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# Set by MetricsMiddleware; visible in the threadpool (contexts are copied) and in run_sync greenlets
+_request_db_stats: ContextVar[Optional[_RequestDbStats]] = ContextVar("inventory_request_db_stats", default=None)
+
+
+class _TimedPoolMixin:
+    """Records how long each checkout waited for a free connection."""
+    metrics_label = "sync"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started, engine=self.metrics_label)
+
+
+class InstrumentedQueuePool(_TimedPoolMixin, QueuePool):
+    metrics_label = "sync"
+
+
+class InstrumentedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    metrics_label = "async"
+
+
+def instrument_engine(target_engine, label: str) -> None:
+    """Statement timing, per-request query counts, slow-query log and pool counters via engine events."""
+    @event.listens_for(target_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("inventory_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(target_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["inventory_query_start"].pop()
+        DB_STATEMENT_SECONDS.observe(elapsed)
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += elapsed
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            DB_SLOW_QUERIES.inc()
+            slow_query_logger.warning(
+                "%.1f ms [%s] %s", elapsed * 1000, stats.path if stats else "-", " ".join(statement.split())[:2000]
+            )
+
+    @event.listens_for(target_engine, "handle_error")
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("inventory_query_start"):
+            conn.info["inventory_query_start"].pop()
+
+    @event.listens_for(target_engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKOUTS.inc(engine=label)
+
+    pool = target_engine.pool
+    if hasattr(pool, "checkedout"):
+        DB_POOL_CHECKED_OUT.set_function(pool.checkedout, engine=label)
+
+
+def route_label(scope: Dict[str, Any]) -> str:
+    # Path template ("/products/{product_id}/stock") keeps the label cardinality bounded
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no BaseHTTPMiddleware buffering, so streaming is unaffected)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        stats = _RequestDbStats(scope.get("path", ""))
+        token = _request_db_stats.set(stats)
+        status, size = 500, 0
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            HTTP_IN_FLIGHT.inc(-1)
+            _request_db_stats.reset(token)
+            route, method = route_label(scope), scope["method"]
+            HTTP_REQUESTS.inc(method=method, route=route, status=status)
+            HTTP_LATENCY.observe(time.perf_counter() - started, method=method, route=route)
+            HTTP_RESPONSE_SIZE.observe(size, method=method, route=route)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+            DB_TIME_PER_REQUEST.observe(stats.seconds, route=route)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+# ===========================
+# DB setup
+# ===========================
+DATABASE_URL = os.getenv("INVENTORY_DATABASE_URL", "sqlite:///./inventory.db")
+
+# Connection-level tuning per profile. "default" keeps SQLite's rollback journal;
+# "wal" lets readers of /stock proceed while create_movement commits.
+SQLITE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {
+        "pragmas": {},
+        "pool": {},
+    },
+    "wal": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",  # durable at checkpoints; safe against corruption in WAL mode
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,  # KiB (negative), i.e. 64 MiB per connection
+            "busy_timeout": 5000,
+            "temp_store": "MEMORY",
+        },
+        # At least as many connections as FastAPI's threadpool (40), so a worker
+        # never waits on the pool while others wait on a thread to release theirs
+        "pool": {"pool_size": 16, "max_overflow": 32, "pool_timeout": 10, "pool_pre_ping": False},
+    },
+}
+SQLITE_PROFILE = os.getenv("INVENTORY_SQLITE_PROFILE", "wal")
+
+
+def sqlite_pragmas(profile: str = SQLITE_PROFILE) -> Dict[str, Any]:
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"INVENTORY_SQLITE_PROFILE inválido: {profile!r} (use {', '.join(SQLITE_PROFILES)})")
+    pragmas = dict(SQLITE_PROFILES[profile]["pragmas"])
+    for item in filter(None, os.getenv("INVENTORY_SQLITE_PRAGMAS", "").split(",")):
+        key, _, value = item.partition("=")
+        pragmas[key.strip()] = value.strip()
+    return pragmas
+
+
+def install_sqlite_pragmas(target_engine, pragmas: Dict[str, Any]) -> None:
+    """Applies the pragmas to every new DBAPI connection of the engine (sync or async.sync_engine)."""
+    if not pragmas:
+        return
+
+    @event.listens_for(target_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key}={value}")
+        cursor.close()
+
+
+def build_engine(url: str = DATABASE_URL, profile: str = SQLITE_PROFILE):
+    if not url.startswith("sqlite"):
+        new_engine = create_engine(url, poolclass=InstrumentedQueuePool)
+    elif ":memory:" in url:
+        new_engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        new_engine = create_engine(
+            url, connect_args={"check_same_thread": False},
+            poolclass=InstrumentedQueuePool, **SQLITE_PROFILES[profile]["pool"],
+        )
+    if url.startswith("sqlite"):
+        install_sqlite_pragmas(new_engine, sqlite_pragmas(profile))
+    instrument_engine(new_engine, "sync")
+    return new_engine
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """The service's engine, built from the configuration on first use: importing the module
+    opens no connection and touches no database file."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = build_engine()
+    return _engine
+
+
+class LazySessionmaker(sessionmaker):
+    """sessionmaker that binds itself to get_engine() when the first session is created."""
+
+    def __call__(self, **local_kw: Any) -> Session:
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
+
+def __getattr__(name: str) -> Any:
+    # `inventory_service_fastapi.engine` keeps working for scripts, without an import-time engine
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+SessionLocal = LazySessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
 # ===========================
@@ -62,7 +485,34 @@ class Product(Base):
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    movements = relationship("StockMovement", back_populates="product", cascade="all, delete-orphan")
+    # passive_deletes: children are removed with set-based DELETEs (delete_product) or by the
+    # FK's ON DELETE CASCADE, never loaded into the session just to be deleted
+    movements = relationship(
+        "StockMovement", back_populates="product", cascade="all, delete-orphan", passive_deletes=True
+    )
+    balance = relationship(
+        "StockBalance", back_populates="product", uselist=False, cascade="all, delete-orphan", passive_deletes=True
+    )
+    rollups = relationship("MovementRollup", cascade="all, delete-orphan", passive_deletes=True)
+    checkpoints = relationship("StockCheckpoint", cascade="all, delete-orphan", passive_deletes=True)
+    alerts = relationship("StockAlert", cascade="all, delete-orphan", passive_deletes=True)
+    idempotency_keys = relationship("IdempotencyKey", cascade="all, delete-orphan", passive_deletes=True)
+    archives = relationship("MovementArchive", cascade="all, delete-orphan", passive_deletes=True)
+    warehouse_balances = relationship("WarehouseBalance", cascade="all, delete-orphan", passive_deletes=True)
+    transfers = relationship("StockTransfer", cascade="all, delete-orphan", passive_deletes=True)
+
+
+# Movements without warehouse_id (and all history from before warehouses existed) belong here
+DEFAULT_WAREHOUSE_ID = 1
+
+
+class Warehouse(Base):
+    __tablename__ = "warehouses"
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String(32), unique=True, nullable=False)
+    name = Column(String(255), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
 
 class StockMovement(Base):
@@ -70,20 +520,165 @@ class StockMovement(Base):
 
     id = Column(Integer, primary_key=True)
     product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=False, default=DEFAULT_WAREHOUSE_ID)
     # change > 0 sempre. A direção (IN/OUT) é marcada em kind
     change = Column(Integer, nullable=False)
     kind = Column(String(3), nullable=False)  # IN | OUT
     note = Column(Text, nullable=True)
+    # The two legs (OUT, IN) of a transfer between warehouses; NULL for ordinary movements
+    transfer_id = Column(Integer, ForeignKey("stock_transfers.id"), nullable=True)
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
 
     __table_args__ = (
         CheckConstraint("change > 0", name="ck_change_positive"),
         CheckConstraint("kind IN ('IN','OUT')", name="ck_kind_valid"),
+        # Keyset pagination of a product's history (created_at desc, id desc)
+        Index("ix_stock_movements_product_created", "product_id", "created_at", "id"),
+        # Archiving deletes rows up to the newest ones; without AUTOINCREMENT SQLite would hand
+        # their ids out again and a client holding an old id would see a different movement
+        {"sqlite_autoincrement": True},
     )
 
     product = relationship("Product", back_populates="movements")
 
 
+class StockBalance(Base):
+    """Saldo atual materializado; mantido por create_movement na mesma transação do lançamento."""
+    __tablename__ = "stock_balances"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    # quantity < products.min_stock; kept by record_threshold_crossings() so the low-stock list is an index read
+    below_minimum = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    product = relationship("Product", back_populates="balance")
+
+    __table_args__ = (
+        Index("ix_stock_balances_below_minimum", "below_minimum"),
+    )
+
+
+class WarehouseBalance(Base):
+    """Saldo por depósito; a soma dos depósitos de um produto é o saldo em stock_balances.
+    É aqui que a saída é validada (não se tira de um depósito o que está em outro)."""
+    __tablename__ = "warehouse_balances"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    warehouse_id = Column(Integer, ForeignKey("warehouses.id"), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class StockTransfer(Base):
+    """Transferência entre depósitos: um OUT na origem e um IN no destino, na mesma transação."""
+    __tablename__ = "stock_transfers"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    from_warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=False)
+    to_warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    note = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        CheckConstraint("quantity > 0", name="ck_transfer_quantity_positive"),
+        CheckConstraint("from_warehouse_id <> to_warehouse_id", name="ck_transfer_distinct_warehouses"),
+    )
+
+
+class MovementRollup(Base):
+    """Totais diários (UTC) de entradas/saídas por produto; mantidos na mesma transação de cada lançamento."""
+    __tablename__ = "movement_rollups"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    qty_in = Column(Integer, nullable=False, default=0)
+    qty_out = Column(Integer, nullable=False, default=0)
+    movement_count = Column(Integer, nullable=False, default=0)
+
+
+class StockCheckpoint(Base):
+    """Saldo do produto considerando todos os lançamentos com created_at <= taken_at."""
+    __tablename__ = "stock_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    taken_at = Column(DateTime, nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ux_stock_checkpoints_product_taken", "product_id", "taken_at", unique=True),
+    )
+
+
+class MovementArchive(Base):
+    """Bloco de lançamentos arquivados de um produto (JSON comprimido com zlib), todos com created_at
+    anterior a archived_before; em stock_movements eles viram um único lançamento de saldo de abertura."""
+    __tablename__ = "stock_movement_archives"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    archived_before = Column(DateTime, nullable=False)
+    first_at = Column(DateTime, nullable=False)
+    last_at = Column(DateTime, nullable=False)
+    movement_count = Column(Integer, nullable=False)
+    net_change = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_stock_movement_archives_product_before", "product_id", "archived_before"),
+    )
+
+
+class StockAlert(Base):
+    """Cruzamento do estoque mínimo (para baixo ou de volta para cima); gravado na transação da escrita."""
+    __tablename__ = "stock_alerts"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    below_minimum = Column(Boolean, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    min_stock = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class SchemaVersion(Base):
+    """Versão do schema gravada por init_db(); quando é a atual, o startup não refaz as verificações."""
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class IdempotencyKey(Base):
+    """Resposta de um POST de lançamento com Idempotency-Key; gravada na mesma transação do lançamento."""
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(255), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    # SHA-256 of the request (product + body): the same key with another payload is rejected
+    request_hash = Column(String(64), nullable=False)
+    response = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ux_idempotency_keys_key", "key", unique=True),
+        Index("ix_idempotency_keys_expires", "expires_at"),
+    )
+
+
+# Tables keyed by product_id, cleared by DELETE /products/{id}
+PRODUCT_CHILD_MODELS = (
+    StockMovement, StockTransfer, WarehouseBalance, StockBalance, MovementRollup, StockCheckpoint, StockAlert,
+    MovementArchive, IdempotencyKey,
+)
+
+
 # ===========================
 # Schemas
 # ===========================
@@ -113,22 +708,103 @@ class ProductOut(BaseModel):
     class Config:
         from_attributes = True
 
+class WarehouseCreate(BaseModel):
+    code: constr(strip_whitespace=True, min_length=1, max_length=32)
+    name: constr(strip_whitespace=True, min_length=1, max_length=255)
+
+class WarehouseOut(BaseModel):
+    id: int
+    code: str
+    name: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class WarehouseStockOut(BaseModel):
+    warehouse_id: int
+    code: str
+    quantity: int
+
 class MovementCreate(BaseModel):
     change: int = Field(..., gt=0)
     kind: Literal["IN", "OUT"]
     note: Optional[str] = None
+    warehouse_id: Optional[int] = None  # padrão: DEFAULT_WAREHOUSE_ID
 
 class MovementOut(BaseModel):
     id: int
     product_id: int
+    warehouse_id: int
     change: int
     kind: Literal["IN", "OUT"]
     note: Optional[str]
+    transfer_id: Optional[int] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
+MAX_BATCH_SIZE = 5000
+
+class MovementBatchItem(MovementCreate):
+    product_id: int
+
+class MovementBatchIn(BaseModel):
+    items: List[MovementBatchItem] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    # atomic: qualquer item inválido rejeita o lote inteiro; best_effort: grava apenas os válidos
+    mode: Literal["atomic", "best_effort"] = "atomic"
+
+class MovementBatchResult(BaseModel):
+    index: int
+    ok: bool
+    movement: Optional[MovementOut] = None
+    error: Optional[str] = None
+
+class MovementBatchOut(BaseModel):
+    mode: Literal["atomic", "best_effort"]
+    accepted: int
+    rejected: int
+    results: List[MovementBatchResult]
+
+class TransferCreate(BaseModel):
+    product_id: int
+    from_warehouse_id: int
+    to_warehouse_id: int
+    quantity: int = Field(..., gt=0)
+    note: Optional[str] = None
+
+class TransferOut(BaseModel):
+    id: int
+    product_id: int
+    from_warehouse_id: int
+    to_warehouse_id: int
+    quantity: int
+    note: Optional[str]
+    created_at: datetime
+    movements: List[MovementOut]  # [OUT na origem, IN no destino]
+
+class ImportRejection(BaseModel):
+    line: int
+    sku: Optional[str] = None
+    error: str
+
+class ProductImportOut(BaseModel):
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    rejected: int = 0
+    errors: List[ImportRejection] = []  # first MAX_IMPORT_ERRORS rejections only
+
+class StockAlertOut(BaseModel):
+    id: int
+    product_id: int
+    sku: str
+    below_minimum: bool
+    current_stock: int
+    min_stock: int
+    created_at: datetime
+
 class StockSnapshot(BaseModel):
     product_id: int
     sku: str
@@ -138,10 +814,59 @@ class StockSnapshot(BaseModel):
     current_stock: int
     below_minimum: bool
 
+class BalanceDrift(BaseModel):
+    product_id: int
+    sku: str
+    warehouse_id: Optional[int] = None  # None: saldo total do produto (stock_balances)
+    stored: Optional[int]
+    ledger: int
+
+class RebuildBalancesOut(BaseModel):
+    checked: int
+    fixed: int
+    dry_run: bool
+    drift: List[BalanceDrift]
+
+class RollupBucket(BaseModel):
+    bucket_start: date
+    qty_in: int
+    qty_out: int
+    net: int
+    movement_count: int
+
+class RebuildRollupsOut(BaseModel):
+    rows: int
+
+class CheckpointJobOut(BaseModel):
+    taken_at: datetime
+    created: int
+    compacted: int
+
+class ArchiveJobOut(BaseModel):
+    archived_before: datetime
+    products: int
+    movements: int
+    blocks: int
+
 # ===========================
 # FastAPI app
 # ===========================
-app = FastAPI(title="Inventory Service", version="1.0.0")
+CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("INVENTORY_CHECKPOINT_INTERVAL", "3600"))
+# 0: the schema is created/upgraded by a separate step (python inventory_service_fastapi.py migrate)
+AUTO_MIGRATE = os.getenv("INVENTORY_AUTO_MIGRATE", "1") != "0"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(init_db, migrate=AUTO_MIGRATE)
+    task = asyncio.create_task(checkpoint_loop()) if CHECKPOINT_INTERVAL_SECONDS > 0 else None
+    yield
+    if task is not None:
+        task.cancel()
+
+
+app = FastAPI(title="Inventory Service", version="1.0.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 
 def get_db():
@@ -152,159 +877,1999 @@ def get_db():
         db.close()
 
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+def balance_below_minimum_expr():
+    """stock_balances.quantity < the product's min_stock, correlated for UPDATEs of stock_balances."""
+    balances = StockBalance.__table__
+    min_stock = select(Product.min_stock).where(Product.id == balances.c.product_id).scalar_subquery()
+    return balances.c.quantity < min_stock
 
-# ===========================
-# Helpers
-# ===========================
 
-def compute_stock_for_product(db: Session, product_id: int) -> int:
-    # Sum IN as +change and OUT as -change
-    stmt_in = select(func.coalesce(func.sum(StockMovement.change), 0)).where(
-        StockMovement.product_id == product_id, StockMovement.kind == "IN"
-    )
-    stmt_out = select(func.coalesce(func.sum(StockMovement.change), 0)).where(
-        StockMovement.product_id == product_id, StockMovement.kind == "OUT"
-    )
-    total_in = db.execute(stmt_in).scalar_one()
-    total_out = db.execute(stmt_out).scalar_one()
-    return int(total_in) - int(total_out)
+def rebuild_movements_with_autoincrement(conn) -> None:
+    """SQLite tables created before sqlite_autoincrement reuse the ids of deleted (archived)
+    movements. Rebuilds stock_movements with AUTOINCREMENT and starts its sequence after every
+    id handed out so far, archived ones included; migrate_schema() recreates the indexes that
+    are dropped together with the old table."""
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'stock_movements'")).scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    last_id = conn.execute(select(func.max(StockMovement.id))).scalar() or 0
+    for payload in conn.execute(select(MovementArchive.payload)).scalars():
+        last_id = max(last_id, *(movement["id"] for movement in unpack_movements(payload)))
 
+    columns = ", ".join(c.name for c in StockMovement.__table__.columns)
+    conn.execute(text("ALTER TABLE stock_movements RENAME TO stock_movements_old"))
+    conn.execute(CreateTable(StockMovement.__table__))
+    conn.execute(text(f"INSERT INTO stock_movements ({columns}) SELECT {columns} FROM stock_movements_old"))
+    conn.execute(text("DROP TABLE stock_movements_old"))
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'stock_movements'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('stock_movements', :seq)"), {"seq": last_id})
 
-def product_to_snapshot(db: Session, p: Product) -> StockSnapshot:
-    current = compute_stock_for_product(db, p.id)
-    return StockSnapshot(
-        product_id=p.id,
-        sku=p.sku,
-        name=p.name,
-        unit=p.unit,
-        min_stock=p.min_stock,
-        current_stock=current,
-        below_minimum=current < p.min_stock,
-    )
 
-# ===========================
-# Product Endpoints
-# ===========================
-@app.post("/products", response_model=ProductOut, status_code=201)
-def create_product(payload: ProductCreate, db: Session = Depends(get_db)):
-    # SKU must be unique
-    existing = db.execute(select(Product).where(Product.sku == payload.sku)).scalar_one_or_none()
-    if existing:
-        raise HTTPException(status_code=409, detail="SKU já existe")
+def upgrade_schema(bind) -> None:
+    """Brings databases created by older versions up to date (create_all only adds missing tables)."""
+    with bind.begin() as conn:
+        if not conn.execute(select(Warehouse.id).where(Warehouse.id == DEFAULT_WAREHOUSE_ID)).first():
+            conn.execute(insert(Warehouse).values(id=DEFAULT_WAREHOUSE_ID, code="MAIN", name="Depósito principal"))
 
-    p = Product(sku=payload.sku, name=payload.name, unit=payload.unit, min_stock=payload.min_stock)
-    db.add(p)
-    db.commit()
-    db.refresh(p)
-    return p
+        balance_columns = {c["name"] for c in inspect(conn).get_columns("stock_balances")}
+        if "below_minimum" not in balance_columns:
+            conn.execute(text("ALTER TABLE stock_balances ADD COLUMN below_minimum BOOLEAN NOT NULL DEFAULT FALSE"))
+            conn.execute(update(StockBalance.__table__).values(below_minimum=balance_below_minimum_expr()))
 
+        # Products from before stock_balances existed have no balance row; derive it (and the flag
+        # read by only_below_min) from the ledger, before the warehouse step copies the balances
+        ledger = (
+            select(ledger_balance_expr())
+            .where(StockMovement.product_id == Product.id)
+            .correlate(Product)
+            .scalar_subquery()
+        )
+        conn.execute(insert(StockBalance).from_select(
+            ["product_id", "quantity", "below_minimum", "updated_at"],
+            select(
+                Product.id, ledger, ledger < Product.min_stock,
+                bindparam("now", datetime.utcnow(), type_=DateTime),
+            ).where(~exists().where(StockBalance.product_id == Product.id)),
+        ))
 
-@app.get("/products", response_model=List[ProductOut])
-def list_products(q: Optional[str] = Query(None, description="Busca por nome ou SKU"), db: Session = Depends(get_db)):
-    stmt = select(Product)
-    if q:
-        pattern = f"%{q}%"
-        stmt = stmt.where((Product.name.ilike(pattern)) | (Product.sku.ilike(pattern)))
-    stmt = stmt.order_by(Product.id.desc())
-    rows = db.execute(stmt).scalars().all()
-    return rows
+        movement_columns = {c["name"] for c in inspect(conn).get_columns("stock_movements")}
+        if "warehouse_id" not in movement_columns:
+            conn.execute(text(
+                f"ALTER TABLE stock_movements ADD COLUMN warehouse_id INTEGER NOT NULL DEFAULT {DEFAULT_WAREHOUSE_ID}"
+            ))
+            conn.execute(text("ALTER TABLE stock_movements ADD COLUMN transfer_id INTEGER"))
+            # All existing stock was in the single (now default) warehouse
+            conn.execute(insert(WarehouseBalance).from_select(
+                ["product_id", "warehouse_id", "quantity", "updated_at"],
+                select(
+                    StockBalance.product_id, bindparam("w", DEFAULT_WAREHOUSE_ID, type_=Integer),
+                    StockBalance.quantity, StockBalance.updated_at,
+                ),
+            ))
 
+        if conn.dialect.name == "sqlite":
+            rebuild_movements_with_autoincrement(conn)
 
-@app.get("/products/{product_id}", response_model=ProductOut)
-def get_product(product_id: int, db: Session = Depends(get_db)):
-    p = db.get(Product, product_id)
-    if not p:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
-    return p
+        # Ledgers recorded before movement_rollups existed: products with movements but no rollup
+        # rows get theirs from one grouped pass (same totals as POST /admin/rebuild-rollups)
+        conn.execute(insert(MovementRollup).from_select(
+            ["product_id", "day", "qty_in", "qty_out", "movement_count"],
+            ledger_rollup_totals(conn.dialect.name).where(
+                ~exists().where(MovementRollup.product_id == StockMovement.product_id)
+            ),
+        ))
 
 
-@app.patch("/products/{product_id}", response_model=ProductOut)
-def update_product(product_id: int, payload: ProductUpdate, db: Session = Depends(get_db)):
-    p = db.get(Product, product_id)
-    if not p:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
-    if payload.name is not None:
-        p.name = payload.name
-    if payload.unit is not None:
-        p.unit = payload.unit
-    if payload.min_stock is not None:
-        p.min_stock = payload.min_stock
-    db.commit()
-    db.refresh(p)
-    return p
+# Bump whenever a model, index or upgrade_schema() step changes
+SCHEMA_VERSION = 23
 
 
-@app.delete("/products/{product_id}", status_code=204)
-def delete_product(product_id: int, db: Session = Depends(get_db)):
+def stored_schema_version(bind) -> Optional[int]:
+    try:
+        with bind.connect() as conn:
+            return conn.execute(select(func.max(SchemaVersion.version))).scalar()
+    except OperationalError:
+        return None  # no schema_version table yet
+
+
+def migrate_schema(bind) -> None:
+    """Creates missing tables and indexes, runs upgrade_schema() and records SCHEMA_VERSION."""
+    Base.metadata.create_all(bind=bind)
+    upgrade_schema(bind)
+    # create_all skips existing tables together with their indexes; add new ones
+    for table_ in Base.metadata.sorted_tables:
+        for index in table_.indexes:
+            index.create(bind=bind, checkfirst=True)
+    ensure_search_index(bind)
+    with bind.begin() as conn:
+        conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION))
+
+
+def init_db(bind=None, migrate: bool = True) -> None:
+    """Startup step (lifespan or `migrate` command). With the schema already at SCHEMA_VERSION
+    it costs one query; otherwise, when `migrate` is set, it brings the schema up to date."""
+    global SEARCH_FTS_ENABLED
+    bind = get_engine() if bind is None else bind
+    if migrate and stored_schema_version(bind) != SCHEMA_VERSION:
+        try:
+            migrate_schema(bind)
+        except (OperationalError, IntegrityError):
+            # Another worker migrating the same file at the same time: check again on its result
+            if stored_schema_version(bind) != SCHEMA_VERSION:
+                raise
+    SEARCH_FTS_ENABLED = search_index_exists(bind)
+
+# ===========================
+# Search index (SQLite FTS5)
+# ===========================
+# External-content FTS5 table over products(sku, name) with the trigram tokenizer,
+# so `q` substring searches use the index instead of scanning with LIKE '%q%'.
+# Kept in sync by triggers, which also cover writes made outside the ORM.
+SEARCH_MIN_CHARS = 3  # trigram queries need at least one full trigram
+PRODUCTS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        sku, name, content='products', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, sku, name) VALUES (new.id, new.sku, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, sku, name) VALUES ('delete', old.id, old.sku, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF sku, name ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, sku, name) VALUES ('delete', old.id, old.sku, old.name);
+        INSERT INTO products_fts(rowid, sku, name) VALUES (new.id, new.sku, new.name);
+    END""",
+]
+products_fts = table("products_fts", column("rowid"), column("products_fts"))
+
+
+def ensure_search_index(bind) -> bool:
+    """Creates the FTS index and its triggers if missing. Returns False when FTS5/trigram is unavailable."""
+    if bind.dialect.name != "sqlite":
+        return False
+    try:
+        with bind.begin() as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+            ).first()
+            for ddl in PRODUCTS_FTS_DDL:
+                conn.execute(text(ddl))
+            if not exists:
+                # Index the products that existed before the search table
+                conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+    except OperationalError:
+        # SQLite built without FTS5 or older than 3.34 (no trigram tokenizer): fall back to LIKE
+        return False
+    return True
+
+
+def search_index_exists(bind) -> bool:
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.connect() as conn:
+        return conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+        ).first() is not None
+
+
+# Set by init_db(); until then `q` searches use LIKE
+SEARCH_FTS_ENABLED = False
+
+
+def product_search_filter(q: str):
+    """WHERE clause for the `q` search: FTS5 trigram match when possible, LIKE scan otherwise."""
+    if SEARCH_FTS_ENABLED and len(q) >= SEARCH_MIN_CHARS:
+        phrase = '"' + q.replace('"', '""') + '"'
+        matches = select(products_fts.c.rowid).where(products_fts.c.products_fts.match(phrase))
+        return Product.id.in_(matches)
+    pattern = f"%{q}%"
+    return (Product.name.ilike(pattern)) | (Product.sku.ilike(pattern))
+
+
+def sku_prefix_filter(prefix: str):
+    # Range on the unique sku index (case-sensitive); LIKE 'x%' would not use it in SQLite
+    return (Product.sku >= prefix) & (Product.sku < prefix + "\U0010ffff")
+
+# ===========================
+# Low-stock alerts
+# ===========================
+# Crossings of min_stock can only happen on writes, so they are detected there:
+# record_threshold_crossings() re-evaluates the below_minimum flag of the touched
+# products and appends every flip to stock_alerts in the same transaction (an
+# outbox, so alerts survive restarts and are shared by all worker processes).
+# After the commit, SSE streams of this process are woken up; streams in other
+# processes pick the rows up within ALERT_POLL_SECONDS.
+ALERT_POLL_SECONDS = float(os.getenv("INVENTORY_ALERT_POLL_SECONDS", "2"))
+ALERT_KEEPALIVE_SECONDS = 15.0
+ALERT_BATCH_SIZE = 500
+
+
+def record_threshold_crossings(db: Session, product_ids) -> int:
+    """Updates below_minimum for the given products and records each change as an alert.
+    Call it after the balance/min_stock write, before commit. Returns the number of crossings."""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    balances = StockBalance.__table__
+    flag = balance_below_minimum_expr()
+    crossed = db.execute(
+        update(balances)
+        .where(balances.c.product_id.in_(product_ids), balances.c.below_minimum != flag)
+        .values(below_minimum=flag)
+        .returning(balances.c.product_id, balances.c.quantity, balances.c.below_minimum)
+    ).all()
+    if not crossed:
+        return 0
+    minimums = dict(db.execute(
+        select(Product.id, Product.min_stock).where(Product.id.in_([pid for pid, _, _ in crossed]))
+    ).all())
+    now = datetime.utcnow()
+    db.execute(insert(StockAlert), [
+        {"product_id": pid, "below_minimum": below, "quantity": qty, "min_stock": minimums[pid], "created_at": now}
+        for pid, qty, below in crossed
+    ])
+    db.info["stock_alerts_pending"] = True
+    return len(crossed)
+
+
+class AlertBroker:
+    """Wakes this process's SSE streams after a commit that recorded alerts (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: Dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+
+    def subscribe(self) -> asyncio.Event:
+        waiter = asyncio.Event()
+        with self._lock:
+            self._waiters[waiter] = asyncio.get_running_loop()
+        return waiter
+
+    def unsubscribe(self, waiter: asyncio.Event) -> None:
+        with self._lock:
+            self._waiters.pop(waiter, None)
+
+    def notify(self) -> None:
+        with self._lock:
+            waiters = list(self._waiters.items())
+        for waiter, loop in waiters:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:  # loop already closed
+                self.unsubscribe(waiter)
+
+
+alert_broker = AlertBroker()
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_alert_subscribers(session: Session) -> None:
+    if session.info.pop("stock_alerts_pending", False):
+        alert_broker.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_alerts(session: Session) -> None:
+    session.info.pop("stock_alerts_pending", None)
+
+
+def fetch_alerts(after_id: int, limit: int = ALERT_BATCH_SIZE) -> List[StockAlertOut]:
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(
+                StockAlert.id, StockAlert.product_id, Product.sku, StockAlert.below_minimum,
+                StockAlert.quantity.label("current_stock"), StockAlert.min_stock, StockAlert.created_at,
+            )
+            .join(Product, Product.id == StockAlert.product_id)
+            .where(StockAlert.id > after_id)
+            .order_by(StockAlert.id)
+            .limit(limit)
+        ).mappings().all()
+    return [StockAlertOut(**row) for row in rows]
+
+
+def latest_alert_id() -> int:
+    with SessionLocal() as db:
+        return db.execute(select(func.coalesce(func.max(StockAlert.id), 0))).scalar_one()
+
+# ===========================
+# Helpers
+# ===========================
+
+def ledger_balance_expr():
+    # IN counts as +change and OUT as -change
+    return func.coalesce(
+        func.sum(case((StockMovement.kind == "IN", StockMovement.change), else_=-StockMovement.change)), 0
+    )
+
+
+def compute_ledger_stock(db: Session, product_id: int) -> int:
+    # Full scan of the product's history; used only to seed/reconcile the balance
+    stmt = select(ledger_balance_expr()).where(StockMovement.product_id == product_id)
+    return int(db.execute(stmt).scalar_one())
+
+
+def compute_stock_for_product(db: Session, product_id: int) -> int:
+    stmt = select(StockBalance.quantity).where(StockBalance.product_id == product_id)
+    stored = db.execute(stmt).scalar_one_or_none()
+    if stored is None:
+        # Products from before stock_balances existed: fall back to the ledger
+        return compute_ledger_stock(db, product_id)
+    return int(stored)
+
+
+def apply_balance_change(db: Session, product_id: int, delta: int) -> bool:
+    """Adds delta to the stored balance with one conditional UPDATE (check-and-decrement in a
+    single statement). Returns False if there is no balance row or the result would be negative."""
+    stmt = update(StockBalance).where(StockBalance.product_id == product_id)
+    if delta < 0:
+        stmt = stmt.where(StockBalance.quantity >= -delta)
+    result = db.execute(stmt.values(quantity=StockBalance.quantity + delta, updated_at=datetime.utcnow()))
+    return result.rowcount == 1
+
+
+def seed_balance(db: Session, product_id: int) -> bool:
+    """Creates the balance row from the ledger if it is missing. Returns True if a row was created."""
+    exists = db.execute(select(StockBalance.product_id).where(StockBalance.product_id == product_id)).first()
+    if exists:
+        return False
+    db.add(StockBalance(product_id=product_id, quantity=compute_ledger_stock(db, product_id)))
+    db.flush()
+    return True
+
+
+def apply_warehouse_change(db: Session, product_id: int, warehouse_id: int, delta: int) -> bool:
+    """apply_balance_change() for one warehouse's balance, where OUTs are validated."""
+    stmt = update(WarehouseBalance).where(
+        WarehouseBalance.product_id == product_id, WarehouseBalance.warehouse_id == warehouse_id,
+    )
+    if delta < 0:
+        stmt = stmt.where(WarehouseBalance.quantity >= -delta)
+    result = db.execute(stmt.values(quantity=WarehouseBalance.quantity + delta, updated_at=datetime.utcnow()))
+    return result.rowcount == 1
+
+
+def warehouse_ledger_expr(product_id, warehouse_id):
+    return select(ledger_balance_expr()).where(
+        StockMovement.product_id == product_id, StockMovement.warehouse_id == warehouse_id,
+    )
+
+
+def seed_warehouse_balance(db: Session, product_id: int, warehouse_id: int) -> bool:
+    """seed_balance() for a (product, warehouse) pair: 0 for a new pair, the ledger otherwise."""
+    exists = db.execute(
+        select(WarehouseBalance.product_id)
+        .where(WarehouseBalance.product_id == product_id, WarehouseBalance.warehouse_id == warehouse_id)
+    ).first()
+    if exists:
+        return False
+    quantity = int(db.execute(warehouse_ledger_expr(product_id, warehouse_id)).scalar_one())
+    db.add(WarehouseBalance(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity))
+    db.flush()
+    return True
+
+
+def change_warehouse_stock(db: Session, product_id: int, warehouse_id: int, delta: int) -> None:
+    """Applies delta to one warehouse's balance. Raises 404 for an unknown product or
+    warehouse and 409 when an OUT exceeds the stock in that warehouse."""
+    if not apply_warehouse_change(db, product_id, warehouse_id, delta):
+        p = db.get(Product, product_id)
+        if not p:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+        if db.get(Warehouse, warehouse_id) is None:
+            raise HTTPException(status_code=404, detail="Depósito não encontrado")
+        # Prevent negative stock on OUT
+        if not (seed_warehouse_balance(db, product_id, warehouse_id)
+                and apply_warehouse_change(db, product_id, warehouse_id, delta)):
+            current = db.execute(
+                select(WarehouseBalance.quantity)
+                .where(WarehouseBalance.product_id == product_id, WarehouseBalance.warehouse_id == warehouse_id)
+            ).scalar_one()
+            raise HTTPException(status_code=409, detail=f"Saída maior que o saldo atual ({current} {p.unit})")
+
+
+def move_stock(db: Session, product_id: int, warehouse_id: int, delta: int) -> None:
+    """Applies delta to the warehouse balance, then to the product total. The warehouse UPDATE
+    is the first statement, so it is the one that takes the write lock."""
+    change_warehouse_stock(db, product_id, warehouse_id, delta)
+    # The total cannot go negative when its warehouse did not; only a missing row needs seeding.
+    # An existing row that still rejects the change has drifted from the warehouse balances
+    if not apply_balance_change(db, product_id, delta):
+        if not (seed_balance(db, product_id) and apply_balance_change(db, product_id, delta)):
+            raise HTTPException(
+                status_code=409,
+                detail="Saldo total diverge dos saldos por depósito; reconcilie com POST /admin/rebuild-balances",
+            )
+
+
+def add_to_rollups(db: Session, movements: List[Tuple[int, datetime, str, int]]) -> None:
+    """Folds (product_id, created_at, kind, change) movements into the daily rollups.
+    Runs after the balance UPDATE, so the product's writers are already serialized."""
+    totals: Dict[Tuple[int, date], List[int]] = {}
+    for product_id, created_at, kind, change in movements:
+        t = totals.setdefault((product_id, created_at.date()), [0, 0, 0])
+        t[0 if kind == "IN" else 1] += change
+        t[2] += 1
+
+    existing = set(db.execute(
+        select(MovementRollup.product_id, MovementRollup.day)
+        .where(tuple_(MovementRollup.product_id, MovementRollup.day).in_(list(totals)))
+    ).tuples())
+    updates = [
+        {"r_product_id": pid, "r_day": day, "r_in": t[0], "r_out": t[1], "r_count": t[2]}
+        for (pid, day), t in totals.items() if (pid, day) in existing
+    ]
+    if updates:
+        table = MovementRollup.__table__
+        db.execute(
+            update(table)
+            .where(table.c.product_id == bindparam("r_product_id"), table.c.day == bindparam("r_day"))
+            .values(
+                qty_in=table.c.qty_in + bindparam("r_in"),
+                qty_out=table.c.qty_out + bindparam("r_out"),
+                movement_count=table.c.movement_count + bindparam("r_count"),
+            ),
+            updates,
+        )
+    inserts = [
+        {"product_id": pid, "day": day, "qty_in": t[0], "qty_out": t[1], "movement_count": t[2]}
+        for (pid, day), t in totals.items() if (pid, day) not in existing
+    ]
+    if inserts:
+        db.execute(insert(MovementRollup), inserts)
+
+
+def ledger_day_expr(dialect_name: str, column=StockMovement.created_at):
+    if dialect_name == "sqlite":
+        return func.date(column, type_=Date)
+    return cast(column, Date)
+
+
+def ledger_rollup_totals(dialect_name: str):
+    """(product_id, day, qty_in, qty_out, movement_count) of the ledger still in stock_movements,
+    i.e. from each product's archive cutoff on; transfer legs are not counted as IN/OUT."""
+    day = ledger_day_expr(dialect_name)
+    movement_cutoff = archive_cutoff_expr(StockMovement.product_id)
+    return (
+        select(
+            StockMovement.product_id,
+            day,
+            func.sum(case((StockMovement.kind == "IN", StockMovement.change), else_=0)),
+            func.sum(case((StockMovement.kind == "OUT", StockMovement.change), else_=0)),
+            func.count(),
+        )
+        .where(
+            StockMovement.created_at >= func.coalesce(movement_cutoff, datetime.min),
+            StockMovement.transfer_id.is_(None),
+        )
+        .group_by(StockMovement.product_id, day)
+    )
+
+
+def rollup_bucket_expr(bucket: str, dialect_name: str):
+    # Weeks start on Monday
+    if bucket == "day":
+        return MovementRollup.day
+    if dialect_name == "sqlite":
+        modifiers = ("weekday 0", "-6 days") if bucket == "week" else ("start of month",)
+        return func.date(MovementRollup.day, *modifiers, type_=Date)
+    return cast(func.date_trunc(bucket, MovementRollup.day), Date)
+
+
+def query_rollups(
+    db: Session, bucket: str, date_from: Optional[date], date_to: Optional[date], product_id: Optional[int] = None,
+) -> List[RollupBucket]:
+    start = rollup_bucket_expr(bucket, db.get_bind().dialect.name).label("bucket_start")
+    stmt = select(
+        start,
+        func.sum(MovementRollup.qty_in),
+        func.sum(MovementRollup.qty_out),
+        func.sum(MovementRollup.movement_count),
+    )
+    if product_id is not None:
+        stmt = stmt.where(MovementRollup.product_id == product_id)
+    if date_from is not None:
+        stmt = stmt.where(MovementRollup.day >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(MovementRollup.day <= date_to)
+    stmt = stmt.group_by(start).order_by(start)
+    return [
+        RollupBucket(bucket_start=b, qty_in=i, qty_out=o, net=i - o, movement_count=n)
+        for b, i, o, n in db.execute(stmt)
+    ]
+
+
+def product_to_snapshot(db: Session, p: Product) -> StockSnapshot:
+    current = compute_stock_for_product(db, p.id)
+    return StockSnapshot(
+        product_id=p.id,
+        sku=p.sku,
+        name=p.name,
+        unit=p.unit,
+        min_stock=p.min_stock,
+        current_stock=current,
+        below_minimum=current < p.min_stock,
+    )
+
+
+def current_stock_expr():
+    # Stored balance; products without a balance row fall back to a correlated
+    # ledger sum (SQLite's coalesce short-circuits, so it only runs for those)
+    ledger = (
+        select(ledger_balance_expr())
+        .where(StockMovement.product_id == Product.id)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    return func.coalesce(StockBalance.quantity, ledger)
+
+
+def warehouse_stock_expr(warehouse_id: int):
+    """current_stock_expr() for one warehouse: the stored (product, warehouse) row, or the
+    ledger of that warehouse when the pair has none yet. Correlated to Product."""
+    stored = (
+        select(WarehouseBalance.quantity)
+        .where(WarehouseBalance.product_id == Product.id, WarehouseBalance.warehouse_id == warehouse_id)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    return func.coalesce(stored, warehouse_ledger_expr(Product.id, warehouse_id).correlate(Product).scalar_subquery())
+
+
+def stock_as_of_expr(as_of: datetime):
+    """Balance at `as_of`: nearest checkpoint at or before it, plus the ledger replayed since
+    (uses the (product_id, created_at) index). Correlated to Product."""
+    taken = (
+        select(func.max(StockCheckpoint.taken_at))
+        .where(StockCheckpoint.product_id == Product.id, StockCheckpoint.taken_at <= as_of)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    base = (
+        select(StockCheckpoint.quantity)
+        .where(StockCheckpoint.product_id == Product.id, StockCheckpoint.taken_at == taken)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    replay = (
+        select(ledger_balance_expr())
+        .where(
+            StockMovement.product_id == Product.id,
+            StockMovement.created_at > func.coalesce(taken, datetime.min),
+            StockMovement.created_at <= as_of,
+        )
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    return func.coalesce(base, 0) + replay
+
+
+def archive_cutoff_after(db: Session, as_of: datetime, product_id: Optional[int] = None) -> Optional[datetime]:
+    """Earliest archive cutoff later than `as_of` (of one product, or of any product), or None.
+    Before a cutoff the movements are gone from stock_movements, so stock_as_of_expr() no longer applies."""
+    stmt = select(func.min(MovementArchive.archived_before)).where(MovementArchive.archived_before > as_of)
+    if product_id is not None:
+        stmt = stmt.where(MovementArchive.product_id == product_id)
+    return db.execute(stmt).scalar()
+
+
+def archived_stock_as_of(db: Session, product_id: int, as_of: datetime) -> Optional[int]:
+    """Total at `as_of` replayed from the archive blocks, or None when the live ledger still covers it.
+    The blocks of the earliest cutoff after as_of hold everything up to it: the previous archive's
+    opening balance plus the movements archived since."""
+    cutoff = archive_cutoff_after(db, as_of, product_id)
+    if cutoff is None:
+        return None
+    payloads = db.execute(
+        select(MovementArchive.payload).where(
+            MovementArchive.product_id == product_id,
+            MovementArchive.archived_before == cutoff,
+            MovementArchive.first_at <= as_of,
+        )
+    ).scalars()
+    total = 0
+    for payload in payloads:
+        for m in unpack_movements(payload):
+            if datetime.fromisoformat(m["created_at"]) <= as_of:
+                total += m["change"] if m["kind"] == "IN" else -m["change"]
+    return total
+
+
+def resolve_stock_expr(db: Session, as_of: Optional[datetime], warehouse_id: Optional[int]):
+    """Balance expression for the stock endpoints: live total, total at `as_of` or one warehouse.
+    Checkpoints are per product total, so as_of cannot be combined with a warehouse."""
+    if warehouse_id is None:
+        return stock_as_of_expr(as_of) if as_of is not None else current_stock_expr()
+    if as_of is not None:
+        raise HTTPException(status_code=400, detail="as_of não pode ser combinado com warehouse_id")
+    if db.get(Warehouse, warehouse_id) is None:
+        raise HTTPException(status_code=404, detail="Depósito não encontrado")
+    return warehouse_stock_expr(warehouse_id)
+
+
+def to_utc_naive(value: datetime) -> datetime:
+    # created_at is stored as naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def stock_sort_keys(current=None):
+    # Below minimum first, then by name; id breaks ties so the order is total (keyset-safe)
+    current = current_stock_expr() if current is None else current
+    rank = case((current < Product.min_stock, 0), else_=1)
+    return rank, func.lower(Product.name), Product.id
+
+
+def stock_snapshot_query(current=None):
+    """Single SELECT producing StockSnapshot rows (plus sort keys), ordered below-minimum first, then by name.
+    `current` defaults to the live balance; pass stock_as_of_expr() for a point in time."""
+    current = (current_stock_expr() if current is None else current).label("current_stock")
+    below = (current < Product.min_stock).label("below_minimum")
+    rank, sort_name, _ = stock_sort_keys(current)
+    return (
+        select(
+            Product.id.label("product_id"), Product.sku, Product.name, Product.unit, Product.min_stock,
+            current, below, rank.label("sort_rank"), sort_name.label("sort_name"),
+        )
+        .outerjoin(StockBalance, StockBalance.product_id == Product.id)
+        .order_by(*stock_sort_keys(current))
+    )
+
+# ===========================
+# Pagination & streaming
+# ===========================
+STREAM_BATCH_SIZE = 500
+MAX_PAGE_SIZE = 1000
+
+LimitParam = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Tamanho da página (sem limite se omitido)")
+AfterParam = Query(None, description="Cursor da página anterior (header X-Next-Cursor)")
+FormatParam = Query("json", alias="format", description="json ou ndjson (streaming)")
+SkuPrefixParam = Query(None, min_length=1, description="SKUs que começam com o valor (sensível a maiúsculas)")
+AsOfParam = Query(None, description="Saldo em um instante passado (ISO 8601; sem fuso = UTC)")
+WarehouseParam = Query(None, description="Saldo de um depósito (padrão: soma de todos)")
+
+
+def encode_cursor(values: List[Any]) -> str:
+    raw = json.dumps(values, default=lambda v: v.isoformat(), separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+
+def fetch_page(
+    db: Session, stmt, limit: Optional[int], response: Response,
+    cursor_of: Callable[[Any], List[Any]], scalars: bool = False, tuples: bool = False,
+) -> list:
+    """Runs a keyset-ordered statement, fetching one extra row to decide whether to emit X-Next-Cursor."""
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    result = db.execute(stmt)
+    if tuples:
+        rows = result.all()
+    else:
+        rows = result.scalars().all() if scalars else result.mappings().all()
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(cursor_of(rows[-1]))
+    return rows
+
+
+def ndjson_response(stmt, serialize: Callable[[Any], BaseModel], scalars: bool = False) -> StreamingResponse:
+    """Streams one JSON object per line from a server-side cursor, in constant memory."""
+    def lines():
+        # Own session: the request-scoped one may be closed before the body is fully sent
+        with SessionLocal() as db:
+            result = db.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+            for row in (result.scalars() if scalars else result.mappings()):
+                yield serialize(row).model_dump_json() + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# ===========================
+# Fast JSON path (rows straight from SQL tuples)
+# ===========================
+# For list endpoints the per-row cost of response_model validation plus the stdlib
+# encoder exceeds the SQL itself. These helpers zip plain result tuples with the
+# schema's field names and encode them in one call. The statement must select the
+# schema's fields first and in declaration order (extra trailing columns, such as
+# sort keys, are dropped by zip); the values must already have the schema's types.
+STOCK_SNAPSHOT_FIELDS = tuple(StockSnapshot.model_fields)
+MOVEMENT_FIELDS = tuple(MovementOut.model_fields)
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} não é serializável em JSON")
+
+
+def dumps_json(value: Any) -> bytes:
+    """Compact UTF-8 JSON, byte-compatible with pydantic's output for the types used here."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_json_default, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def rows_to_json(fields: Tuple[str, ...], rows) -> bytes:
+    return dumps_json([dict(zip(fields, row)) for row in rows])
+
+
+def json_page_response(
+    db: Session, stmt, fields: Tuple[str, ...], limit: Optional[int], cursor_of: Callable[[Any], List[Any]],
+) -> Tuple[bytes, Dict[str, str]]:
+    """fetch_page() over plain tuples; returns the encoded body and the X-Next-Cursor header, if any."""
+    page = Response()
+    rows = fetch_page(db, stmt, limit, page, cursor_of, tuples=True)
+    headers = {"X-Next-Cursor": page.headers["x-next-cursor"]} if "x-next-cursor" in page.headers else {}
+    return rows_to_json(fields, rows), headers
+
+
+def ndjson_rows_response(stmt, fields: Tuple[str, ...]) -> StreamingResponse:
+    """ndjson_response() for plain tuples: one encode call per batch instead of one model per row."""
+    def lines():
+        with SessionLocal() as db:
+            result = db.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+            for rows in result.partitions():
+                yield b"".join(dumps_json(dict(zip(fields, row))) + b"\n" for row in rows)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# ===========================
+# Response cache
+# ===========================
+# Opt-in: writes only invalidate the local process, so with several workers a cached
+# balance can lag another worker's write by up to the TTL
+CACHE_TTL_SECONDS = float(os.getenv("INVENTORY_CACHE_TTL", "0"))
+CACHE_MAX_ENTRIES = int(os.getenv("INVENTORY_CACHE_MAX_ENTRIES", "10000"))
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    headers: Dict[str, str]
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL.
+
+    Every invalidation bumps `epoch`; a value loaded under an older epoch is not
+    stored, so a read racing with a write cannot put stale data back in the cache.
+    The TTL bounds staleness for writes made by other worker processes.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.epoch = 0
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any, epoch: int) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            self.epoch += 1
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+
+stock_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+
+def invalidate_stock_cache(*product_ids: int) -> None:
+    """Drops the snapshots of the given products and every /stock list (a write can change
+    any list's membership or order). Without ids, drops everything."""
+    if not product_ids:
+        stock_cache.invalidate(lambda key: True)
+        return
+    ids = set(product_ids)
+    stock_cache.invalidate(lambda key: key[0] == "stock" or (key[0] == "product" and key[1] in ids))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {c.strip().removeprefix("W/") for c in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def cached_json_response(
+    request: Request, key: Tuple, load: Callable[[], Tuple[bytes, Dict[str, str]]],
+) -> Response:
+    """Serves `key` from the cache (loading it on a miss) with a content-derived ETag; answers
+    If-None-Match with 304. A fresh cache hit does not touch the database."""
+    entry = stock_cache.get(key)
+    if entry is None:
+        epoch = stock_cache.epoch
+        body, headers = load()
+        entry = CachedResponse(body, '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"', headers)
+        stock_cache.set(key, entry, epoch)
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return Response(entry.body, media_type="application/json", headers={"ETag": entry.etag, **entry.headers})
+
+# ===========================
+# Product Endpoints
+# ===========================
+@app.post("/products", response_model=ProductOut, status_code=201)
+def create_product(payload: ProductCreate, db: Session = Depends(get_db)):
+    # SKU must be unique
+    existing = db.execute(select(Product).where(Product.sku == payload.sku)).scalar_one_or_none()
+    if existing:
+        raise HTTPException(status_code=409, detail="SKU já existe")
+
+    p = Product(
+        sku=payload.sku, name=payload.name, unit=payload.unit, min_stock=payload.min_stock,
+        balance=StockBalance(quantity=0),
+    )
+    db.add(p)
+    db.flush()
+    record_threshold_crossings(db, [p.id])
+    db.commit()
+    db.refresh(p)
+    invalidate_stock_cache(p.id)
+    return p
+
+
+@app.get("/products", response_model=List[ProductOut])
+def list_products(
+    response: Response,
+    q: Optional[str] = Query(None, description="Busca por nome ou SKU"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    db: Session = Depends(get_db),
+):
+    stmt = select(Product)
+    if q:
+        stmt = stmt.where(product_search_filter(q))
+    if sku_prefix:
+        stmt = stmt.where(sku_prefix_filter(sku_prefix))
+    if after:
+        (last_id,) = decode_cursor(after, 1)
+        stmt = stmt.where(Product.id < last_id)
+    stmt = stmt.order_by(Product.id.desc())
+    if fmt == "ndjson":
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return ndjson_response(stmt, ProductOut.model_validate, scalars=True)
+    return fetch_page(db, stmt, limit, response, lambda p: [p.id], scalars=True)
+
+
+@app.get("/products/{product_id}", response_model=ProductOut)
+def get_product(product_id: int, db: Session = Depends(get_db)):
+    p = db.get(Product, product_id)
+    if not p:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    return p
+
+
+@app.patch("/products/{product_id}", response_model=ProductOut)
+def update_product(product_id: int, payload: ProductUpdate, db: Session = Depends(get_db)):
     p = db.get(Product, product_id)
     if not p:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
-    db.delete(p)
+    if payload.name is not None:
+        p.name = payload.name
+    if payload.unit is not None:
+        p.unit = payload.unit
+    if payload.min_stock is not None:
+        p.min_stock = payload.min_stock
+        db.flush()
+        record_threshold_crossings(db, [product_id])
+    db.commit()
+    invalidate_stock_cache(product_id)
+    db.refresh(p)
+    return p
+
+
+@app.delete("/products/{product_id}", status_code=204)
+def delete_product(product_id: int, db: Session = Depends(get_db)):
+    # Set-based: one DELETE per child table instead of loading the history into the session.
+    # Explicit because SQLite only honours ON DELETE CASCADE with PRAGMA foreign_keys=ON.
+    for child in PRODUCT_CHILD_MODELS:
+        db.execute(delete(child).where(child.product_id == product_id))
+    if db.execute(delete(Product).where(Product.id == product_id)).rowcount == 0:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
     db.commit()
+    invalidate_stock_cache(product_id)
     return None
 
+
+# ===========================
+# Bulk import / export
+# ===========================
+IMPORT_CHUNK_SIZE = 1000  # rows per INSERT ... ON CONFLICT and per transaction
+IMPORT_SPOOL_BYTES = 8 * 1024 * 1024  # larger uploads are spooled to a temp file
+MAX_IMPORT_ERRORS = 100
+PRODUCT_CSV_COLUMNS = ("id", "sku", "name", "unit", "min_stock", "created_at", "updated_at")
+
+
+def dialect_insert(db: Session):
+    """insert() with on_conflict_* support for the session's dialect."""
+    # Imported here: loading the PostgreSQL dialect costs ~40 ms of import time on SQLite deployments
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_specific_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_specific_insert
+    return dialect_specific_insert
+
+
+def iter_import_rows(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """Yields (line number, raw row); a row that cannot be parsed is yielded as the exception."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            # Empty cells fall back to the schema defaults; extra cells (key None) are ignored
+            yield reader.line_num, {k: v for k, v in row.items() if k is not None and v not in (None, "")}
+        return
+    for line_no, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as exc:
+            yield line_no, exc
+
+
+def upsert_products(db: Session, rows: List[ProductCreate]) -> Tuple[int, int, int]:
+    """Upserts one chunk by SKU in a single statement. Returns (created, updated, unchanged).
+
+    Rows whose values already match are left alone (the DO UPDATE has a WHERE), so
+    re-importing the same file does not touch updated_at. Within a chunk the last
+    row for a SKU wins; earlier duplicates count as unchanged.
+    """
+    by_sku = {row.sku: row for row in rows}
+    existing = set(db.execute(select(Product.sku).where(Product.sku.in_(list(by_sku)))).scalars())
+    now = datetime.utcnow()
+    products = Product.__table__
+    stmt = dialect_insert(db)(products).values([
+        {"sku": r.sku, "name": r.name, "unit": r.unit, "min_stock": r.min_stock, "created_at": now, "updated_at": now}
+        for r in by_sku.values()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[products.c.sku],
+        set_={
+            "name": stmt.excluded.name, "unit": stmt.excluded.unit,
+            "min_stock": stmt.excluded.min_stock, "updated_at": stmt.excluded.updated_at,
+        },
+        where=(products.c.name != stmt.excluded.name)
+        | (products.c.unit != stmt.excluded.unit)
+        | (products.c.min_stock != stmt.excluded.min_stock),
+    ).returning(products.c.id, products.c.sku)
+    written = db.execute(stmt).all()
+
+    created_ids = [pid for pid, sku in written if sku not in existing]
+    if created_ids:
+        db.execute(
+            dialect_insert(db)(StockBalance.__table__)
+            .values([{"product_id": pid, "quantity": 0, "updated_at": now} for pid in created_ids])
+            .on_conflict_do_nothing()
+        )
+    record_threshold_crossings(db, [pid for pid, _ in written])
+    created = len(created_ids)
+    return created, len(written) - created, len(rows) - len(written)
+
+
+def import_products_file(stream: BinaryIO, fmt: str) -> ProductImportOut:
+    summary = ProductImportOut()
+    chunk: List[ProductCreate] = []
+
+    def reject(line: int, error: str, sku: Optional[str] = None) -> None:
+        summary.rejected += 1
+        if len(summary.errors) < MAX_IMPORT_ERRORS:
+            summary.errors.append(ImportRejection(line=line, sku=sku, error=error))
+
+    def flush(db: Session) -> None:
+        created, updated, unchanged = upsert_products(db, chunk)
+        db.commit()
+        summary.created += created
+        summary.updated += updated
+        summary.unchanged += unchanged
+        chunk.clear()
+
+    with SessionLocal() as db:
+        rows = iter_import_rows(stream, fmt)
+        line = 0
+        try:
+            for line, raw in rows:
+                if isinstance(raw, Exception):
+                    reject(line, "JSON inválido")
+                    continue
+                try:
+                    chunk.append(ProductCreate.model_validate(raw))
+                except ValidationError as exc:
+                    detail = "; ".join(
+                        f"{'.'.join(str(loc) for loc in err['loc']) or 'linha'}: {err['msg']}" for err in exc.errors()
+                    )
+                    reject(line, detail, raw.get("sku") if isinstance(raw, dict) else None)
+                    continue
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    flush(db)
+        except (UnicodeDecodeError, csv.Error) as exc:
+            # Chunks already committed stay; the rest of the file is not read
+            reject(line + 1, f"arquivo ilegível a partir desta linha: {exc}")
+        if chunk:
+            flush(db)
+    if summary.created or summary.updated:
+        invalidate_stock_cache()
+    return summary
+
+
+@app.post("/products:import", response_model=ProductImportOut)
+async def import_products(
+    request: Request,
+    fmt: Optional[Literal["csv", "ndjson"]] = Query(
+        None, alias="format", description="csv ou ndjson (padrão: pelo Content-Type)"
+    ),
+):
+    """Corpo bruto (não multipart): CSV com cabeçalho sku,name,unit,min_stock ou NDJSON.
+
+    Cada lote de IMPORT_CHUNK_SIZE linhas é gravado na sua própria transação.
+    """
+    if fmt is None:
+        content_type = request.headers.get("content-type", "")
+        fmt = "ndjson" if "ndjson" in content_type or "json" in content_type else "csv"
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        return await run_in_threadpool(import_products_file, spool, fmt)
+
+
+def csv_response(stmt, columns: Tuple[str, ...], filename: str) -> StreamingResponse:
+    """Streams rows as CSV from a server-side cursor, in constant memory."""
+    def lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        with SessionLocal() as db:
+            result = db.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+            for rows in result.partitions():
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    return StreamingResponse(
+        lines(), media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/products:export")
+def export_products(
+    fmt: Literal["csv", "ndjson"] = Query("csv", alias="format", description="csv ou ndjson"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
+):
+    stmt = select(*(getattr(Product, c) for c in PRODUCT_CSV_COLUMNS)).order_by(Product.id)
+    if sku_prefix:
+        stmt = stmt.where(sku_prefix_filter(sku_prefix))
+    if fmt == "ndjson":
+        return ndjson_response(stmt, ProductOut.model_validate)
+    return csv_response(stmt, PRODUCT_CSV_COLUMNS, "products.csv")
+
+# ===========================
+# Warehouse Endpoints
+# ===========================
+@app.post("/warehouses", response_model=WarehouseOut, status_code=201)
+def create_warehouse(payload: WarehouseCreate, db: Session = Depends(get_db)):
+    existing = db.execute(select(Warehouse.id).where(Warehouse.code == payload.code)).first()
+    if existing:
+        raise HTTPException(status_code=409, detail="Código de depósito já existe")
+    w = Warehouse(code=payload.code, name=payload.name)
+    db.add(w)
+    db.commit()
+    db.refresh(w)
+    return w
+
+
+@app.get("/warehouses", response_model=List[WarehouseOut])
+def list_warehouses(db: Session = Depends(get_db)):
+    return db.execute(select(Warehouse).order_by(Warehouse.id)).scalars().all()
+
+# ===========================
+# Idempotency keys
+# ===========================
+# A retried POST /products/{id}/movements with the same Idempotency-Key gets the
+# stored response of the first attempt (one indexed read, no balance update, no
+# insert). The key row is written in the movement's transaction, so a key is
+# stored if and only if its movement was. Expired rows stop matching at once and
+# are purged by the background job (or replaced when their key is reused).
+IDEMPOTENCY_TTL = timedelta(hours=float(os.getenv("INVENTORY_IDEMPOTENCY_TTL_HOURS", "24")))
+IdempotencyKeyHeader = Header(
+    None, alias="Idempotency-Key", min_length=1, max_length=255,
+    description="Chave única por operação; repetições devolvem a resposta original",
+)
+
+
+def idempotency_fingerprint(product_id: int, payload: BaseModel) -> str:
+    body = dumps_json({"product_id": product_id, **payload.model_dump()})
+    return hashlib.sha256(body).hexdigest()
+
+
+def find_idempotent_response(db: Session, key: str, request_hash: str) -> Optional[bytes]:
+    """Stored response for a live key; 422 if the key was used with a different request."""
+    row = db.execute(
+        select(IdempotencyKey.request_hash, IdempotencyKey.response)
+        .where(IdempotencyKey.key == key, IdempotencyKey.expires_at > datetime.utcnow())
+    ).first()
+    if row is None:
+        return None
+    if row.request_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outra requisição")
+    return row.response
+
+
+def claim_idempotency_key(db: Session, key: str, request_hash: str) -> Optional[bytes]:
+    """find_idempotent_response, but the transaction writes first (dropping an expired row for
+    the key), so on SQLite it already holds the write lock when it looks the key up: a concurrent
+    retry with the same key waits for our commit and replays it instead of moving stock again.
+    Elsewhere the unique key makes the later of two racing commits fail (see create_movement)."""
+    now = datetime.utcnow()
+    db.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.expires_at <= now))
+    return find_idempotent_response(db, key, request_hash)
+
+
+def store_idempotent_response(db: Session, key: str, product_id: int, request_hash: str, body: bytes) -> None:
+    now = datetime.utcnow()
+    db.add(IdempotencyKey(
+        key=key, product_id=product_id, request_hash=request_hash, response=body,
+        created_at=now, expires_at=now + IDEMPOTENCY_TTL,
+    ))
+
+
+def replay_response(body: bytes) -> Response:
+    return Response(body, status_code=201, media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+
+def purge_idempotency_keys(db: Session, now: datetime) -> int:
+    return db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= now)).rowcount
+
 # ===========================
 # Stock Endpoints
 # ===========================
 @app.post("/products/{product_id}/movements", response_model=MovementOut, status_code=201)
-def create_movement(product_id: int, payload: MovementCreate, db: Session = Depends(get_db)):
-    p = db.get(Product, product_id)
-    if not p:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
+def create_movement(
+    product_id: int,
+    payload: MovementCreate,
+    idempotency_key: Optional[str] = IdempotencyKeyHeader,
+    db: Session = Depends(get_db),
+):
+    request_hash = None
+    if idempotency_key is not None:
+        request_hash = idempotency_fingerprint(product_id, payload)
+        stored = claim_idempotency_key(db, idempotency_key, request_hash)
+        if stored is not None:
+            return replay_response(stored)
 
-    # Prevent negative stock on OUT
-    if payload.kind == "OUT":
-        current = compute_stock_for_product(db, product_id)
-        if payload.change > current:
-            raise HTTPException(status_code=409, detail=f"Saída maior que o saldo atual ({current} {p.unit})")
+    delta = payload.change if payload.kind == "IN" else -payload.change
+    warehouse_id = payload.warehouse_id or DEFAULT_WAREHOUSE_ID
 
-    m = StockMovement(product_id=product_id, change=payload.change, kind=payload.kind, note=payload.note)
+    # The transaction's first statement is a write (this conditional UPDATE or, with an
+    # Idempotency-Key, the claim's DELETE), so the write lock is held before anything is
+    # read: two concurrent OUTs cannot both pass the check
+    move_stock(db, product_id, warehouse_id, delta)
+
+    now = datetime.utcnow()
+    m = StockMovement(
+        product_id=product_id, warehouse_id=warehouse_id, change=payload.change, kind=payload.kind,
+        note=payload.note, created_at=now,
+    )
     db.add(m)
+    add_to_rollups(db, [(product_id, now, payload.kind, payload.change)])
+    record_threshold_crossings(db, [product_id])
+    if idempotency_key is None:
+        db.commit()
+        invalidate_stock_cache(product_id)
+        db.refresh(m)
+        return m
+
+    db.flush()
+    body = MovementOut.model_validate(m).model_dump_json().encode()
+    store_idempotent_response(db, idempotency_key, product_id, request_hash, body)
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent retry with the same key committed first: ours is rolled back, theirs is the answer
+        db.rollback()
+        stored = find_idempotent_response(db, idempotency_key, request_hash)
+        if stored is None:
+            raise
+        return replay_response(stored)
+    invalidate_stock_cache(product_id)
+    return Response(body, status_code=201, media_type="application/json")
+
+
+@app.post("/transfers", response_model=TransferOut, status_code=201)
+def create_transfer(payload: TransferCreate, db: Session = Depends(get_db)):
+    if payload.from_warehouse_id == payload.to_warehouse_id:
+        raise HTTPException(status_code=400, detail="Origem e destino devem ser depósitos diferentes")
+    pid, qty = payload.product_id, payload.quantity
+    # Both legs in one transaction; the product total nets to zero, so it is left alone
+    # (no rollups and no threshold crossings either). An error rolls both back (get_db closes
+    # the session without committing).
+    change_warehouse_stock(db, pid, payload.from_warehouse_id, -qty)
+    change_warehouse_stock(db, pid, payload.to_warehouse_id, qty)
+
+    now = datetime.utcnow()
+    transfer = StockTransfer(
+        product_id=pid, from_warehouse_id=payload.from_warehouse_id, to_warehouse_id=payload.to_warehouse_id,
+        quantity=qty, note=payload.note, created_at=now,
+    )
+    db.add(transfer)
+    db.flush()
+    legs = [
+        StockMovement(
+            product_id=pid, warehouse_id=warehouse_id, change=qty, kind=kind, note=payload.note,
+            transfer_id=transfer.id, created_at=now,
+        )
+        for warehouse_id, kind in ((payload.from_warehouse_id, "OUT"), (payload.to_warehouse_id, "IN"))
+    ]
+    db.add_all(legs)
     db.commit()
-    db.refresh(m)
-    return m
+    invalidate_stock_cache(pid)
+    return TransferOut(
+        id=transfer.id, product_id=pid, from_warehouse_id=transfer.from_warehouse_id,
+        to_warehouse_id=transfer.to_warehouse_id, quantity=qty, note=transfer.note, created_at=now,
+        movements=[MovementOut.model_validate(leg) for leg in legs],
+    )
+
+
+BATCH_MAX_ATTEMPTS = 3
+
+
+class _StaleBalance(Exception):
+    """A balance changed between the batch's read and its conditional update."""
+
+
+def _apply_movement_batch(db: Session, payload: MovementBatchIn) -> MovementBatchOut:
+    def warehouse_of(item: MovementBatchItem) -> int:
+        return item.warehouse_id or DEFAULT_WAREHOUSE_ID
+
+    # Products, warehouses and the balance of every (product, warehouse) pair in the batch, read once
+    product_ids = {item.product_id for item in payload.items}
+    stmt = (
+        select(Product.id, Product.unit, StockBalance.quantity, current_stock_expr())
+        .outerjoin(StockBalance, StockBalance.product_id == Product.id)
+        .where(Product.id.in_(product_ids))
+    )
+    units: Dict[int, str] = {}
+    totals: Dict[int, Optional[int]] = {}  # stored product total; None when the row is missing
+    ledger_totals: Dict[int, int] = {}
+    for pid, unit, stored, current in db.execute(stmt):
+        units[pid] = unit
+        totals[pid] = stored
+        ledger_totals[pid] = int(current)
+    warehouses = set(db.execute(
+        select(Warehouse.id).where(Warehouse.id.in_({warehouse_of(i) for i in payload.items}))
+    ).scalars())
+    pairs = [
+        pair for pair in {(i.product_id, warehouse_of(i)) for i in payload.items}
+        if pair[0] in units and pair[1] in warehouses
+    ]
+    stored_pairs: Dict[Tuple[int, int], int] = {}
+    if pairs:
+        stored_pairs = {
+            (pid, wid): qty for pid, wid, qty in db.execute(
+                select(WarehouseBalance.product_id, WarehouseBalance.warehouse_id, WarehouseBalance.quantity)
+                .where(tuple_(WarehouseBalance.product_id, WarehouseBalance.warehouse_id).in_(pairs))
+            )
+        }
+    missing = [pair for pair in pairs if pair not in stored_pairs]
+    ledger_pairs: Dict[Tuple[int, int], int] = {}
+    if missing:
+        ledger_pairs = {
+            (pid, wid): int(total) for pid, wid, total in db.execute(
+                select(StockMovement.product_id, StockMovement.warehouse_id, ledger_balance_expr())
+                .where(tuple_(StockMovement.product_id, StockMovement.warehouse_id).in_(missing))
+                .group_by(StockMovement.product_id, StockMovement.warehouse_id)
+            )
+        }
+    running = {pair: int(stored_pairs.get(pair, ledger_pairs.get(pair, 0))) for pair in pairs}
+    initial = dict(running)
+    lowest = dict(running)
+
+    # Validate in order against the running balance, so an IN earlier in the batch can cover a later OUT
+    results: List[MovementBatchResult] = []
+    accepted: List[MovementBatchItem] = []
+    for index, item in enumerate(payload.items):
+        pair = (item.product_id, warehouse_of(item))
+        if item.product_id not in units:
+            results.append(MovementBatchResult(index=index, ok=False, error="Produto não encontrado"))
+            continue
+        if pair[1] not in warehouses:
+            results.append(MovementBatchResult(index=index, ok=False, error="Depósito não encontrado"))
+            continue
+        if item.kind == "OUT" and item.change > running[pair]:
+            results.append(MovementBatchResult(
+                index=index, ok=False,
+                error=f"Saída maior que o saldo atual ({running[pair]} {units[item.product_id]})",
+            ))
+            continue
+        running[pair] += item.change if item.kind == "IN" else -item.change
+        lowest[pair] = min(lowest[pair], running[pair])
+        accepted.append(item)
+        results.append(MovementBatchResult(index=index, ok=True))
+
+    rejected = len(payload.items) - len(accepted)
+    if rejected and payload.mode == "atomic":
+        raise HTTPException(
+            status_code=409,
+            detail=[r.model_dump(exclude={"movement"}) for r in results if not r.ok],
+        )
+
+    if accepted:
+        now = datetime.utcnow()
+        touched_pairs = {(i.product_id, warehouse_of(i)) for i in accepted}
+        touched = {pid for pid, _ in touched_pairs}
+
+        # Existing warehouse rows: one conditional executemany. The batch never drops a
+        # balance below initial - lowest, so requiring at least that much stock at
+        # update time keeps every prefix non-negative even if others wrote meanwhile.
+        deltas = [
+            {
+                "b_product_id": pid, "b_warehouse_id": wid, "b_delta": running[(pid, wid)] - initial[(pid, wid)],
+                "b_required": initial[(pid, wid)] - lowest[(pid, wid)],
+            }
+            for pid, wid in touched_pairs if (pid, wid) in stored_pairs
+        ]
+        if deltas:
+            table = WarehouseBalance.__table__
+            result = db.execute(
+                update(table)
+                .where(
+                    table.c.product_id == bindparam("b_product_id"),
+                    table.c.warehouse_id == bindparam("b_warehouse_id"),
+                    table.c.quantity >= bindparam("b_required"),
+                )
+                .values(quantity=table.c.quantity + bindparam("b_delta"), updated_at=now),
+                deltas,
+            )
+            if result.rowcount != len(deltas):
+                raise _StaleBalance()
+
+        # Product totals follow the warehouses (validated above), unconditionally
+        net: Dict[int, int] = {}
+        for (pid, wid) in touched_pairs:
+            net[pid] = net.get(pid, 0) + running[(pid, wid)] - initial[(pid, wid)]
+        total_deltas = [{"t_product_id": pid, "t_delta": net[pid]} for pid in touched if totals[pid] is not None]
+        if total_deltas:
+            table = StockBalance.__table__
+            db.execute(
+                update(table)
+                .where(table.c.product_id == bindparam("t_product_id"))
+                .values(quantity=table.c.quantity + bindparam("t_delta"), updated_at=now),
+                total_deltas,
+            )
+
+        # Rows that do not exist yet; a concurrent writer seeding the same row makes this flush fail
+        db.add_all(
+            WarehouseBalance(product_id=pid, warehouse_id=wid, quantity=running[(pid, wid)])
+            for pid, wid in touched_pairs if (pid, wid) not in stored_pairs
+        )
+        db.add_all(
+            StockBalance(product_id=pid, quantity=ledger_totals[pid] + net[pid])
+            for pid in touched if totals[pid] is None
+        )
+        try:
+            db.flush()
+        except IntegrityError:
+            raise _StaleBalance()
+
+        rows = [
+            {
+                "product_id": i.product_id, "warehouse_id": warehouse_of(i), "change": i.change, "kind": i.kind,
+                "note": i.note, "created_at": now,
+            }
+            for i in accepted
+        ]
+        ids = db.execute(
+            insert(StockMovement).returning(StockMovement.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        add_to_rollups(db, [(i.product_id, now, i.kind, i.change) for i in accepted])
+        # Net effect of the batch: a product that dips below and recovers within it raises no alert
+        record_threshold_crossings(db, touched)
+        db.commit()
+        invalidate_stock_cache(*touched)
+
+        ok_results = (r for r in results if r.ok)
+        for movement_id, row, result in zip(ids, rows, ok_results):
+            result.movement = MovementOut(id=movement_id, **row)
+
+    return MovementBatchOut(
+        mode=payload.mode, accepted=len(accepted), rejected=rejected, results=results,
+    )
+
+
+@app.post("/movements:batch", response_model=MovementBatchOut)
+def create_movements_batch(payload: MovementBatchIn, db: Session = Depends(get_db)):
+    for _ in range(BATCH_MAX_ATTEMPTS):
+        try:
+            return _apply_movement_batch(db, payload)
+        except _StaleBalance:
+            # Re-read the balances and validate again
+            db.rollback()
+        except OperationalError as exc:
+            # SQLite: a concurrent writer committed after our read snapshot (lock upgrade refused)
+            if "locked" not in str(exc.orig):
+                raise
+            db.rollback()
+    raise HTTPException(status_code=409, detail="Saldos alterados concorrentemente, tente novamente")
 
 
 @app.get("/products/{product_id}/movements", response_model=List[MovementOut])
-def list_movements(product_id: int, db: Session = Depends(get_db)):
+def list_movements(
+    product_id: int,
+    response: Response,
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    warehouse_id: Optional[int] = Query(None, description="Apenas lançamentos deste depósito"),
+    db: Session = Depends(get_db),
+):
     p = db.get(Product, product_id)
     if not p:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
+    stmt = select(*(getattr(StockMovement, f) for f in MOVEMENT_FIELDS)).where(StockMovement.product_id == product_id)
+    if warehouse_id is not None:
+        stmt = stmt.where(StockMovement.warehouse_id == warehouse_id)
+    if after:
+        last_created, last_id = decode_cursor(after, 2)
+        try:
+            last_created = datetime.fromisoformat(last_created)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        stmt = stmt.where(tuple_(StockMovement.created_at, StockMovement.id) < tuple_(last_created, last_id))
+    stmt = stmt.order_by(StockMovement.created_at.desc(), StockMovement.id.desc())
+    if fmt == "ndjson":
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return ndjson_rows_response(stmt, MOVEMENT_FIELDS)
+    body, headers = json_page_response(db, stmt, MOVEMENT_FIELDS, limit, lambda m: [m.created_at, m.id])
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/products/{product_id}/movements/archived")
+def list_archived_movements(product_id: int, db: Session = Depends(get_db)):
+    """Lançamentos arquivados do produto, do mais antigo ao mais recente, em NDJSON (um bloco por vez)."""
+    if db.get(Product, product_id) is None:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
     stmt = (
-        select(StockMovement)
-        .where(StockMovement.product_id == product_id)
-        .order_by(StockMovement.created_at.desc(), StockMovement.id.desc())
+        select(MovementArchive.payload)
+        .where(MovementArchive.product_id == product_id)
+        .order_by(MovementArchive.first_at, MovementArchive.id)
     )
-    return db.execute(stmt).scalars().all()
+
+    def lines():
+        with SessionLocal() as session:
+            for payload in session.execute(stmt.execution_options(yield_per=1)).scalars():
+                yield b"".join(dumps_json(m) + b"\n" for m in unpack_movements(payload))
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.get("/stock", response_model=List[StockSnapshot])
 def list_stock(
+    request: Request,
     q: Optional[str] = Query(None, description="Busca por nome ou SKU"),
+    sku_prefix: Optional[str] = SkuPrefixParam,
     only_below_min: bool = Query(False, description="Apenas itens abaixo do mínimo"),
+    limit: Optional[int] = LimitParam,
+    after: Optional[str] = AfterParam,
+    fmt: Literal["json", "ndjson"] = FormatParam,
+    as_of: Optional[datetime] = AsOfParam,
+    warehouse_id: Optional[int] = WarehouseParam,
     db: Session = Depends(get_db),
 ):
-    stmt = select(Product)
+    as_of = to_utc_naive(as_of) if as_of is not None else None
+    current = resolve_stock_expr(db, as_of, warehouse_id)
+    if as_of is not None:
+        # The list is ordered and filtered in SQL, which cannot replay the archive blocks
+        cutoff = archive_cutoff_after(db, as_of)
+        if cutoff is not None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"as_of anterior ao arquivamento do histórico ({cutoff.isoformat()}); "
+                       "consulte /products/{id}/stock?as_of=... por produto",
+            )
+    # Ordena: abaixo do mínimo primeiro, depois por nome (tudo em SQL)
+    stmt = stock_snapshot_query(current)
     if q:
-        pattern = f"%{q}%"
-        stmt = stmt.where((Product.name.ilike(pattern)) | (Product.sku.ilike(pattern)))
-    products = db.execute(stmt).scalars().all()
-    snapshots = [product_to_snapshot(db, p) for p in products]
+        stmt = stmt.where(product_search_filter(q))
+    if sku_prefix:
+        stmt = stmt.where(sku_prefix_filter(sku_prefix))
     if only_below_min:
-        snapshots = [s for s in snapshots if s.below_minimum]
-    # Ordena: abaixo do mínimo primeiro, depois por nome
-    snapshots.sort(key=lambda s: (not s.below_minimum, s.name.lower()))
-    return snapshots
+        # Live totals: the indexed flag maintained at write time; as_of and per warehouse: computed
+        computed = as_of is not None or warehouse_id is not None
+        stmt = stmt.where(current < Product.min_stock if computed else StockBalance.below_minimum.is_(True))
+    if after:
+        stmt = stmt.where(tuple_(*stock_sort_keys(current)) > tuple_(*decode_cursor(after, 3)))
+    if fmt == "ndjson":
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return ndjson_rows_response(stmt, STOCK_SNAPSHOT_FIELDS)
+
+    def load() -> Tuple[bytes, Dict[str, str]]:
+        return json_page_response(
+            db, stmt, STOCK_SNAPSHOT_FIELDS, limit, lambda row: [row.sort_rank, row.sort_name, row.product_id]
+        )
+
+    return cached_json_response(request, ("stock", q, sku_prefix, only_below_min, limit, after, as_of, warehouse_id), load)
 
 
 @app.get("/products/{product_id}/stock", response_model=StockSnapshot)
-def get_product_stock(product_id: int, db: Session = Depends(get_db)):
+def get_product_stock(
+    product_id: int,
+    request: Request,
+    as_of: Optional[datetime] = AsOfParam,
+    warehouse_id: Optional[int] = WarehouseParam,
+    db: Session = Depends(get_db),
+):
+    as_of = to_utc_naive(as_of) if as_of is not None else None
+
+    def load() -> Tuple[bytes, Dict[str, str]]:
+        if as_of is None and warehouse_id is None:
+            p = db.get(Product, product_id)
+            if not p:
+                raise HTTPException(status_code=404, detail="Produto não encontrado")
+            return product_to_snapshot(db, p).model_dump_json().encode(), {}
+        stmt = stock_snapshot_query(resolve_stock_expr(db, as_of, warehouse_id)).where(Product.id == product_id)
+        row = db.execute(stmt).mappings().first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+        archived = archived_stock_as_of(db, product_id, as_of) if as_of is not None else None
+        if archived is not None:
+            row = {**row, "current_stock": archived, "below_minimum": archived < row["min_stock"]}
+        return StockSnapshot(**row).model_dump_json().encode(), {}
+
+    return cached_json_response(request, ("product", product_id, as_of, warehouse_id), load)
+
+
+@app.get("/products/{product_id}/stock/warehouses", response_model=List[WarehouseStockOut])
+def get_product_stock_by_warehouse(product_id: int, db: Session = Depends(get_db)):
+    """Saldo do produto em cada depósito (depósitos sem saldo aparecem com 0)."""
+    if db.get(Product, product_id) is None:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    stored = (
+        select(WarehouseBalance.quantity)
+        .where(WarehouseBalance.product_id == product_id, WarehouseBalance.warehouse_id == Warehouse.id)
+        .correlate(Warehouse)
+        .scalar_subquery()
+    )
+    ledger = warehouse_ledger_expr(product_id, Warehouse.id).correlate(Warehouse).scalar_subquery()
+    stmt = select(Warehouse.id, Warehouse.code, func.coalesce(stored, ledger)).order_by(Warehouse.id)
+    return [WarehouseStockOut(warehouse_id=wid, code=code, quantity=qty) for wid, code, qty in db.execute(stmt)]
+
+
+# ===========================
+# Alert stream (Server-Sent Events)
+# ===========================
+def sse_event(alert: StockAlertOut) -> str:
+    kind = "below_minimum" if alert.below_minimum else "restocked"
+    return f"id: {alert.id}\nevent: {kind}\ndata: {alert.model_dump_json()}\n\n"
+
+
+@app.get("/alerts/stream")
+async def stream_alerts(
+    request: Request,
+    after: Optional[int] = Query(None, ge=0, description="Reenvia os alertas com id maior (padrão: só os novos)"),
+):
+    """Eventos `below_minimum` / `restocked`; o header Last-Event-ID da reconexão tem precedência sobre `after`."""
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        start = int(last_event_id)
+    else:
+        start = after if after is not None else await run_in_threadpool(latest_alert_id)
+
+    async def events():
+        waiter = alert_broker.subscribe()
+        last_id, idle = start, 0.0
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                waiter.clear()  # before the read, so a commit racing with it still wakes us
+                alerts = await run_in_threadpool(fetch_alerts, last_id)
+                for alert in alerts:
+                    yield sse_event(alert)
+                    last_id = alert.id
+                if len(alerts) == ALERT_BATCH_SIZE:
+                    continue
+                try:
+                    await asyncio.wait_for(waiter.wait(), ALERT_POLL_SECONDS)
+                    idle = 0.0
+                except asyncio.TimeoutError:
+                    idle += ALERT_POLL_SECONDS
+                    if idle >= ALERT_KEEPALIVE_SECONDS:
+                        yield ": keepalive\n\n"
+                        idle = 0.0
+        finally:
+            alert_broker.unsubscribe(waiter)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ===========================
+# Reporting
+# ===========================
+BucketParam = Query("day", description="Agrupamento: day, week (início na segunda) ou month")
+DateFromParam = Query(None, alias="from", description="Dia inicial (inclusive, UTC)")
+DateToParam = Query(None, alias="to", description="Dia final (inclusive, UTC)")
+
+
+@app.get("/products/{product_id}/movements/rollup", response_model=List[RollupBucket])
+def product_movements_rollup(
+    product_id: int,
+    bucket: Literal["day", "week", "month"] = BucketParam,
+    date_from: Optional[date] = DateFromParam,
+    date_to: Optional[date] = DateToParam,
+    db: Session = Depends(get_db),
+):
     p = db.get(Product, product_id)
     if not p:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
-    return product_to_snapshot(db, p)
+    return query_rollups(db, bucket, date_from, date_to, product_id=product_id)
+
+
+@app.get("/movements/rollup", response_model=List[RollupBucket])
+def movements_rollup(
+    bucket: Literal["day", "week", "month"] = BucketParam,
+    date_from: Optional[date] = DateFromParam,
+    date_to: Optional[date] = DateToParam,
+    db: Session = Depends(get_db),
+):
+    # Totais de todos os produtos, sem varrer stock_movements
+    return query_rollups(db, bucket, date_from, date_to)
+
+# ===========================
+# Admin
+# ===========================
+@app.post("/admin/rebuild-balances", response_model=RebuildBalancesOut)
+def rebuild_balances(
+    dry_run: bool = Query(False, description="Apenas reporta divergências, sem corrigir"),
+    db: Session = Depends(get_db),
+):
+    # One grouped pass over the ledger, compared against the stored balances
+    ledger = (
+        select(StockMovement.product_id, ledger_balance_expr().label("total"))
+        .group_by(StockMovement.product_id)
+        .subquery()
+    )
+    stmt = (
+        select(Product.id, Product.sku, StockBalance.quantity, func.coalesce(ledger.c.total, 0))
+        .outerjoin(StockBalance, StockBalance.product_id == Product.id)
+        .outerjoin(ledger, ledger.c.product_id == Product.id)
+        .order_by(Product.id)
+    )
+    checked = 0
+    drift: List[BalanceDrift] = []
+    for product_id, sku, stored, total in db.execute(stmt):
+        checked += 1
+        if stored is None or int(stored) != int(total):
+            drift.append(BalanceDrift(product_id=product_id, sku=sku, stored=stored, ledger=int(total)))
+
+    # Same for the per-warehouse balances; a pair with no row and an empty ledger is not drift
+    skus = dict(db.execute(select(Product.id, Product.sku)).all())
+    pair_ledger = {
+        (pid, wid): int(total) for pid, wid, total in db.execute(
+            select(StockMovement.product_id, StockMovement.warehouse_id, ledger_balance_expr())
+            .group_by(StockMovement.product_id, StockMovement.warehouse_id)
+        )
+    }
+    pair_stored = {
+        (pid, wid): int(qty) for pid, wid, qty in db.execute(
+            select(WarehouseBalance.product_id, WarehouseBalance.warehouse_id, WarehouseBalance.quantity)
+        )
+    }
+    for pid, wid in sorted(pair_ledger.keys() | pair_stored.keys()):
+        stored, total = pair_stored.get((pid, wid)), pair_ledger.get((pid, wid), 0)
+        if pid in skus and stored != total and not (stored is None and total == 0):
+            drift.append(BalanceDrift(product_id=pid, sku=skus[pid], warehouse_id=wid, stored=stored, ledger=total))
+
+    if not dry_run:
+        for d in drift:
+            if d.warehouse_id is not None:
+                if not seed_warehouse_balance(db, d.product_id, d.warehouse_id):
+                    db.execute(
+                        update(WarehouseBalance)
+                        .where(WarehouseBalance.product_id == d.product_id, WarehouseBalance.warehouse_id == d.warehouse_id)
+                        .values(
+                            quantity=warehouse_ledger_expr(d.product_id, d.warehouse_id).scalar_subquery(),
+                            updated_at=datetime.utcnow(),
+                        )
+                    )
+            elif d.stored is None:
+                seed_balance(db, d.product_id)
+            else:
+                # Recomputed inside the UPDATE, so movements committed since the scan are not lost
+                ledger_now = (
+                    select(ledger_balance_expr())
+                    .where(StockMovement.product_id == d.product_id)
+                    .scalar_subquery()
+                )
+                db.execute(
+                    update(StockBalance)
+                    .where(StockBalance.product_id == d.product_id)
+                    .values(quantity=ledger_now, updated_at=datetime.utcnow())
+                )
+        record_threshold_crossings(db, {d.product_id for d in drift})
+        db.commit()
+        invalidate_stock_cache()
+
+    return RebuildBalancesOut(checked=checked, fixed=0 if dry_run else len(drift), dry_run=dry_run, drift=drift)
+
+
+@app.post("/admin/rebuild-rollups", response_model=RebuildRollupsOut)
+def rebuild_rollups(db: Session = Depends(get_db)):
+    # Backfills history recorded before the rollup table existed; one grouped pass over the ledger.
+    # Days before a product's archive cutoff are no longer in the ledger: their rollups are kept
+    # as they are (this also leaves out the opening-balance movement, dated just before the cutoff).
+    # Transfer legs only move stock between warehouses and are not counted as IN/OUT.
+    dialect_name = db.get_bind().dialect.name
+    totals = ledger_rollup_totals(dialect_name)
+    rollup_cutoff = ledger_day_expr(dialect_name, archive_cutoff_expr(MovementRollup.product_id))
+    db.execute(delete(MovementRollup).where(MovementRollup.day >= func.coalesce(rollup_cutoff, date.min)))
+    db.execute(
+        insert(MovementRollup).from_select(
+            ["product_id", "day", "qty_in", "qty_out", "movement_count"], totals
+        )
+    )
+    rows = db.execute(select(func.count()).select_from(MovementRollup)).scalar_one()
+    db.commit()
+    return RebuildRollupsOut(rows=rows)
+
+
+@app.post("/admin/checkpoints", response_model=CheckpointJobOut)
+def run_checkpoints():
+    # Same work as the periodic background job, on demand
+    return run_checkpoint_job()
+
+
+# ===========================
+# Balance checkpoints (background job)
+# ===========================
+# Checkpoints are taken a little in the past so transactions still in flight
+# (created_at already set, not yet committed) are not missed.
+CHECKPOINT_LAG = timedelta(seconds=60)
+CHECKPOINT_KEEP_DAYS = int(os.getenv("INVENTORY_CHECKPOINT_KEEP_DAYS", "30"))
+
+
+def take_checkpoints(db: Session, taken_at: datetime) -> int:
+    """Inserts a checkpoint at `taken_at` for every product with movements since its latest one."""
+    latest = (
+        select(func.max(StockCheckpoint.taken_at))
+        .where(StockCheckpoint.product_id == Product.id)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    has_new_movements = exists().where(
+        StockMovement.product_id == Product.id,
+        StockMovement.created_at > func.coalesce(latest, datetime.min),
+        StockMovement.created_at <= taken_at,
+    )
+    source = select(
+        Product.id, bindparam("taken_at", taken_at, type_=DateTime), stock_as_of_expr(taken_at),
+    ).where(has_new_movements)
+    result = db.execute(insert(StockCheckpoint).from_select(["product_id", "taken_at", "quantity"], source))
+    return result.rowcount
+
+
+def compact_checkpoints(db: Session, older_than: datetime) -> int:
+    """Before `older_than`, keeps only the last checkpoint of each product per month."""
+    if db.get_bind().dialect.name == "sqlite":
+        month = func.strftime("%Y-%m", StockCheckpoint.taken_at)
+    else:
+        month = func.date_trunc("month", StockCheckpoint.taken_at)
+    keep = (
+        select(func.max(StockCheckpoint.id))
+        .where(StockCheckpoint.taken_at < older_than)
+        .group_by(StockCheckpoint.product_id, month)
+    )
+    # Checkpoints at an archive cutoff are the base of every as_of after it: never compacted
+    at_cutoff = exists().where(
+        MovementArchive.product_id == StockCheckpoint.product_id,
+        MovementArchive.archived_before == StockCheckpoint.taken_at,
+    )
+    result = db.execute(
+        delete(StockCheckpoint).where(
+            StockCheckpoint.taken_at < older_than, StockCheckpoint.id.not_in(keep), ~at_cutoff,
+        )
+    )
+    return result.rowcount
+
+
+def run_idempotency_purge() -> int:
+    with SessionLocal() as db:
+        purged = purge_idempotency_keys(db, datetime.utcnow())
+        db.commit()
+    return purged
+
+
+def run_checkpoint_job() -> CheckpointJobOut:
+    now = datetime.utcnow()
+    taken_at = now - CHECKPOINT_LAG
+    with SessionLocal() as db:
+        created = take_checkpoints(db, taken_at)
+        compacted = compact_checkpoints(db, now - timedelta(days=CHECKPOINT_KEEP_DAYS))
+        db.commit()
+    return CheckpointJobOut(taken_at=taken_at, created=created, compacted=compacted)
+
+
+async def checkpoint_loop() -> None:
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(run_checkpoint_job)
+        except Exception:
+            logger.exception("Falha no job de checkpoints de saldo")
+        if ARCHIVE_RETENTION_DAYS > 0:
+            try:
+                await run_in_threadpool(run_archive_job, ARCHIVE_RETENTION_DAYS)
+            except Exception:
+                logger.exception("Falha no arquivamento de lançamentos")
+        try:
+            await run_in_threadpool(run_idempotency_purge)
+        except Exception:
+            logger.exception("Falha na limpeza de chaves de idempotência")
+
+# ===========================
+# Ledger archival
+# ===========================
+# Movements older than the retention window (cut at UTC midnight) are moved, per
+# product, into zlib-compressed JSON blocks in stock_movement_archives, in the
+# same transaction that deletes them. What stays behind in stock_movements:
+# - one opening-balance movement per warehouse with their net total, dated 1 us
+#   before the cutoff, so ledger sums (rebuild-balances) keep matching the stored balances;
+# - a checkpoint at the cutoff, so as_of after it replays only live movements.
+#   as_of before a cutoff is replayed from the archive blocks by /products/{id}/stock
+#   (archived_stock_as_of); /stock answers it with 409.
+# Daily rollups are left untouched, so reports still cover the archived period.
+ARCHIVE_RETENTION_DAYS = int(os.getenv("INVENTORY_ARCHIVE_RETENTION_DAYS", "0"))
+ARCHIVE_PRODUCTS_PER_TX = 200
+ARCHIVE_BLOCK_ROWS = 10_000
+OPENING_BALANCE_NOTE = "Saldo de abertura (lançamentos anteriores a {:%Y-%m-%d} arquivados)"
+
+
+def archive_cutoff_expr(product_id_column):
+    """Latest archive cutoff of the product (NULL if nothing was archived), correlated to the column."""
+    return (
+        select(func.max(MovementArchive.archived_before))
+        .where(MovementArchive.product_id == product_id_column)
+        .scalar_subquery()
+    )
+
+
+def pack_movements(rows: List[Dict[str, Any]]) -> bytes:
+    return zlib.compress(dumps_json(rows), 6)
+
+
+def unpack_movements(payload: bytes) -> List[Dict[str, Any]]:
+    return json.loads(zlib.decompress(payload))
+
+
+def archive_products(db: Session, product_ids: List[int], cutoff: datetime) -> Tuple[int, int]:
+    """Archives the movements before `cutoff` of the given products. Returns (movements, blocks)."""
+    stmt = (
+        select(*(getattr(StockMovement, f) for f in MOVEMENT_FIELDS))
+        .where(StockMovement.product_id.in_(product_ids), StockMovement.created_at < cutoff)
+        .order_by(StockMovement.product_id, StockMovement.created_at, StockMovement.id)
+        .execution_options(yield_per=ARCHIVE_BLOCK_ROWS)
+    )
+    now = datetime.utcnow()
+    blocks: List[Dict[str, Any]] = []
+    net: Dict[Tuple[int, int], int] = {}  # per (product, warehouse)
+    block: List[Dict[str, Any]] = []
+
+    def close_block() -> None:
+        blocks.append({
+            "product_id": block[0]["product_id"], "archived_before": cutoff,
+            "first_at": block[0]["created_at"], "last_at": block[-1]["created_at"],
+            "movement_count": len(block),
+            "net_change": sum(m["change"] if m["kind"] == "IN" else -m["change"] for m in block),
+            "payload": pack_movements(block), "archived_at": now,
+        })
+        block.clear()
+
+    for row in db.execute(stmt):
+        movement = dict(zip(MOVEMENT_FIELDS, row))
+        if block and (block[0]["product_id"] != movement["product_id"] or len(block) >= ARCHIVE_BLOCK_ROWS):
+            close_block()
+        block.append(movement)
+        delta = movement["change"] if movement["kind"] == "IN" else -movement["change"]
+        pair = (movement["product_id"], movement["warehouse_id"])
+        net[pair] = net.get(pair, 0) + delta
+    if block:
+        close_block()
+    if not net:
+        return 0, 0
+
+    db.execute(insert(MovementArchive), blocks)
+    totals: Dict[int, int] = {}
+    for (pid, _), total in net.items():
+        totals[pid] = totals.get(pid, 0) + total
+    archived = db.execute(
+        delete(StockMovement).where(StockMovement.product_id.in_(list(totals)), StockMovement.created_at < cutoff)
+    ).rowcount
+    openings = [
+        {
+            "product_id": pid, "warehouse_id": wid, "change": abs(total), "kind": "IN" if total > 0 else "OUT",
+            "note": OPENING_BALANCE_NOTE.format(cutoff), "created_at": cutoff - timedelta(microseconds=1),
+        }
+        for (pid, wid), total in net.items() if total != 0
+    ]
+    if openings:
+        db.execute(insert(StockMovement), openings)
+    checkpoint = dialect_insert(db)(StockCheckpoint.__table__).values(
+        [{"product_id": pid, "taken_at": cutoff, "quantity": total} for pid, total in totals.items()]
+    )
+    db.execute(checkpoint.on_conflict_do_update(
+        index_elements=["product_id", "taken_at"], set_={"quantity": checkpoint.excluded.quantity},
+    ))
+    return archived, len(blocks)
+
+
+def run_archive_job(retention_days: int) -> ArchiveJobOut:
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - timedelta(days=retention_days)
+    with SessionLocal() as db:
+        product_ids = list(db.execute(
+            select(StockMovement.product_id).where(StockMovement.created_at < cutoff).distinct()
+        ).scalars())
+    summary = ArchiveJobOut(archived_before=cutoff, products=0, movements=0, blocks=0)
+    # Short transactions: writers of other products are only blocked for one group at a time
+    for start in range(0, len(product_ids), ARCHIVE_PRODUCTS_PER_TX):
+        group = product_ids[start:start + ARCHIVE_PRODUCTS_PER_TX]
+        with SessionLocal() as db:
+            movements, blocks = archive_products(db, group, cutoff)
+            db.commit()
+        summary.products += len(group)
+        summary.movements += movements
+        summary.blocks += blocks
+    if summary.movements:
+        invalidate_stock_cache()
+    return summary
+
+
+@app.post("/admin/archive-movements", response_model=ArchiveJobOut)
+def archive_movements(
+    retention_days: int = Query(
+        ARCHIVE_RETENTION_DAYS or 365, ge=1, description="Dias de histórico mantidos em stock_movements"
+    ),
+):
+    return run_archive_job(retention_days)
 
 
 # ===========================
@@ -313,3 +2878,18 @@ def get_product_stock(product_id: int, db: Session = Depends(get_db)):
 @app.get("/health")
 def health() -> Dict[str, str]:
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+if __name__ == "__main__":
+    # Schema step for multi-worker deployments: run once, then start the workers with INVENTORY_AUTO_MIGRATE=0
+    import sys
+
+    if sys.argv[1:] != ["migrate"]:
+        raise SystemExit("uso: python inventory_service_fastapi.py migrate")
+    init_db()
+    print(f"Schema na versão {SCHEMA_VERSION} ({DATABASE_URL})")
@@ -0,0 +1,90 @@
+import os
+import sys
+import threading
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consulta_dentista  # noqa: E402
+from consulta_dentista import DatabaseWorker  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "appointments.db")
+
+
+def test_worker_stop_with_queued_bookings(db_path):
+    # The stop sentinel arrives while the worker is batching the queued bookings
+    release = threading.Event()
+    worker = DatabaseWorker(db_path).start()
+    worker.submit(lambda repository: release.wait(5))
+    for hour in ("09:00", "10:00", "11:00"):
+        worker.submit_booking("Paciente", "03/03/2031", hour)
+    stopper = threading.Thread(target=worker.stop)
+    stopper.start()
+    release.set()
+    stopper.join(5)
+    assert not stopper.is_alive()
+    assert not worker.thread.is_alive()
+    assert worker.stats()["bookings"] == 3
+
+    repository = consulta_dentista.AppointmentRepository(db_path)
+    assert len(repository.page_appointments()[0]) == 3
+    repository.close()
+
+
+def test_page_appointments_date_filters_skip_undated_rows(db_path):
+    repository = consulta_dentista.AppointmentRepository(db_path)
+    repository.init_schema()
+    repository.conn.execute("INSERT INTO appointments (name, date, time) VALUES ('antigo', 'xx', 'yy')")
+    repository.conn.commit()
+    repository.save_appointment("Paciente", "03/03/2031", "09:00")
+
+    assert [row[4] for row in repository.page_appointments()[0]] == ["antigo", "Paciente"]
+    for filters in ({"date_to": date(2031, 3, 3)}, {"date_from": date(2031, 3, 3)}):
+        assert [row[4] for row in repository.page_appointments(**filters)[0]] == ["Paciente"]
+    repository.close()
+
+
+def test_coalesced_batch_commits_all_but_the_conflict(db_path):
+    repository = consulta_dentista.AppointmentRepository(db_path)
+    repository.init_schema()
+    repository.save_appointment("Primeiro", "03/03/2031", "09:00")
+    repository.close()
+
+    release = threading.Event()
+    results = []
+    # Callbacks run right on the worker thread instead of waiting for a Tk poll
+    worker = DatabaseWorker(db_path, deliver=lambda callback, result, error: callback(result, error))
+    worker.start()
+    # Holds the worker so the three bookings are queued together and go out as one batch
+    worker.submit(lambda repository: release.wait(5))
+    for hour in ("08:00", "09:00", "10:00"):
+        worker.submit_booking("Paciente", "03/03/2031", hour, callback=lambda result, error: results.append((result, error)))
+    release.set()
+    worker.wait()
+    assert worker.stop(5)
+
+    assert worker.stats()["booking_batches"] == 1
+    assert isinstance(results[1][1], consulta_dentista.BookingConflict)
+    assert results[0][1] is None and results[2][1] is None
+    repository = consulta_dentista.AppointmentRepository(db_path)
+    assert [row[3] for row in repository.page_appointments()[0]] == ["08:00", "09:00", "10:00"]
+    repository.close()
+
+
+def test_worker_fails_requests_when_database_cannot_open(tmp_path):
+    results = []
+    # A directory path: sqlite3 cannot open it, so the worker starts without a repository
+    worker = DatabaseWorker(str(tmp_path), deliver=lambda callback, result, error: callback(result, error))
+    worker.start()
+    worker.submit(consulta_dentista.AppointmentRepository.list_dentists, callback=lambda r, e: results.append(e))
+    worker.submit_booking("Paciente", "03/03/2031", "09:00", callback=lambda r, e: results.append(e))
+    worker.wait()
+    assert worker.stop(5)
+
+    assert worker.startup_error is not None
+    assert results == [worker.startup_error, worker.startup_error]
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consulta_dentista  # noqa: E402
+from consulta_dentista_api import MAX_AVAILABILITY_DAYS, app  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(consulta_dentista, "DB_PATH", str(tmp_path / "appointments.db"))
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def book(client, **overrides):
+    payload = {"name": "Paciente", "date": "03/03/2031", "time": "09:00", **overrides}
+    return client.post("/appointments", json=payload)
+
+
+def test_booking_and_slot_conflict(client):
+    created = book(client)
+    assert created.status_code == 201
+    assert created.json()["start"] == "2031-03-03T09:00:00"
+
+    # Overlapping a 30-minute appointment from a different start time is also a conflict
+    assert book(client).status_code == 409
+    assert book(client, time="08:30", duration=60).status_code == 409
+    assert book(client, time="09:30").status_code == 201
+
+
+def test_invalid_date_is_rejected(client):
+    response = book(client, date="31/02/2031")
+    assert response.status_code == 422
+    assert "inválida" in response.json()["detail"]
+
+
+@pytest.mark.parametrize("overrides", [
+    {"time": "03:17"},  # before opening and off the 30-minute grid
+    {"time": "09:15"},  # off the grid
+    {"time": "17:30", "duration": 60},  # ends after closing
+    {"date": "08/03/2031"},  # Saturday
+])
+def test_booking_outside_the_schedule_is_rejected(client, overrides):
+    response = book(client, **overrides)
+    assert response.status_code == 422
+    assert "Fora da agenda" in response.json()["detail"]
+
+
+def test_unknown_dentist_is_rejected(client):
+    response = book(client, dentist_id=999)
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Dentista não encontrado."
+
+
+def test_availability_excludes_booked_slots(client):
+    book(client, time="09:00")
+    response = client.get("/availability", params={"date_from": "2031-03-03"})
+    assert response.status_code == 200
+    starts = [slot["start"] for slot in response.json()]
+    assert "2031-03-03T08:30:00" in starts
+    assert "2031-03-03T09:00:00" not in starts
+
+
+def test_availability_range_limits(client):
+    too_long = {"date_from": "2031-03-01", "date_to": f"2031-03-{MAX_AVAILABILITY_DAYS + 1:02d}"}
+    assert client.get("/availability", params=too_long).status_code == 422
+    backwards = {"date_from": "2031-03-10", "date_to": "2031-03-09"}
+    assert client.get("/availability", params=backwards).status_code == 422
+    longest = {"date_from": "2031-03-01", "date_to": f"2031-03-{MAX_AVAILABILITY_DAYS:02d}"}
+    assert client.get("/availability", params=longest).status_code == 200
+
+
+def test_dentist_login(client):
+    assert client.post("/dentists/login", json={"username": "admin", "password": "1234"}).json()["username"] == "admin"
+    assert client.post("/dentists/login", json={"username": "admin", "password": "x"}).status_code == 401
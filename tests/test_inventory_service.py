@@ -0,0 +1,310 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Read at import: no background checkpoint job while the tests run
+os.environ.setdefault("INVENTORY_CHECKPOINT_INTERVAL", "0")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import inventory_service_fastapi as service  # noqa: E402
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'inventory.db'}"
+
+
+@pytest.fixture
+def engine(db_url, monkeypatch):
+    engine = service.build_engine(db_url)
+    monkeypatch.setattr(service, "_engine", engine)
+    service.SessionLocal.configure(bind=engine)
+    yield engine
+    service.SessionLocal.configure(bind=None)
+    engine.dispose()
+
+
+@pytest.fixture
+def client(engine):
+    with TestClient(service.app) as client:
+        yield client
+
+
+def create_product(client, sku="SKU-1", min_stock=0):
+    response = client.post("/products", json={"sku": sku, "name": "Produto", "min_stock": min_stock})
+    assert response.status_code == 201
+    return response.json()["id"]
+
+
+def move(client, product_id, kind, change, headers=None):
+    return client.post(f"/products/{product_id}/movements", json={"kind": kind, "change": change}, headers=headers)
+
+
+def stock(client, product_id, **params):
+    return client.get(f"/products/{product_id}/stock", params=params).json()["current_stock"]
+
+
+def assert_no_drift(client):
+    report = client.post("/admin/rebuild-balances", params={"dry_run": True}).json()
+    assert report["drift"] == []
+
+
+def run_concurrently(calls):
+    """Runs the calls on their own threads, released together; returns their results in order."""
+    barrier = threading.Barrier(len(calls))
+
+    def run(call):
+        barrier.wait()
+        return call()
+
+    with ThreadPoolExecutor(len(calls)) as pool:
+        return list(pool.map(run, calls))
+
+
+def archive_everything(product_id):
+    # A cutoff in the future archives up to the newest movement
+    with service.SessionLocal() as db:
+        service.archive_products(db, [product_id], datetime.utcnow() + timedelta(seconds=1))
+        db.commit()
+
+
+def archived_ids(client, product_id):
+    lines = client.get(f"/products/{product_id}/movements/archived").text.splitlines()
+    return {json.loads(line)["id"] for line in lines}
+
+
+# ===========================
+# Balances under concurrency
+# ===========================
+def test_concurrent_outs_never_oversell_or_drift(client):
+    product_id = create_product(client)
+    move(client, product_id, "IN", 20)
+
+    def single_out():
+        with service.SessionLocal() as db:
+            try:
+                service.create_movement(product_id, service.MovementCreate(kind="OUT", change=1), None, db)
+                return 1
+            except service.HTTPException as error:
+                assert error.status_code == 409
+                return 0
+
+    def batch_out():
+        item = service.MovementBatchItem(product_id=product_id, kind="OUT", change=1)
+        with service.SessionLocal() as db:
+            return service.create_movements_batch(service.MovementBatchIn(items=[item], mode="best_effort"), db).accepted
+
+    accepted = run_concurrently([single_out, batch_out] * 15)
+    assert sum(accepted) == 20
+    assert stock(client, product_id) == 0
+    assert_no_drift(client)
+
+
+# ===========================
+# Batches
+# ===========================
+def test_atomic_batch_rejects_everything_on_one_invalid_item(client):
+    product_id = create_product(client)
+    move(client, product_id, "IN", 5)
+    items = [
+        {"product_id": product_id, "kind": "IN", "change": 2},
+        {"product_id": product_id, "kind": "OUT", "change": 10},
+    ]
+
+    response = client.post("/movements:batch", json={"items": items, "mode": "atomic"})
+    assert response.status_code == 409
+    assert [error["index"] for error in response.json()["detail"]] == [1]
+    assert stock(client, product_id) == 5
+    assert len(client.get(f"/products/{product_id}/movements").json()) == 1
+
+
+def test_best_effort_batch_keeps_the_valid_items(client):
+    product_id = create_product(client)
+    move(client, product_id, "IN", 5)
+    items = [
+        {"product_id": product_id, "kind": "IN", "change": 2},
+        {"product_id": product_id, "kind": "OUT", "change": 10},
+        {"product_id": 999, "kind": "IN", "change": 1},
+    ]
+
+    response = client.post("/movements:batch", json={"items": items, "mode": "best_effort"})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["accepted"], body["rejected"]) == (1, 2)
+    assert [result["ok"] for result in body["results"]] == [True, False, False]
+    assert stock(client, product_id) == 7
+    assert_no_drift(client)
+
+
+# ===========================
+# Idempotency-Key
+# ===========================
+def test_idempotency_key_replays_the_original_response(client):
+    product_id = create_product(client)
+    first = move(client, product_id, "IN", 5, headers={"Idempotency-Key": "entrada-1"})
+    again = move(client, product_id, "IN", 5, headers={"Idempotency-Key": "entrada-1"})
+
+    assert first.status_code == again.status_code == 201
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.json() == first.json()
+    assert stock(client, product_id) == 5
+
+
+def test_idempotency_key_reused_with_another_request_is_rejected(client):
+    product_id = create_product(client)
+    move(client, product_id, "IN", 5, headers={"Idempotency-Key": "entrada-1"})
+
+    response = move(client, product_id, "IN", 6, headers={"Idempotency-Key": "entrada-1"})
+    assert response.status_code == 422
+    assert stock(client, product_id) == 5
+
+
+def test_concurrent_retries_with_one_key_move_stock_once(client):
+    product_id = create_product(client)
+
+    def retry():
+        with service.SessionLocal() as db:
+            response = service.create_movement(
+                product_id, service.MovementCreate(kind="IN", change=3), "entrada-1", db
+            )
+            return json.loads(response.body)["id"]
+
+    assert len(set(run_concurrently([retry] * 8))) == 1
+    assert stock(client, product_id) == 3
+    assert len(client.get(f"/products/{product_id}/movements").json()) == 1
+
+
+# ===========================
+# Archiving
+# ===========================
+def test_archiving_the_newest_movements_never_reissues_their_ids(client):
+    product_id = create_product(client)
+    for _ in range(3):
+        assert move(client, product_id, "IN", 5).status_code == 201
+    archive_everything(product_id)
+
+    archived = archived_ids(client, product_id)
+    assert len(archived) == 3
+    opening = client.get(f"/products/{product_id}/movements").json()
+    new_id = move(client, product_id, "OUT", 1).json()["id"]
+    assert {m["id"] for m in opening} | {new_id} == {max(archived) + 1, max(archived) + 2}
+
+
+def test_as_of_across_an_archive_cutoff(client):
+    product_id = create_product(client)
+    for kind, change in (("IN", 10), ("IN", 5), ("OUT", 3)):
+        move(client, product_id, kind, change)
+    # Spread the ledger over three days
+    with service.SessionLocal() as db:
+        movements = db.execute(service.select(service.StockMovement).order_by(service.StockMovement.id)).scalars()
+        for day, movement in enumerate(movements, start=1):
+            movement.created_at = datetime(2024, 1, day, 10)
+        db.commit()
+    with service.SessionLocal() as db:
+        service.archive_products(db, [product_id], datetime(2024, 1, 2, 12))
+        db.commit()
+
+    assert stock(client, product_id) == 12
+    # Before the cutoff the per-product endpoint replays the archive blocks
+    assert stock(client, product_id, as_of="2024-01-01T12:00:00") == 10
+    assert stock(client, product_id, as_of="2024-01-02T18:00:00") == 15
+    assert stock(client, product_id, as_of="2024-01-03T12:00:00") == 12
+    # The list is computed in SQL and cannot: it refuses instead of returning stale totals
+    assert client.get("/stock", params={"as_of": "2024-01-01T12:00:00"}).status_code == 409
+    listed = client.get("/stock", params={"as_of": "2024-01-03T12:00:00"})
+    assert [row["current_stock"] for row in listed.json()] == [12]
+    assert_no_drift(client)
+
+
+def test_upgrade_rebuilds_movements_without_autoincrement(engine, db_url):
+    with TestClient(service.app) as client:
+        product_id = create_product(client)
+        move(client, product_id, "IN", 5)
+        move(client, product_id, "OUT", 5)
+        # Nets to zero: no opening movement, stock_movements is left empty
+        archive_everything(product_id)
+        archived = archived_ids(client, product_id)
+
+    # Same ledger in a stock_movements created before sqlite_autoincrement
+    engine.dispose()
+    conn = sqlite3.connect(db_url.removeprefix("sqlite:///"))
+    ddl = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'stock_movements'").fetchone()[0]
+    conn.executescript(f"""
+        ALTER TABLE stock_movements RENAME TO stock_movements_old;
+        {ddl.replace(" AUTOINCREMENT", "")};
+        INSERT INTO stock_movements SELECT * FROM stock_movements_old;
+        DROP TABLE stock_movements_old;
+        DELETE FROM schema_version;
+    """)
+    conn.close()
+
+    service.init_db(engine)
+    with TestClient(service.app) as client:
+        new_id = move(client, product_id, "IN", 1).json()["id"]
+        assert new_id > max(archived)
+        assert client.get(f"/products/{product_id}/stock").json()["current_stock"] == 1
+    conn = sqlite3.connect(db_url.removeprefix("sqlite:///"))
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE tbl_name = 'stock_movements'")}
+    conn.close()
+    assert "ix_stock_movements_product_created" in indexes
+
+
+# ===========================
+# Schema upgrade
+# ===========================
+# The schema of the first release: products and stock_movements only, no schema_version
+BASELINE_SCHEMA = """
+CREATE TABLE products (
+    id INTEGER NOT NULL, sku VARCHAR(64) NOT NULL, name VARCHAR(255) NOT NULL, unit VARCHAR(16) NOT NULL,
+    min_stock INTEGER NOT NULL, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE INDEX ix_products_id ON products (id);
+CREATE UNIQUE INDEX ix_products_sku ON products (sku);
+CREATE TABLE stock_movements (
+    id INTEGER NOT NULL, product_id INTEGER NOT NULL, change INTEGER NOT NULL, kind VARCHAR(3) NOT NULL,
+    note TEXT, created_at DATETIME NOT NULL,
+    PRIMARY KEY (id),
+    CONSTRAINT ck_change_positive CHECK (change > 0),
+    CONSTRAINT ck_kind_valid CHECK (kind IN ('IN','OUT')),
+    FOREIGN KEY(product_id) REFERENCES products (id) ON DELETE CASCADE
+);
+CREATE INDEX ix_stock_movements_product_id ON stock_movements (product_id);
+CREATE INDEX ix_stock_movements_created_at ON stock_movements (created_at);
+INSERT INTO products VALUES
+    (1, 'A-1', 'Abaixo do mínimo', 'un', 5, '2024-01-01 08:00:00.000000', '2024-01-01 08:00:00.000000'),
+    (2, 'B-1', 'Sem movimentos', 'un', 0, '2024-01-01 08:00:00.000000', '2024-01-01 08:00:00.000000');
+INSERT INTO stock_movements (product_id, change, kind, note, created_at) VALUES
+    (1, 10, 'IN', NULL, '2024-01-01 10:00:00.000000'),
+    (1, 7, 'OUT', NULL, '2024-01-02 10:00:00.000000');
+"""
+
+
+def test_upgrade_from_the_baseline_schema(engine, db_url):
+    conn = sqlite3.connect(db_url.removeprefix("sqlite:///"))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+
+    with TestClient(service.app) as client:
+        assert service.stored_schema_version(engine) == service.SCHEMA_VERSION
+        snapshot = client.get("/products/1/stock").json()
+        assert (snapshot["current_stock"], snapshot["below_minimum"]) == (3, True)
+        assert stock(client, 2) == 0
+        assert [row["sku"] for row in client.get("/stock", params={"only_below_min": True}).json()] == ["A-1"]
+        warehouses = client.get("/products/1/stock/warehouses").json()
+        assert [(row["warehouse_id"], row["quantity"]) for row in warehouses] == [(1, 3)]
+        rollups = client.get("/products/1/movements/rollup").json()
+        assert [(row["qty_in"], row["qty_out"]) for row in rollups] == [(10, 0), (0, 7)]
+        assert_no_drift(client)
+
+        # Writes keep working on the upgraded tables
+        assert move(client, 1, "OUT", 3).json()["id"] == 3
+        assert move(client, 1, "OUT", 1).status_code == 409